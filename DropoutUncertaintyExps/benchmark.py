@@ -0,0 +1,166 @@
+# This file contains a CPU benchmark of the dropout network on the UCI datasets. For every
+# dataset, on the first split, it reports:
+# 1. Training throughput (samples / s) of net.net for a fixed number of epochs.
+# 2. Prediction latency per MC dropout sample of net.predict on the validation set, and of
+#    the NumPy engine of mc_engine.py.
+# 3. Wall time of one grid cell (training and validation predictions).
+# 4. Peak resident memory of the process running the dataset.
+# Every dataset runs in its own process, so peak memory is not shared between datasets.
+# Results can be saved as a baseline, later runs are compared to it and regressions above a
+# threshold are flagged (exit code 1).
+#
+#   python benchmark.py --save                  # measure and store the baseline
+#   python benchmark.py -d yacht -d concrete    # measure and compare to the baseline
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+_BASE = os.path.dirname(os.path.abspath(__file__))
+_DATASETS = os.path.join(_BASE, 'UCI_Datasets')
+
+# Metric -> True when higher is better
+_METRICS = dict(train_samples_per_s = True, predict_ms_per_sample = False, numpy_ms_per_sample = False,
+    cell_wall_time = False, peak_rss_mb = False)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.**2 if sys.platform == 'darwin' else 1024.)
+
+
+def measure(name, n_epochs, T, n_layers = 2):
+    """
+       Method to benchmark one dataset in the current process.
+       @param name      Name of the UCI dataset directory
+       @param n_epochs  Number of training epochs
+       @param T         Number of MC dropout samples
+       @param n_layers  Number of hidden layers
+       @return metrics  Dictionary of the measured metrics
+    """
+    os.environ.setdefault('CUDA_VISIBLE_DEVICES', '')
+    sys.path.append(os.path.join(_BASE, 'net'))
+    sys.path.append(_BASE)
+    import numpy as np
+    import net
+    import mc_engine
+    import cache
+    import datasets
+    from parallel import split_data
+
+    dataset = datasets.load(os.path.join(_DATASETS, name, 'data'))
+    data = np.asarray(dataset['data'], dtype = np.float64)
+    X = data[:, np.asarray(dataset['index_features'])]
+    y = data[:, int(dataset['index_target'])]
+    X_train, y_train, X_validation, y_validation = split_data(X, y, np.asarray(dataset['index_train'][0]),
+        np.asarray(dataset['index_test'][0]), False)
+    cache.set_seed(0)
+
+    start_time = time.time()
+    network = net.net(X_train, y_train, [ int(dataset['n_hidden']) ] * n_layers, normalize = True,
+        n_epochs = n_epochs, tau = dataset['tau_values'][0], dropout = dataset['dropout_rates'][0])
+    predict_time = time.time()
+    network.predict(X_validation, y_validation, T = T)
+    end_time = time.time()
+    engine = mc_engine.mc_engine(mc_engine.export(network), seed = 0)
+    engine.predict(X_validation, y_validation, T = T)
+    numpy_time = time.time() - end_time
+
+    return dict(rows = int(X.shape[0]), features = int(X.shape[1]), epochs = n_epochs, T = T,
+        train_samples_per_s = X_train.shape[0] * n_epochs / network.running_time,
+        predict_ms_per_sample = 1e3 * (end_time - predict_time) / T,
+        numpy_ms_per_sample = 1e3 * numpy_time / T,
+        cell_wall_time = end_time - start_time,
+        peak_rss_mb = _peak_rss_mb())
+
+
+def run(names, n_epochs, T, n_layers = 2):
+    """
+       Method to benchmark every dataset in its own process.
+       @return results  Dictionary dataset -> metrics
+    """
+    results = {}
+    for name in names:
+        print ('Benchmarking ' + name + '...')
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--one', name,
+            '--epochs', str(n_epochs), '-T', str(T), '--hidden', str(n_layers)])
+        results[name] = json.loads(out.decode().strip().splitlines()[-1])
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+       Method to find the metrics that regressed by more than threshold (relative)
+       with respect to the baseline.
+       @return regressions  List of (dataset, metric, baseline value, value)
+    """
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        # Only runs with the same settings are comparable
+        if name not in baseline or any(baseline[name][k] != metrics[k] for k in ['epochs', 'T']):
+            continue
+        for m, higher in _METRICS.items():
+            if m not in baseline[name]:
+                continue
+            old, new = baseline[name][m], metrics[m]
+            change = (old - new) / old if higher else (new - old) / old
+            if change > threshold:
+                regressions.append((name, m, old, new))
+    return regressions
+
+
+def report(results, baseline = None):
+    metrics = ['train_samples_per_s', 'predict_ms_per_sample', 'numpy_ms_per_sample', 'cell_wall_time',
+        'peak_rss_mb']
+    print ('%-28s %8s %14s %14s %14s %10s %10s' % ('Dataset', 'rows', 'train samp/s', 'ms/MC sample',
+        'numpy ms/MC', 'cell s', 'peak MB'))
+    for name, r in sorted(results.items(), key = lambda r: r[1]['rows']):
+        print ('%-28s %8d %14.1f %14.4f %14.4f %10.2f %10.1f' % (name, r['rows'], r['train_samples_per_s'],
+            r['predict_ms_per_sample'], r['numpy_ms_per_sample'], r['cell_wall_time'], r['peak_rss_mb']))
+        if baseline is not None and name in baseline:
+            b = baseline[name]
+            print ('%-28s %8s %13s%% %13s%% %13s%% %9s%% %9s%%' % (('  vs baseline', '') +
+                tuple('%+.1f' % (100. * (r[m] / b[m] - 1)) if m in b else '-' for m in metrics)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dir', '-d', action='append', default=None, help='UCI Dataset directory to benchmark, can be repeated (default: all).')
+    parser.add_argument('--epochs', '-e', default=10, type=int, help='Number of training epochs.')
+    parser.add_argument('-T', default=1000, type=int, help='Number of MC dropout samples.')
+    parser.add_argument('--hidden', '-nh', default=2, type=int, help='Number of hidden layers.')
+    parser.add_argument('--baseline', '-b', default=os.path.join(_BASE, 'benchmark_baseline.json'), help='Baseline file.')
+    parser.add_argument('--save', action='store_true', help='Store the results as the new baseline.')
+    parser.add_argument('--threshold', default=0.1, type=float, help='Relative change flagged as a regression.')
+    parser.add_argument('--one', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one is not None:
+        print (json.dumps(measure(args.one, args.epochs, args.T, args.hidden)))
+        sys.exit(0)
+
+    names = args.dir or sorted(os.listdir(_DATASETS))
+    results = run(names, args.epochs, args.T, args.hidden)
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.save:
+        baseline = dict(baseline or {}, **results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+        print ('Baseline saved to ' + args.baseline)
+    elif baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for name, m, old, new in regressions:
+            print ('REGRESSION %s %s: %g -> %g' % (name, m, old, new))
+        if regressions:
+            sys.exit(1)
+        print ('No regression above ' + str(100 * args.threshold) + '%.')
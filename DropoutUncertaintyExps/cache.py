@@ -0,0 +1,171 @@
+# This file contains a content-addressed cache of trained networks for experiment.py.
+# Every (split, phase, hidden layout, epochs, dropout_rate, tau, seed, MC samples) cell of a
+# dataset is stored under a key hashing these values together with the dataset itself and the
+# train / test indexes of the split. A cached cell holds the network weights, its
+# normalization statistics and its RMSE / log-likelihood, so reruns and grid extensions
+# only train the missing cells.
+
+import os
+import json
+import time
+import zlib
+import uuid
+import random
+import shutil
+import hashlib
+
+import numpy as np
+
+import net
+
+
+def job_seed(split, dropout_rate, tau, final=False):
+    """
+       Deterministic seed of a cell, independent of the order of execution.
+    """
+    return zlib.crc32(repr((split, dropout_rate, tau, final)).encode()) & 0x7fffffff
+
+
+_SESSION = {}
+
+
+def set_threads(threads):
+    """
+       Number of threads of the tensorflow sessions created by set_seed.
+    """
+    _SESSION['threads'] = threads
+
+
+def set_seed(seed):
+    """
+       Seed the generators of a cell on a fresh keras graph. Tensorflow derives
+       op seeds from the number of ops already in the graph, so reusing the graph
+       of the cells run before in the process would change the results.
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    import keras.backend as K
+    K.clear_session()
+    if K.backend() == 'tensorflow':
+        import tensorflow as tf
+        tf.set_random_seed(seed)
+        if 'threads' in _SESSION:
+            K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=_SESSION['threads'],
+                inter_op_parallelism_threads=_SESSION['threads'])))
+
+
+class cache:
+
+    def __init__(self, path, X, y):
+
+        """
+            Cache of trained networks of one dataset.
+
+            @param path     Directory of the cache.
+            @param X, y     Features and targets of the whole dataset, their
+                            content is part of every key.
+        """
+
+        self.path = path
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(X, dtype = np.float64).tobytes())
+        h.update(np.ascontiguousarray(y, dtype = np.float64).tobytes())
+        self.dataset = h.hexdigest()
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def key(self, split, index, final, n_hidden, n_epochs, dropout_rate, tau, seed, T, tol = None):
+
+        """
+            @param index    (index_train, index_test) of the split, their content is
+                            part of the key, so regenerated splits are new cells.
+            @param T        Number of MC samples of the evaluation.
+        """
+
+        h = hashlib.sha1()
+        for i in index:
+            h.update(np.ascontiguousarray(i, dtype = '<i8').tobytes())
+        cell = dict(dataset = self.dataset, split = int(split), index = h.hexdigest(), final = bool(final),
+            n_hidden = [int(n) for n in n_hidden], n_epochs = int(n_epochs),
+            dropout = float(dropout_rate), tau = float(tau), seed = int(seed), T = int(T))
+        if tol is not None:
+            # Metrics of sequential MC estimates are different cells
+            cell['tol'] = float(tol)
+        return hashlib.sha1(json.dumps(cell, sort_keys = True).encode()).hexdigest()
+
+    def _dir(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key):
+
+        """
+            @return metrics     Cached (error, MC_error, ll, running_time) of the
+                                cell, or None if the cell was never trained.
+        """
+
+        fname = os.path.join(self._dir(key), 'metrics.json')
+        if not os.path.exists(fname):
+            return None
+        with open(fname) as f:
+            m = json.load(f)
+        return m['error'], m['MC_error'], m['ll'], m['running_time']
+
+    def load(self, key):
+        return net.load(self._dir(key))
+
+    def put(self, key, network, metrics):
+
+        """
+            Store a trained network and its metrics. The entry is written to a
+            temporary directory unique to the writer and renamed, so concurrent
+            writers never leave partial entries.
+        """
+
+        d = self._dir(key)
+        tmp = d + '.tmp%d.%s' % (os.getpid(), uuid.uuid4().hex)
+        os.makedirs(tmp)
+        network.save(tmp)
+        error, MC_error, ll, running_time = metrics
+        with open(os.path.join(tmp, 'metrics.json'), 'w') as f:
+            json.dump(dict(error = float(error), MC_error = float(MC_error), ll = float(ll),
+                running_time = float(running_time)), f)
+        try:
+            os.rename(tmp, d)
+        except OSError:
+            # Another writer stored the cell first
+            shutil.rmtree(tmp)
+
+
+def run_cell(store, split, index, final, X_train, y_train, X_eval, y_eval, n_hidden, n_epochs, tau, dropout_rate,
+        tol = None, T = 10000):
+
+    """
+        Train and evaluate a network for one cell with its own seed, or return its cached
+        metrics. Runs with and without a cache use this function, so they are reproducible
+        against each other.
+
+        @param store    cache object, or None to always train.
+        @param index    (index_train, index_test) of the split.
+        @param tol      Tolerance of the sequential MC estimates (see net.predict),
+                        None to draw all samples.
+        @param T        Number of MC samples.
+        @return error, MC_error, ll, running_time
+    """
+
+    # The cell is seeded before the cache is checked, so cached and uncached runs of a
+    # cell train from the same generator state
+    seed = job_seed(split, dropout_rate, tau, final)
+    set_seed(seed)
+    key = store.key(split, index, final, n_hidden, n_epochs, dropout_rate, tau, seed, T, tol) if store is not None else None
+    metrics = store.get(key) if store is not None else None
+    if metrics is not None:
+        print ('Loaded cached cell: Tau: ' + str(tau) + ' Dropout rate: ' + str(dropout_rate))
+        return metrics
+    start_time = time.time()
+    network = net.net(X_train, y_train, n_hidden, normalize = True, n_epochs = n_epochs, tau = tau,
+        dropout = dropout_rate)
+    error, MC_error, ll = network.predict(X_eval, y_eval, T = T, tol = tol)
+    metrics = (error, MC_error, ll, time.time() - start_time)
+    if store is not None:
+        store.put(key, network, metrics)
+    return metrics
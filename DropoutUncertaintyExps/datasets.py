@@ -0,0 +1,124 @@
+# This file contains a converter and a loader for a binary format of the UCI datasets.
+# Each dataset is stored in one file, data/data.bin, holding the data as float32, the
+# training/test split indexes as int32 matrices (one row per split) and the metadata
+# (n_hidden, n_epochs, n_splits, dropout_rates, tau_values, feature and target indexes).
+#
+# Layout: 8 bytes magic, 8 bytes little-endian header length, a JSON header describing the
+# arrays (dtype, shape, offset) and the metadata, then the arrays, each aligned to 64 bytes.
+# Arrays are read by memory mapping, so loading does not parse or copy the data.
+#
+# To convert datasets (all of them by default):
+#   python datasets.py [<UCI Dataset directory> ...]
+
+import os
+import sys
+import json
+import struct
+
+import numpy as np
+
+_MAGIC = b'UCIBIN01'
+_ALIGN = 64
+_BINARY_FILE = 'data.bin'
+
+
+def _text(path, name):
+    return np.loadtxt(os.path.join(path, name))
+
+
+def load_text(path):
+    """
+       Method to load a dataset from the original text files.
+       @param path      Data directory of the dataset, e.g. UCI_Datasets/yacht/data/
+       @return dataset  Dictionary with data, index_train, index_test, index_features,
+                        index_target and the metadata
+    """
+    n_splits = int(_text(path, 'n_splits.txt'))
+    dataset = dict(data = _text(path, 'data.txt'),
+        index_train = [_text(path, 'index_train_%d.txt' % k).astype(int) for k in range(n_splits)],
+        index_test = [_text(path, 'index_test_%d.txt' % k).astype(int) for k in range(n_splits)],
+        index_features = np.array(_text(path, 'index_features.txt'), ndmin = 1).astype(int),
+        index_target = int(_text(path, 'index_target.txt')),
+        n_hidden = int(_text(path, 'n_hidden.txt')),
+        n_epochs = int(_text(path, 'n_epochs.txt')),
+        n_splits = n_splits,
+        dropout_rates = np.array(_text(path, 'dropout_rates.txt'), ndmin = 1).tolist(),
+        tau_values = np.array(_text(path, 'tau_values.txt'), ndmin = 1).tolist())
+    return dataset
+
+
+def convert(path):
+    """
+       Method to convert the text files of a dataset to the binary format.
+       @param path      Data directory of the dataset
+       @return fname    Path of the binary file
+    """
+    dataset = load_text(path)
+    arrays = dict(data = np.asarray(dataset['data'], dtype = '<f4'),
+        index_train = np.array(dataset['index_train'], dtype = '<i4'),
+        index_test = np.array(dataset['index_test'], dtype = '<i4'),
+        index_features = np.asarray(dataset['index_features'], dtype = '<i4'))
+    meta = dict((k, dataset[k]) for k in ['index_target', 'n_hidden', 'n_epochs', 'n_splits',
+        'dropout_rates', 'tau_values'])
+    header = dict(arrays = {}, meta = meta)
+
+    # We compute the offsets with a header of the final size, then write everything
+    size = 0
+    while True:
+        start = _pad(len(_MAGIC) + 8 + size)
+        for name, a in arrays.items():
+            header['arrays'][name] = dict(dtype = a.dtype.str, shape = list(a.shape), offset = start)
+            start = _pad(start + a.nbytes)
+        encoded = json.dumps(header).encode()
+        if len(encoded) == size:
+            break
+        size = len(encoded)
+
+    fname = os.path.join(path, _BINARY_FILE)
+    with open(fname + '.tmp', 'wb') as f:
+        f.write(_MAGIC + struct.pack('<Q', size) + encoded)
+        for name, a in arrays.items():
+            f.write(b'\0' * (header['arrays'][name]['offset'] - f.tell()))
+            f.write(a.tobytes())
+    os.rename(fname + '.tmp', fname)
+    return fname
+
+
+def _pad(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def load_binary(path):
+    """
+       Method to load a dataset from its binary file, arrays are memory mapped.
+       @param path      Data directory of the dataset
+       @return dataset  Dictionary with the same keys as load_text
+    """
+    fname = os.path.join(path, _BINARY_FILE)
+    with open(fname, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('Not a binary UCI dataset: ' + fname)
+        size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(size).decode())
+    dataset = dict(header['meta'])
+    for name, a in header['arrays'].items():
+        dataset[name] = np.memmap(fname, dtype = np.dtype(a['dtype']), mode = 'r', offset = a['offset'],
+            shape = tuple(a['shape']))
+    return dataset
+
+
+def load(path):
+    """
+       Method to load a dataset, from its binary file if it exists, else from the
+       text files.
+    """
+    if os.path.exists(os.path.join(path, _BINARY_FILE)):
+        return load_binary(path)
+    return load_text(path)
+
+
+if __name__ == '__main__':
+    base = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'UCI_Datasets')
+    names = sys.argv[1:] or sorted(os.listdir(base))
+    for name in names:
+        print ('Converting ' + name + ' -> ' + convert(os.path.join(base, name, 'data')))
@@ -12,15 +12,24 @@
 # 7. Report the averaged performance (Monte Carlo RMSE and log-likelihood) on all 20 splits.
 
 import math
-import numpy as np
+import time
 import argparse
 import sys
+import os
 
 parser=argparse.ArgumentParser()
 
 parser.add_argument('--dir', '-d', required=True, help='Name of the UCI Dataset directory. Eg: bostonHousing')
 parser.add_argument('--epochx','-e', default=500, type=int, help='Multiplier for the number of epochs for training.')
 parser.add_argument('--hidden', '-nh', default=2, type=int, help='Number of hidden layers for the neural net')
+parser.add_argument('--jobs', '-j', default=1, type=int, help='Number of worker processes for the grid search (0 for all cores).')
+parser.add_argument('--threads', '-t', default=1, type=int, help='Number of threads per worker process when running in parallel.')
+parser.add_argument('--tol', default=None, type=float, help='Draw the MC samples of the validation predictions sequentially until the standard errors of MC RMSE and LL are below this tolerance.')
+parser.add_argument('--db', default=None, help='SQLite results store. Records are committed as they are computed and runs resume from them.')
+parser.add_argument('--cache', '-c', default=None, help='Directory of the cache of trained networks. Cached cells are not retrained.')
+parser.add_argument('--search', '-s', default='grid', choices=['grid', 'halving', 'stacked'], help='Hyperparameter search: exhaustive grid, successive halving (serial) or the whole grid trained as one stacked model (serial).')
+parser.add_argument('--eta', default=3, type=int, help='Successive halving keeps 1/eta of the candidates at every rung.')
+parser.add_argument('--patience', default=None, type=int, help='Successive halving stops candidates whose validation log-likelihood did not improve for this many rungs.')
 
 args=parser.parse_args()
 
@@ -28,9 +37,22 @@ data_directory = args.dir
 epochs_multiplier = args.epochx
 num_hidden_layers = args.hidden
 
+# In parallel mode we pin the thread counts before numpy and the keras backend are
+# loaded, the forked worker processes inherit them
+
+if args.jobs != 1:
+    for v in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']:
+        os.environ[v] = str(args.threads)
+
+import numpy as np
+
 sys.path.append('net/')
 
 import net
+import cache
+import halving
+import datasets
+import results
 
 # We delete previous results
 
@@ -48,27 +70,66 @@ _RESULTS_TEST_MC_RMSE = "./UCI_Datasets/" + data_directory + "/results/test_MC_r
 _RESULTS_TEST_LOG = "./UCI_Datasets/" + data_directory + "/results/log_" + str(epochs_multiplier) + "_xepochs_" + str(num_hidden_layers) + "_hidden_layers.txt"
 
 _DATA_DIRECTORY_PATH = "./UCI_Datasets/" + data_directory + "/data/"
-_DROPOUT_RATES_FILE = _DATA_DIRECTORY_PATH + "dropout_rates.txt"
-_TAU_VALUES_FILE = _DATA_DIRECTORY_PATH + "tau_values.txt"
-_DATA_FILE = _DATA_DIRECTORY_PATH + "data.txt"
-_HIDDEN_UNITS_FILE = _DATA_DIRECTORY_PATH + "n_hidden.txt"
-_EPOCHS_FILE = _DATA_DIRECTORY_PATH + "n_epochs.txt"
-_INDEX_FEATURES_FILE = _DATA_DIRECTORY_PATH + "index_features.txt"
-_INDEX_TARGET_FILE = _DATA_DIRECTORY_PATH + "index_target.txt"
-_N_SPLITS_FILE = _DATA_DIRECTORY_PATH + "n_splits.txt"
-
-def _get_index_train_test_path(split_num, train = True):
+
+def _write_validation(split, dropout_rate, tau, error, MC_error, ll):
+    """
+       Method to write the validation results of one grid search step to the text files.
+    """
+    with open(_RESULTS_VALIDATION_RMSE, "a") as myfile:
+        myfile.write('Dropout_Rate: ' + repr(dropout_rate) + ' Tau: ' + repr(tau) + ' :: ')
+        myfile.write(repr(error) + '\n')
+
+    with open(_RESULTS_VALIDATION_MC_RMSE, "a") as myfile:
+        myfile.write('Dropout_Rate: ' + repr(dropout_rate) + ' Tau: ' + repr(tau) + ' :: ')
+        myfile.write(repr(MC_error) + '\n')
+
+    with open(_RESULTS_VALIDATION_LL, "a") as myfile:
+        myfile.write('Dropout_Rate: ' + repr(dropout_rate) + ' Tau: ' + repr(tau) + ' :: ')
+        myfile.write(repr(ll) + '\n')
+
+def _write_test(split, error, MC_error, ll, tau):
     """
-       Method to generate the path containing the training/test split for the given
-       split number (generally from 1 to 20).
-       @param split_num      Split number for which the data has to be generated
-       @param train          Is true if the data is training data. Else false.
-       @return path          Path of the file containing the requried data
+       Method to write the test results of one split to the text files.
     """
-    if train:
-        return _DATA_DIRECTORY_PATH + "index_train_" + str(split_num) + ".txt"
+    with open(_RESULTS_TEST_RMSE, "a") as myfile:
+        myfile.write(repr(error) + '\n')
+
+    with open(_RESULTS_TEST_MC_RMSE, "a") as myfile:
+        myfile.write(repr(MC_error) + '\n')
+
+    with open(_RESULTS_TEST_LL, "a") as myfile:
+        myfile.write(repr(ll) + '\n')
+
+    with open(_RESULTS_TEST_TAU, "a") as myfile:
+        myfile.write(repr(tau) + '\n')
+
+def _record_validation(split, dropout_rate, tau, error, MC_error, ll, running_time = None, epochs = None):
+    """
+       Method to store the validation results of one grid search step, committed to the
+       results store if one is used, else appended to the text files.
+    """
+    if db is not None:
+        db.add(split, 'validation', dropout_rate, tau, error, MC_error, ll, running_time, epochs)
     else:
-        return _DATA_DIRECTORY_PATH + "index_test_" + str(split_num) + ".txt" 
+        _write_validation(split, dropout_rate, tau, error, MC_error, ll)
+
+def _record_test(split, error, MC_error, ll, tau, dropout_rate = None, running_time = None, epochs = None):
+    """
+       Method to store the test results of one split, committed to the results store if
+       one is used, else appended to the text files.
+    """
+    if db is not None:
+        db.add(split, 'test', dropout_rate, tau, error, MC_error, ll, running_time, epochs)
+    else:
+        _write_test(split, error, MC_error, ll, tau)
+
+def _lookup(split, dropout_rate, tau, final):
+    """
+       Method to get the committed results of a cell when resuming a run.
+    """
+    if db is None:
+        return None
+    return db.get(split, 'test' if final else 'validation', dropout_rate, tau)
 
 
 print ("Removing existing result files...")
@@ -87,45 +148,68 @@ print ("Result files removed.")
 np.random.seed(1)
 
 print ("Loading data and other hyperparameters...")
-# We load the data
-
-data = np.loadtxt(_DATA_FILE)
+# We load the data, the hyperparameters and the splits, from the binary file of the
+# dataset if it was created with datasets.py, else from the text files
 
-# We load the number of hidden units
+dataset = datasets.load(_DATA_DIRECTORY_PATH)
+data = dataset['data']
 
-n_hidden = np.loadtxt(_HIDDEN_UNITS_FILE).tolist()
+# We load the number of hidden units and the number of training epocs
 
-# We load the number of training epocs
-
-n_epochs = np.loadtxt(_EPOCHS_FILE).tolist()
+n_hidden = dataset['n_hidden']
+n_epochs = dataset['n_epochs']
 
 # We load the indexes for the features and for the target
 
-index_features = np.loadtxt(_INDEX_FEATURES_FILE)
-index_target = np.loadtxt(_INDEX_TARGET_FILE)
+index_features = np.asarray(dataset['index_features'])
+index_target = dataset['index_target']
 
-X = data[ : , [int(i) for i in index_features.tolist()] ]
-y = data[ : , int(index_target.tolist()) ]
+X = data[ : , index_features ]
+y = data[ : , int(index_target) ]
 
 # We iterate over the training test splits
 
-n_splits = np.loadtxt(_N_SPLITS_FILE)
+n_splits = dataset['n_splits']
 print ("Done.")
 
+# We open the cache of trained networks, keyed by the content of the dataset
+
+store = cache.cache(args.cache, X, y) if args.cache is not None else None
+
+# We open the results store, records already committed by a previous run are not recomputed
+
+db = results.results(args.db, data_directory, epochs_multiplier, num_hidden_layers) if args.db is not None else None
+
 errors, MC_errors, lls = [], [], []
-for split in range(int(n_splits)):
+if args.jobs != 1 and args.search == 'grid':
+
+    # We run every (split, dropout_rate, tau) cell on a process pool
+
+    import parallel
+    splits = [(np.asarray(dataset['index_train'][split]), np.asarray(dataset['index_test'][split]))
+        for split in range(int(n_splits))]
+    errors, MC_errors, lls = parallel.run(X, y, splits, list(dataset['dropout_rates']),
+        list(dataset['tau_values']), [ int(n_hidden) ] * num_hidden_layers,
+        int(n_epochs * epochs_multiplier), _record_validation, _record_test,
+        jobs = args.jobs or None, threads = args.threads, store = store, lookup = _lookup, tol = args.tol)
+
+serial_splits = range(int(n_splits)) if (args.jobs == 1 or args.search != 'grid') else []
+for split in serial_splits:
+
+    if db is not None and db.get(split, 'test') is not None:
+        print ('Split ' + str(split) + ' found in the results store, skipping.')
+        continue
 
     # We load the indexes of the training and test sets
-    print ('Loading file: ' + _get_index_train_test_path(split, train=True))
-    print ('Loading file: ' + _get_index_train_test_path(split, train=False))
-    index_train = np.loadtxt(_get_index_train_test_path(split, train=True))
-    index_test = np.loadtxt(_get_index_train_test_path(split, train=False))
+    print ('Loading split: ' + str(split))
+    index_train = np.asarray(dataset['index_train'][split])
+    index_test = np.asarray(dataset['index_test'][split])
 
-    X_train = X[ [int(i) for i in index_train.tolist()] ]
-    y_train = y[ [int(i) for i in index_train.tolist()] ]
+    X_train = X[ index_train ]
+    y_train = y[ index_train ]
     
-    X_test = X[ [int(i) for i in index_test.tolist()] ]
-    y_test = y[ [int(i) for i in index_test.tolist()] ]
+    X_test = X[ index_test ]
+    y_test = y[ index_test ]
 
     X_train_original = X_train
     y_train_original = y_train
@@ -142,69 +226,82 @@ for split in range(int(n_splits)):
     print ('Number of train_original examples: ' + str(X_train_original.shape[0]))
 
     # List of hyperparameters which we will try out using grid-search
-    dropout_rates = np.loadtxt(_DROPOUT_RATES_FILE).tolist()
-    tau_values = np.loadtxt(_TAU_VALUES_FILE).tolist()
+    dropout_rates = list(dataset['dropout_rates'])
+    tau_values = list(dataset['tau_values'])
 
     # We perform grid-search to select the best hyperparameters based on the highest log-likelihood value
-    best_network = None
     best_ll = -float('inf')
     best_tau = 0
     best_dropout = 0
+    if args.search == 'halving':
+        # We select the best hyperparameters with successive halving on growing epoch budgets
+        best_dropout, best_tau, best_ll, _ = halving.successive_halving(X_train, y_train, X_validation,
+            y_validation, dropout_rates, tau_values, ([ int(n_hidden) ] * num_hidden_layers),
+            int(n_epochs * epochs_multiplier), eta = args.eta, patience = args.patience,
+            write_validation = lambda *r, **kw: _record_validation(split, *r, **kw), tol = args.tol)
+        dropout_rates = []
+    stacked = {}
+    if args.search == 'stacked':
+        # We train all the cells of the grid (but those found in the results store) as
+        # one model with a branch per cell, and evaluate every branch on the validation set
+        cells = [(d, t) for d in dropout_rates for t in tau_values if _lookup(split, d, t, False) is None]
+        if cells:
+            print ('Training ' + str(len(cells)) + ' grid cells as one stacked model')
+            start_time = time.time()
+            network = net.grid_net(X_train, y_train, ([ int(n_hidden) ] * num_hidden_layers), cells,
+                normalize = True, n_epochs = int(n_epochs * epochs_multiplier))
+            cell_results = network.predict(X_validation, y_validation, tol = args.tol)
+            running_time = (time.time() - start_time) / len(cells)
+            for cell, result in zip(cells, cell_results):
+                stacked[cell] = tuple(result) + (running_time,)
     for dropout_rate in dropout_rates:
         for tau in tau_values:
             print ('Grid search step: Tau: ' + str(tau) + ' Dropout rate: ' + str(dropout_rate))
-            network = net.net(X_train, y_train, ([ int(n_hidden) ] * num_hidden_layers),
-                    normalize = True, n_epochs = int(n_epochs * epochs_multiplier), tau = tau,
-                    dropout = dropout_rate)
-
-            # We obtain the test RMSE and the test ll from the validation sets
-
-            error, MC_error, ll = network.predict(X_validation, y_validation)
+            resumed = _lookup(split, dropout_rate, tau, False)
+            if resumed is not None:
+                # We resume the cell from the results store
+                error, MC_error, ll, running_time = resumed
+            elif (dropout_rate, tau) in stacked:
+                error, MC_error, ll, running_time = stacked[(dropout_rate, tau)]
+            else:
+                # We train the cell with its own seed (with or without the cache), or load its
+                # results from the cache, and obtain the RMSE and ll from the validation set
+                error, MC_error, ll, running_time = cache.run_cell(store, split, (index_train, index_test), False,
+                    X_train, y_train, X_validation, y_validation, ([ int(n_hidden) ] * num_hidden_layers),
+                    int(n_epochs * epochs_multiplier), tau, dropout_rate, args.tol)
             if (ll > best_ll):
                 best_ll = ll
-                best_network = network
                 best_tau = tau
                 best_dropout = dropout_rate
                 print ('Best log_likelihood changed to: ' + str(best_ll))
                 print ('Best tau changed to: ' + str(best_tau))
                 print ('Best dropout rate changed to: ' + str(best_dropout))
             
-            # Storing validation results
-            with open(_RESULTS_VALIDATION_RMSE, "a") as myfile:
-                myfile.write('Dropout_Rate: ' + repr(dropout_rate) + ' Tau: ' + repr(tau) + ' :: ')
-                myfile.write(repr(error) + '\n')
-
-            with open(_RESULTS_VALIDATION_MC_RMSE, "a") as myfile:
-                myfile.write('Dropout_Rate: ' + repr(dropout_rate) + ' Tau: ' + repr(tau) + ' :: ')
-                myfile.write(repr(MC_error) + '\n')
-
-            with open(_RESULTS_VALIDATION_LL, "a") as myfile:
-                myfile.write('Dropout_Rate: ' + repr(dropout_rate) + ' Tau: ' + repr(tau) + ' :: ')
-                myfile.write(repr(ll) + '\n')
+            # Storing validation results, cells resumed from the results store are already committed
+            if resumed is None:
+                _record_validation(split, dropout_rate, tau, error, MC_error, ll, running_time,
+                    int(n_epochs * epochs_multiplier))
 
     # Storing test results
-    best_network = net.net(X_train_original, y_train_original, ([ int(n_hidden) ] * num_hidden_layers),
-                    normalize = True, n_epochs = int(n_epochs * epochs_multiplier), tau = best_tau,
-                    dropout = best_dropout)
-    error, MC_error, ll = best_network.predict(X_test, y_test)
-    
-    with open(_RESULTS_TEST_RMSE, "a") as myfile:
-        myfile.write(repr(error) + '\n')
-
-    with open(_RESULTS_TEST_MC_RMSE, "a") as myfile:
-        myfile.write(repr(MC_error) + '\n')
-
-    with open(_RESULTS_TEST_LL, "a") as myfile:
-        myfile.write(repr(ll) + '\n')
-
-    with open(_RESULTS_TEST_TAU, "a") as myfile:
-        myfile.write(repr(best_network.tau) + '\n')
+    error, MC_error, ll, running_time = cache.run_cell(store, split, (index_train, index_test), True,
+        X_train_original, y_train_original, X_test, y_test, ([ int(n_hidden) ] * num_hidden_layers),
+        int(n_epochs * epochs_multiplier), best_tau, best_dropout)
+    _record_test(split, error, MC_error, ll, best_tau, best_dropout, running_time,
+        int(n_epochs * epochs_multiplier))
 
     print ("Tests on split " + str(split) + " complete.")
     errors += [error]
     MC_errors += [MC_error]
     lls += [ll]
 
+# With a results store, the text files are written from the committed records of all splits
+
+if db is not None:
+    db.export(_write_validation, _write_test)
+    errors = [r[3] for r in db.records('test')]
+    MC_errors = [r[4] for r in db.records('test')]
+    lls = [r[5] for r in db.records('test')]
+
 with open(_RESULTS_TEST_LOG, "a") as myfile:
     myfile.write('errors %f +- %f (stddev) +- %f (std error), median %f 25p %f 75p %f \n' % (
         np.mean(errors), np.std(errors), np.std(errors)/math.sqrt(n_splits),
@@ -0,0 +1,83 @@
+# This file contains a successive halving search over the (dropout_rate, tau) grid used in
+# experiment.py, as an alternative to training every candidate for the full budget:
+# 1. Train all candidates for a small number of epochs and compute the validation log-likelihood.
+# 2. Keep the best 1 / eta fraction of the candidates.
+# 3. Continue training the survivors with an eta times larger budget, until the full number of
+#    epochs is reached.
+# Optionally, a survivor whose validation log-likelihood has not improved for `patience`
+# consecutive rungs is stopped early.
+
+import math
+
+import net
+
+
+def rungs(n_candidates, max_epochs, eta = 3):
+    """
+       Method to compute the epoch budget of every rung: the last rung trains for
+       max_epochs and every previous rung for eta times less.
+       @param n_candidates   Number of hyperparameter candidates
+       @param max_epochs     Number of epochs of the full budget
+       @param eta            Reduction factor between rungs
+       @return budgets       List with the cumulative number of epochs of each rung
+    """
+    n_rungs = int(math.ceil(math.log(n_candidates) / math.log(eta))) if n_candidates > 1 else 0
+    budgets = [max(1, int(round(max_epochs / float(eta**(n_rungs - i))))) for i in range(n_rungs)]
+    return sorted(set(budgets + [max_epochs]))
+
+
+def successive_halving(X_train, y_train, X_validation, y_validation, dropout_rates, tau_values,
+        n_hidden, max_epochs, eta = 3, patience = None, write_validation = None, tol = None):
+    """
+       Method to select the best hyperparameters with successive halving.
+       @param dropout_rates     List of dropout rates of the grid
+       @param tau_values        List of tau values of the grid
+       @param n_hidden          Vector with the number of neurons for each hidden layer
+       @param max_epochs        Number of epochs of the full budget
+       @param eta               Fraction 1 / eta of the candidates is kept at every rung
+       @param patience          Number of rungs without improvement of the validation
+                                log-likelihood after which a candidate is stopped
+       @param write_validation  Callback(dropout_rate, tau, error, MC_error, ll, epochs = n)
+                                storing the last validation results of every candidate
+       @param tol               Tolerance of the sequential MC estimates (see net.predict)
+       @return best_dropout, best_tau, best_ll, epochs  Best hyperparameters, their validation
+                                log-likelihood, and the total number of epochs trained
+    """
+    candidates = [dict(dropout = dropout_rate, tau = tau, network = None, best_ll = -float('inf'), stale = 0)
+        for dropout_rate in dropout_rates for tau in tau_values]
+    survivors = list(candidates)
+    budgets = rungs(len(candidates), max_epochs, eta)
+    epochs = 0
+    for i, budget in enumerate(budgets):
+        for c in survivors:
+            if c['network'] is None:
+                c['network'] = net.net(X_train, y_train, n_hidden, normalize = True, n_epochs = budget,
+                    tau = c['tau'], dropout = c['dropout'])
+                epochs += budget
+            else:
+                epochs += budget - c['network'].n_epochs
+                c['network'].train(budget - c['network'].n_epochs)
+            c['result'] = c['network'].predict(X_validation, y_validation, tol = tol)
+            c['epochs'] = budget
+            ll = c['result'][2]
+            c['stale'] = 0 if ll > c['best_ll'] else c['stale'] + 1
+            c['best_ll'] = max(c['best_ll'], ll)
+            print ('Rung ' + str(i) + ' (' + str(budget) + ' epochs): Tau: ' + str(c['tau']) +
+                ' Dropout rate: ' + str(c['dropout']) + ' :: ' + str(ll))
+
+        # We keep the top fraction of the candidates, dropping those that stopped improving
+        survivors.sort(key = lambda c: -c['result'][2])
+        if patience is not None:
+            survivors = [c for c in survivors if c['stale'] < patience] or survivors[:1]
+        if i < len(budgets) - 1:
+            survivors = survivors[:max(1, int(math.ceil(len(survivors) / float(eta))))]
+        for c in candidates:
+            if c not in survivors:
+                c['network'] = None
+
+    if write_validation is not None:
+        for c in candidates:
+            write_validation(c['dropout'], c['tau'], *c['result'], epochs = c['epochs'])
+    best = survivors[0]
+    print ('Successive halving: ' + str(epochs) + ' epochs instead of ' + str(len(candidates) * max_epochs))
+    return best['dropout'], best['tau'], best['result'][2], epochs
@@ -0,0 +1,130 @@
+# This file contains a pure-NumPy Monte Carlo dropout inference engine for the networks
+# trained by net.py. The Dense weights, the dropout rate and the normalization statistics are
+# exported from a trained network (or read from a directory written by net.save), and the MC
+# forward passes run as batched float32 matrix products: the test set is replicated for a block
+# of samples and the Bernoulli masks of the whole block, (samples x test points x units), are
+# drawn at once for every layer. The predictions are accumulated with net.mc_accumulator, so the
+# returned metrics are the same as those of net.predict.
+
+import numpy as np
+
+from net import mc_accumulator
+
+
+def export(network):
+
+    """
+        Function extracting the parameters of a trained network.
+
+        @param network  A trained net.net.
+
+        @return params  Dictionary with the Dense weights and biases (in
+                        layer order), the dropout rate, tau and the
+                        normalization statistics.
+    """
+
+    weights = network.model.get_weights()
+    return dict(weights = weights[0::2], biases = weights[1::2], dropout = float(network.dropout),
+        tau = float(network.tau), mean_X_train = network.mean_X_train, std_X_train = network.std_X_train,
+        mean_y_train = float(network.mean_y_train), std_y_train = float(network.std_y_train))
+
+
+def load(path):
+
+    """
+        Function reading the parameters of a network stored with net.save,
+        without building the keras model.
+
+        @param path     Directory in which the network is stored.
+    """
+
+    params = np.load(path + '/net.npz')
+    weights = np.load(path + '/weights.npz')
+    weights = [weights['arr_%d' % i] for i in range(len(weights.files))]
+    return dict(weights = weights[0::2], biases = weights[1::2], dropout = float(params['dropout']),
+        tau = float(params['tau']), mean_X_train = params['mean_X_train'], std_X_train = params['std_X_train'],
+        mean_y_train = float(params['mean_y_train']), std_y_train = float(params['std_y_train']))
+
+
+class mc_engine:
+
+    def __init__(self, params, seed = None):
+
+        """
+            MC dropout engine of a network exported with export or load.
+
+            @param params   Dictionary of the network parameters.
+            @param seed     Seed of the dropout masks.
+        """
+
+        self.weights = [np.ascontiguousarray(W, dtype = np.float32) for W in params['weights']]
+        self.biases = [np.asarray(b, dtype = np.float32) for b in params['biases']]
+        self.dropout = params['dropout']
+        self.tau = params['tau']
+        self.mean_X_train = params['mean_X_train']
+        self.std_X_train = params['std_X_train']
+        self.mean_y_train = params['mean_y_train']
+        self.std_y_train = params['std_y_train']
+        self.rng = np.random.default_rng(seed)
+
+    def forward(self, X, t = 1, mc = True):
+
+        """
+            Function computing t stochastic forward passes.
+
+            @param X        Normalized test features (N x features), float32.
+            @param t        Number of MC samples.
+            @param mc       Whether dropout is applied.
+
+            @return Y       Matrix (t x N) of normalized predictions.
+        """
+
+        N = X.shape[0]
+        h = np.tile(X, (t, 1)) if t > 1 else X
+        keep = 1. - self.dropout
+        for i, (W, b) in enumerate(zip(self.weights, self.biases)):
+            if mc and self.dropout > 0:
+                # Inverted dropout, as in the keras Dropout layer
+                h = h * (self.rng.random(h.shape, dtype = np.float32) < keep) * np.float32(1. / keep)
+            h = h @ W
+            h += b
+            if i < len(self.weights) - 1:
+                np.maximum(h, 0, out = h)
+        return h.reshape(t, N)
+
+    def predict(self, X_test, y_test, T = 10000, max_rows = 65536, tol = None, T_min = 100):
+
+        """
+            Function for making predictions, with the arguments and the results
+            of net.predict.
+
+            @param X_test   The matrix of features for the test data
+            @param T        Number of Monte Carlo dropout samples
+            @param max_rows Maximum number of replicated rows per block.
+            @param tol      Tolerance of the sequential MC estimates, see
+                            net.predict.
+
+            @return rmse_standard_pred, rmse, test_ll
+        """
+
+        X_test = np.array(X_test, ndmin = 2)
+        y_test = np.array(y_test, ndmin = 1).ravel()
+        X_test = ((X_test - self.mean_X_train) / self.std_X_train).astype(np.float32)
+
+        standard_pred = self.forward(X_test, mc = False)[0] * self.std_y_train + self.mean_y_train
+        rmse_standard_pred = np.mean((y_test - standard_pred)**2.)**0.5
+
+        N = X_test.shape[0]
+        samples_per_call = max(1, max_rows // N)
+        acc = mc_accumulator(y_test, self.tau)
+        while acc.T < T:
+            if tol is not None and acc.T >= T_min and max(acc.rmse_se(), acc.ll_se()) <= tol:
+                break
+            t = min(samples_per_call, T - acc.T)
+            if tol is not None:
+                t = min(t, max(T_min - acc.T, acc.T))
+            acc.update(self.forward(X_test, t) * self.std_y_train + self.mean_y_train)
+        self.mc_samples = acc.T
+        self.mc_se = (acc.rmse_se(), acc.ll_se())
+
+        return rmse_standard_pred, acc.rmse(), acc.ll()
@@ -6,28 +6,255 @@ import warnings
 warnings.filterwarnings("ignore")
 
 import math
-from scipy.misc import logsumexp
 import numpy as np
 
 from keras.regularizers import l2
 from keras import Input
 from keras.layers import Dropout
 from keras.layers import Dense
+from keras.layers import concatenate
 from keras import Model
+from keras import backend as K
 
 import time
 
 
+def _moments(X, chunk_rows):
+
+    """
+        Function computing the column means and standard deviations of an
+        array in one pass over chunks of rows (Chan's parallel update).
+    """
+
+    n, mean, m2 = 0, 0., 0.
+    for start in range(0, X.shape[0], chunk_rows):
+        x = np.asarray(X[start : start + chunk_rows], dtype = np.float64)
+        k = x.shape[0]
+        mu = x.mean(0)
+        delta = mu - mean
+        m2 = m2 + ((x - mu)**2.).sum(0) + delta**2. * n * k / (n + k)
+        mean = mean + delta * k / (n + k)
+        n += k
+    return mean, (m2 / n)**0.5
+
+
+def _statistics(X_train, y_train, normalize, chunk_rows = None):
+
+    """
+        Function computing the normalization statistics of the training
+        data: means and standard deviations of the features (zero and one
+        without normalize, a constant feature keeps a unit standard
+        deviation) and of the targets. With chunk_rows the data is read in
+        one pass over chunks of rows.
+    """
+
+    if chunk_rows is not None:
+        mean_X, std_X = _moments(X_train, chunk_rows)
+        mean_y, std_y = [float(v) for v in _moments(y_train, chunk_rows)]
+    else:
+        mean_X, std_X = np.mean(X_train, 0), np.std(X_train, 0)
+        mean_y, std_y = np.mean(y_train), np.std(y_train)
+    if normalize:
+        std_X[ std_X == 0 ] = 1
+    else:
+        std_X = np.ones(X_train.shape[ 1 ])
+        mean_X = np.zeros(X_train.shape[ 1 ])
+    return mean_X, std_X, mean_y, std_y
+
+
+def _normalize(X, mean_X, std_X):
+    X = np.asarray(X, dtype = np.float32)
+    return (X - mean_X.astype(np.float32)) / std_X.astype(np.float32)
+
+
+def _regularisation(N, dropout, tau, lengthscale = 1e-2):
+    return lengthscale**2 * (1 - dropout) / (2. * N * tau)
+
+
+def _branch(inputs, n_hidden, dropout, reg):
+
+    """
+        Function building the layers of one MC dropout network on the
+        inputs: dropout (also at prediction time) before every dense layer
+        and L2 regularisation reg. Returns the output tensor.
+    """
+
+    inter = Dropout(dropout)(inputs, training=True)
+    inter = Dense(n_hidden[0], activation='relu', W_regularizer=l2(reg))(inter)
+    for i in range(len(n_hidden) - 1):
+        inter = Dropout(dropout)(inter, training=True)
+        inter = Dense(n_hidden[i+1], activation='relu', W_regularizer=l2(reg))(inter)
+    inter = Dropout(dropout)(inter, training=True)
+    return Dense(1, W_regularizer=l2(reg))(inter)
+
+
+def _mc_predict(model, X_test, y_test, mean_X, std_X, mean_y, std_y, taus, T, max_rows, tol, T_min):
+
+    """
+        Function computing the metrics of the MC dropout predictions of a
+        model with one output per tau (see net.predict for the arguments).
+        The test set is processed in chunks of max_rows rows; with tol set,
+        sampling of a chunk stops when the standard errors of every output
+        are below tol.
+
+        @return results     List with the (rmse_standard_pred, rmse,
+                            test_ll) of every output.
+        @return mc_samples  Largest number of samples drawn for a chunk.
+        @return mc_se       List with the (rmse, ll) Monte Carlo standard
+                            errors of every output.
+    """
+
+    n_out = len(taus)
+    N_test = X_test.shape[0]
+    sq_standard, sq, ll, se_sq, se_ll = [np.zeros(n_out) for _ in range(5)]
+    mc_samples = 0
+    for start in range(0, N_test, max_rows):
+
+        # We normalize the chunk of the test set
+
+        X = _normalize(np.array(X_test[start : start + max_rows], ndmin = 2), mean_X, std_X)
+        y = np.array(y_test[start : start + max_rows], ndmin = 1).ravel()
+        N = X.shape[0]
+
+        # We compute the predictive mean and variance for the target variables
+        # of the test data
+
+        standard_pred = model.predict(X, batch_size=500, verbose=0).reshape(N, n_out)
+        standard_pred = standard_pred * std_y + mean_y
+        sq_standard += np.sum((y[:, None] - standard_pred)**2., 0)
+
+        # We draw the MC samples in blocks of replicated inputs and accumulate
+        # the MC mean and the log-likelihood in a streaming fashion. In the
+        # sequential mode the blocks double in size, so that the number of
+        # samples overshoots the converged count by at most a factor 2
+
+        samples_per_call = max(1, max_rows // N)
+        accs = [mc_accumulator(y, tau) for tau in taus]
+        while accs[0].T < T:
+            if tol is not None and accs[0].T >= T_min and \
+                    max(max(acc.rmse_se(), acc.ll_se()) for acc in accs) <= tol:
+                break
+            t = min(samples_per_call, T - accs[0].T)
+            if tol is not None:
+                t = min(t, max(T_min - accs[0].T, accs[0].T))
+            Yt_hat = model.predict(np.tile(X, (t, 1)), batch_size=min(t * N, max_rows), verbose=0)
+            Yt_hat = Yt_hat.reshape(t, N, n_out) * std_y + mean_y
+            for k, acc in enumerate(accs):
+                acc.update(Yt_hat[:, :, k])
+
+        # We combine the chunks, weighting them by their number of points
+        for k, acc in enumerate(accs):
+            sq[k] += N * acc.rmse()**2.
+            ll[k] += N * acc.ll()
+            se_sq[k] += (2. * N * acc.rmse() * acc.rmse_se())**2.
+            se_ll[k] += (N * acc.ll_se())**2.
+        mc_samples = max(mc_samples, accs[0].T)
+
+    rmse_standard_pred = (sq_standard / N_test)**0.5
+    rmse = (sq / N_test)**0.5
+    mc_se = [(se_sq[k]**0.5 / N_test / (2. * max(rmse[k], 1e-12)), se_ll[k]**0.5 / N_test) for k in range(n_out)]
+
+    # We compute the test log-likelihood
+    return [(rmse_standard_pred[k], rmse[k], ll[k] / N_test) for k in range(n_out)], mc_samples, mc_se
+
+
+class mc_accumulator:
+
+    def __init__(self, y_test, tau):
+
+        """
+            Streaming statistics of Monte Carlo dropout samples. Memory does not
+            depend on the number of samples T: the MC mean is kept as a running
+            mean and sum of squared deviations, and the log-likelihood as a
+            running log-sum-exp together with the sum of the squared terms,
+            which give the Monte Carlo standard errors of both metrics.
+
+            @param y_test   Vector with the test target variables.
+            @param tau      Tau value used for the Gaussian likelihood.
+        """
+
+        self.y_test = np.array(y_test, ndmin = 1).ravel()
+        self.tau = tau
+        self.T = 0
+        self.mu = np.zeros(self.y_test.shape[0])
+        self.m2 = np.zeros(self.y_test.shape[0])
+        self.max = np.full(self.y_test.shape[0], -np.inf)
+        self.sumexp = np.zeros(self.y_test.shape[0])
+        self.sumexp2 = np.zeros(self.y_test.shape[0])
+
+    def update(self, Yt_hat):
+
+        """
+            Add a block of samples.
+
+            @param Yt_hat   Matrix (samples x test points) of predictions in
+                            the original target scale.
+        """
+
+        Yt_hat = np.array(Yt_hat, ndmin = 2)
+        t = Yt_hat.shape[0]
+        mu = Yt_hat.mean(0)
+        delta = mu - self.mu
+        self.m2 += ((Yt_hat - mu[None])**2.).sum(0) + delta**2. * self.T * t / (self.T + t)
+        self.mu += delta * t / (self.T + t)
+        self.T += t
+        l = -0.5 * self.tau * (self.y_test[None] - Yt_hat)**2.
+        new_max = np.maximum(self.max, l.max(0))
+        scale = np.exp(self.max - new_max)
+        e = np.exp(l - new_max[None])
+        self.sumexp = self.sumexp * scale + e.sum(0)
+        self.sumexp2 = self.sumexp2 * scale**2. + (e**2.).sum(0)
+        self.max = new_max
+
+    def mean(self):
+        return self.mu
+
+    def rmse(self):
+        return np.mean((self.y_test - self.mean())**2.)**0.5
+
+    def ll(self):
+        ll = (self.max + np.log(self.sumexp) - np.log(self.T)
+            - 0.5*np.log(2*np.pi) + 0.5*np.log(self.tau))
+        return np.mean(ll)
+
+    def rmse_se(self):
+
+        """
+            Monte Carlo standard error of the MC RMSE (delta method on the
+            per point MC means).
+        """
+
+        N = self.y_test.shape[0]
+        residual = self.y_test - self.mean()
+        var_mean = self.m2 / max(self.T - 1, 1) / self.T
+        return (np.sum(residual**2. * var_mean))**0.5 / (N * max(self.rmse(), 1e-12))
+
+    def ll_se(self):
+
+        """
+            Monte Carlo standard error of the test log-likelihood (delta method
+            on the per point log of the mean likelihood).
+        """
+
+        N = self.y_test.shape[0]
+        p = self.sumexp / self.T
+        var = np.maximum(self.sumexp2 / self.T - p**2., 0) * self.T / max(self.T - 1, 1)
+        return (np.sum(var / (self.T * p**2.)))**0.5 / N
+
+
 class net:
 
     def __init__(self, X_train, y_train, n_hidden, n_epochs = 40,
-        normalize = False, tau = 1.0, dropout = 0.05):
+        normalize = False, tau = 1.0, dropout = 0.05, chunk_rows = None):
 
         """
             Constructor for the class implementing a Bayesian neural network
             trained with the probabilistic back propagation method.
 
             @param X_train      Matrix with the features for the training data.
+                                Memory-mapped arrays (or any array supporting
+                                row slices, e.g. an h5py dataset) are not
+                                loaded: they are read in chunks of rows.
             @param y_train      Vector with the target variables for the
                                 training data.
             @param n_hidden     Vector with the number of neurons for each
@@ -43,62 +270,144 @@ class net:
             @param tau          Tau value used for regularization
             @param dropout      Dropout rate for all the dropout layers in the
                                 network.
+            @param chunk_rows   Number of rows read at once from out-of-core
+                                training data. If set, in-memory data is
+                                also streamed.
         """
 
+        # Data which is not an in-memory array is streamed: the normalization
+        # statistics are computed in one pass over chunks, and the network is
+        # trained on normalized float32 batches read from the source
+
+        self.out_of_core = chunk_rows is not None or not isinstance(X_train, np.ndarray) or \
+            isinstance(X_train, np.memmap)
+        self.batch_size = 128
+        self.chunk_rows = chunk_rows or self.batch_size * 512
+
         # We normalize the training data to have zero mean and unit standard
         # deviation in the training set if necessary
 
-        if normalize:
-            self.std_X_train = np.std(X_train, 0)
-            self.std_X_train[ self.std_X_train == 0 ] = 1
-            self.mean_X_train = np.mean(X_train, 0)
+        self.mean_X_train, self.std_X_train, self.mean_y_train, self.std_y_train = _statistics(X_train,
+            y_train, normalize, self.chunk_rows if self.out_of_core else None)
+
+        if self.out_of_core:
+            self.X_train = X_train
+            self.y_train = y_train
         else:
-            self.std_X_train = np.ones(X_train.shape[ 1 ])
-            self.mean_X_train = np.zeros(X_train.shape[ 1 ])
+            # keras trains in float32, so the normalized copy is float32
+            self.X_train = self._normalize(X_train)
+            y_train_normalized = (np.asarray(y_train, dtype = np.float32) - self.mean_y_train) / self.std_y_train
+            self.y_train_normalized = np.array(y_train_normalized, dtype = np.float32, ndmin = 2).T
+        
+        # We construct the network
+        reg = _regularisation(X_train.shape[0], dropout, tau)
 
-        X_train = (X_train - np.full(X_train.shape, self.mean_X_train)) / \
-            np.full(X_train.shape, self.std_X_train)
+        self._build(X_train.shape[1], n_hidden, dropout, reg)
+        self.tau = tau
+        self.dropout = dropout
+        self.n_epochs = 0
+        self.running_time = 0
 
-        self.mean_y_train = np.mean(y_train)
-        self.std_y_train = np.std(y_train)
+        # We iterate the learning process
+        self.train(n_epochs)
 
-        y_train_normalized = (y_train - self.mean_y_train) / self.std_y_train
-        y_train_normalized = np.array(y_train_normalized, ndmin = 2).T
-        
-        # We construct the network
-        N = X_train.shape[0]
-        batch_size = 128
-        lengthscale = 1e-2
-        reg = lengthscale**2 * (1 - dropout) / (2. * N * tau)
+        # We are done!
 
-        inputs = Input(shape=(X_train.shape[1],))
-        inter = Dropout(dropout)(inputs, training=True)
-        inter = Dense(n_hidden[0], activation='relu', W_regularizer=l2(reg))(inter)
-        for i in range(len(n_hidden) - 1):
-            inter = Dropout(dropout)(inter, training=True)
-            inter = Dense(n_hidden[i+1], activation='relu', W_regularizer=l2(reg))(inter)
-        inter = Dropout(dropout)(inter, training=True)
-        outputs = Dense(y_train_normalized.shape[1], W_regularizer=l2(reg))(inter)
-        model = Model(inputs, outputs)
+    def _build(self, n_features, n_hidden, dropout, reg):
+
+        """
+            Function constructing and compiling the keras model.
+        """
+
+        inputs = Input(shape=(n_features,))
+        model = Model(inputs, _branch(inputs, n_hidden, dropout, reg))
 
         model.compile(loss='mean_squared_error', optimizer='adam')
 
-        # We iterate the learning process
-        start_time = time.time()
-        model.fit(X_train, y_train_normalized, batch_size=batch_size, nb_epoch=n_epochs, verbose=0)
         self.model = model
-        self.tau = tau
-        self.running_time = time.time() - start_time
+        self.n_hidden = n_hidden
+        self.reg = reg
 
-        # We are done!
+    def save(self, path):
+
+        """
+            Function storing the weights and the normalization statistics of
+            the network as uncompressed numpy archives.
+
+            @param path     Directory in which the network is stored.
+        """
 
-    def predict(self, X_test, y_test):
+        np.savez(path + '/weights.npz', *self.model.get_weights())
+        np.savez(path + '/net.npz', mean_X_train = self.mean_X_train, std_X_train = self.std_X_train,
+            mean_y_train = self.mean_y_train, std_y_train = self.std_y_train, tau = self.tau,
+            dropout = self.dropout, reg = self.reg, n_hidden = self.n_hidden, n_epochs = self.n_epochs,
+            running_time = self.running_time)
+
+    def train(self, n_epochs):
+
+        """
+            Function to continue training the network for a number of epochs,
+            e.g. to grow the budget of a candidate during hyperparameter search.
+
+            @param n_epochs     Number of additional epochs.
+        """
+
+        start_time = time.time()
+        if self.out_of_core:
+            N = self.X_train.shape[0]
+            steps = sum(int(math.ceil(min(self.chunk_rows, N - start) / float(self.batch_size)))
+                for start in range(0, N, self.chunk_rows))
+            self.model.fit_generator(self._batches(), steps_per_epoch=steps, epochs=n_epochs, verbose=0)
+        else:
+            self.model.fit(self.X_train, self.y_train_normalized, batch_size=self.batch_size,
+                nb_epoch=n_epochs, verbose=0)
+        self.n_epochs += n_epochs
+        self.running_time += time.time() - start_time
+
+    def _normalize(self, X):
+        return _normalize(X, self.mean_X_train, self.std_X_train)
+
+    def _batches(self):
+
+        """
+            Endless generator of normalized float32 training batches. Every
+            epoch visits the chunks of rows in random order and shuffles the
+            rows within each chunk, so only one chunk is in memory at a time.
+        """
+
+        N = self.X_train.shape[0]
+        while True:
+            for start in np.random.permutation(np.arange(0, N, self.chunk_rows)):
+                X = self._normalize(self.X_train[start : start + self.chunk_rows])
+                y = (np.asarray(self.y_train[start : start + self.chunk_rows], dtype = np.float32) -
+                    self.mean_y_train) / self.std_y_train
+                order = np.random.permutation(X.shape[0])
+                for i in range(0, X.shape[0], self.batch_size):
+                    index = order[i : i + self.batch_size]
+                    yield X[index], y[index, None]
+
+    def predict(self, X_test, y_test, T = 10000, max_rows = 262144, tol = None, T_min = 100):
 
         """
             Function for making predictions with the Bayesian neural network.
 
             @param X_test   The matrix of features for the test data
-            
+            @param T        Number of Monte Carlo dropout samples, the
+                            maximum number when tol is set
+            @param max_rows Maximum number of rows per forward call. The test
+                            set is replicated so that several MC samples
+                            are drawn in each call, and test sets larger
+                            than max_rows are processed in chunks, so that
+                            memory does not depend on the test set size
+                            (besides the per point statistics).
+            @param tol      If set, samples are drawn in blocks of growing
+                            size until the Monte Carlo standard errors of
+                            the MC RMSE and of the test log-likelihood are
+                            both below tol, or T samples were drawn. The
+                            number of samples used is stored in mc_samples
+                            and the standard errors in mc_se.
+            @param T_min    Number of samples drawn before the standard
+                            errors are checked.
     
             @return m       The predictive mean for the test target variables.
             @return v       The predictive variance for the test target
@@ -107,33 +416,104 @@ class net:
 
         """
 
-        X_test = np.array(X_test, ndmin = 2)
-        y_test = np.array(y_test, ndmin = 2).T
+        results, self.mc_samples, mc_se = _mc_predict(self.model, X_test, y_test, self.mean_X_train,
+            self.std_X_train, self.mean_y_train, self.std_y_train, [self.tau], T, max_rows, tol, T_min)
+        self.mc_se = mc_se[0]
 
-        # We normalize the test set
+        # We are done!
+        return results[0]
 
-        X_test = (X_test - np.full(X_test.shape, self.mean_X_train)) / \
-            np.full(X_test.shape, self.std_X_train)
 
-        # We compute the predictive mean and variance for the target variables
-        # of the test data
+class grid_net:
 
-        model = self.model
-        standard_pred = model.predict(X_test, batch_size=500, verbose=1)
-        standard_pred = standard_pred * self.std_y_train + self.mean_y_train
-        rmse_standard_pred = np.mean((y_test.squeeze() - standard_pred.squeeze())**2.)**0.5
+    def __init__(self, X_train, y_train, n_hidden, cells, n_epochs = 40,
+        normalize = False):
 
-        T = 10000
-        
-        Yt_hat = np.array([model.predict(X_test, batch_size=500, verbose=0) for _ in range(T)])
-        Yt_hat = Yt_hat * self.std_y_train + self.mean_y_train
-        MC_pred = np.mean(Yt_hat, 0)
-        rmse = np.mean((y_test.squeeze() - MC_pred.squeeze())**2.)**0.5
+        """
+            Constructor for the class training all the (dropout_rate, tau)
+            candidates of a grid as one model. Every candidate is an
+            independent branch (the blocks of a block-diagonal network) with
+            its own dropout rate and L2 regularisation, and the loss is the
+            sum of the per candidate losses, so the gradients of each branch
+            are those of a separately trained net.net. All branches see the
+            same minibatches.
 
-        # We compute the test log-likelihood
-        ll = (logsumexp(-0.5 * self.tau * (y_test[None] - Yt_hat)**2., 0) - np.log(T) 
-            - 0.5*np.log(2*np.pi) + 0.5*np.log(self.tau))
-        test_ll = np.mean(ll)
+            @param X_train      Matrix with the features for the training data.
+            @param y_train      Vector with the target variables for the
+                                training data.
+            @param n_hidden     Vector with the number of neurons for each
+                                hidden layer.
+            @param cells        List of (dropout_rate, tau) candidates.
+            @param n_epochs     Numer of epochs for which to train the
+                                network.
+            @param normalize    Whether to normalize the input features.
+        """
 
-        # We are done!
-        return rmse_standard_pred, rmse, test_ll
+        self.mean_X_train, self.std_X_train, self.mean_y_train, self.std_y_train = _statistics(X_train,
+            y_train, normalize)
+
+        X_train = _normalize(X_train, self.mean_X_train, self.std_X_train)
+        y_train_normalized = (np.asarray(y_train, dtype = np.float32) - self.mean_y_train) / self.std_y_train
+        y_train_normalized = np.tile(np.array(y_train_normalized, dtype = np.float32, ndmin = 2).T, (1, len(cells)))
+
+        # We construct one branch per candidate, with the regularisation of
+        # net.net for its dropout rate and tau
+        N = X_train.shape[0]
+        batch_size = 128
+
+        inputs = Input(shape=(X_train.shape[1],))
+        outputs = [_branch(inputs, n_hidden, dropout, _regularisation(N, dropout, tau)) for dropout, tau in cells]
+        model = Model(inputs, concatenate(outputs) if len(outputs) > 1 else outputs[0])
+
+        model.compile(loss=lambda y_true, y_pred: K.sum(K.square(y_pred - y_true), axis=-1),
+            optimizer='adam')
+
+        start_time = time.time()
+        model.fit(X_train, y_train_normalized, batch_size=batch_size, nb_epoch=n_epochs, verbose=0)
+        self.running_time = time.time() - start_time
+        self.model = model
+        self.cells = cells
+        self.n_epochs = n_epochs
+
+    def predict(self, X_test, y_test, T = 10000, max_rows = 262144, tol = None, T_min = 100):
+
+        """
+            Function for making predictions with all the candidates, with the
+            arguments of net.predict (test sets larger than max_rows are
+            processed in chunks). With tol set, sampling stops when the
+            standard errors of every candidate are below tol.
+
+            @return results     List with the (rmse_standard_pred, rmse,
+                                test_ll) of every candidate, in the order of
+                                cells.
+        """
+
+        results, self.mc_samples, self.mc_se = _mc_predict(self.model, X_test, y_test, self.mean_X_train,
+            self.std_X_train, self.mean_y_train, self.std_y_train, [tau for _, tau in self.cells], T, max_rows,
+            tol, T_min)
+        return results
+
+
+def load(path):
+
+    """
+        Function loading a network stored with net.save, without training.
+
+        @param path     Directory in which the network is stored.
+
+        @return network The network, ready for predictions.
+    """
+
+    params = np.load(path + '/net.npz')
+    weights = np.load(path + '/weights.npz')
+    network = net.__new__(net)
+    for k in ['mean_X_train', 'std_X_train', 'mean_y_train', 'std_y_train']:
+        setattr(network, k, params[k])
+    network.tau = float(params['tau'])
+    network.dropout = float(params['dropout'])
+    network.n_epochs = int(params['n_epochs'])
+    network.running_time = float(params['running_time'])
+    network._build(network.mean_X_train.shape[0], params['n_hidden'].tolist(), network.dropout,
+        float(params['reg']))
+    network.model.set_weights([weights['arr_%d' % i] for i in range(len(weights.files))])
+    return network
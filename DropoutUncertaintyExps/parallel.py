@@ -0,0 +1,135 @@
+# This file contains a process-parallel version of the grid search in experiment.py:
+# 1. Every (split, dropout_rate, tau) cell is a job on a process pool. Each job gets a
+#    deterministic seed derived from the cell (see cache.py), so results do not depend
+#    on scheduling.
+# 2. Validation log-likelihoods are collected in the main process.
+# 3. As soon as all cells of a split are finished, the final network for that split is
+#    retrained on the full training set with the best hyperparameters. Final jobs are
+#    scheduled ahead of the remaining grid cells.
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import cache
+
+_WORKER = {}
+
+
+def _init_worker(X, y, splits, threads, store, tol):
+    """
+       Initializer of the worker processes. Holds the dataset and the cache of trained
+       networks, and pins the number of threads used by the keras backend.
+    """
+    _WORKER.update(X=X, y=y, splits=splits, store=store, tol=tol)
+    # Every job runs on its own graph and session, see cache.set_seed
+    cache.set_threads(threads)
+
+
+def split_data(X, y, index_train, index_test, final):
+    """
+       Training and evaluation sets of a split: the first 80% of the training set
+       and the remaining 20% for validation cells, or the whole training set and the
+       test set for the final network.
+    """
+    X_train, y_train = X[index_train], y[index_train]
+    if final:
+        return X_train, y_train, X[index_test], y[index_test]
+    num_training_examples = int(0.8 * X_train.shape[0])
+    return (X_train[0:num_training_examples, :], y_train[0:num_training_examples],
+        X_train[num_training_examples:, :], y_train[num_training_examples:])
+
+
+def _run_job(job):
+    split, dropout_rate, tau, final, n_hidden, n_epochs = job
+    index_train, index_test = _WORKER['splits'][split]
+    X_train, y_train, X_eval, y_eval = split_data(_WORKER['X'], _WORKER['y'], index_train, index_test, final)
+    # Sequential MC estimates are only used for the validation cells
+    return job, cache.run_cell(_WORKER['store'], split, (index_train, index_test), final, X_train, y_train,
+        X_eval, y_eval, n_hidden, n_epochs, tau, dropout_rate, None if final else _WORKER['tol'])
+
+
+def run(X, y, splits, dropout_rates, tau_values, n_hidden, n_epochs, write_validation, write_test,
+        jobs = None, threads = 1, store = None, lookup = None, tol = None):
+    """
+       Run the grid search and the final retraining of every split on a process pool.
+       @param X, y              Features and targets of the whole dataset
+       @param splits            List of (index_train, index_test) pairs
+       @param write_validation  Callback(split, dropout_rate, tau, error, MC_error, ll,
+                                running_time, epochs) storing the validation results of a cell
+       @param write_test        Callback(split, error, MC_error, ll, tau, dropout_rate,
+                                running_time, epochs) storing the test results of a split
+       @param jobs              Number of worker processes (defaults to the number of cores)
+       @param threads           Number of threads per worker
+       @param store             cache.cache of trained networks, or None
+       @param lookup            Callback(split, dropout_rate, tau, final) returning the
+                                already computed (error, MC_error, ll, running_time) of a
+                                cell, or None. Such cells are not submitted.
+       @param tol               Tolerance of the sequential MC estimates of the validation
+                                cells (see net.predict), or None
+       @return errors, MC_errors, lls  Test results of every split, in split order
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    grid = [(split, dropout_rate, tau, False, n_hidden, n_epochs) for split in range(len(splits))
+        for dropout_rate in dropout_rates for tau in tau_values]
+    grid.reverse()
+    finals, pending, validation, test, best = [], set(), {}, {}, {}
+    # Cells completed from lookup are already recorded and are not written again
+    loaded = set()
+    remaining = dict((split, len(dropout_rates) * len(tau_values)) for split in range(len(splits)))
+    next_split = 0
+    errors, MC_errors, lls = [], [], []
+
+    def _done(job, result):
+        split, dropout_rate, tau, final = job[:4]
+        if final:
+            test[split] = result
+            print ('Tests on split ' + str(split) + ' complete.')
+            return
+        validation[(split, dropout_rate, tau)] = result
+        remaining[split] -= 1
+        if remaining[split] > 0:
+            return
+        # The grid of this split is finished: store validation results in grid
+        # order and select the best hyperparameters as in the serial search
+        best_ll, best_tau, best_dropout = -float('inf'), 0, 0
+        for d in dropout_rates:
+            for t in tau_values:
+                error, MC_error, ll, running_time = validation.pop((split, d, t))
+                if (split, d, t, False) not in loaded:
+                    write_validation(split, d, t, error, MC_error, ll, running_time, n_epochs)
+                if ll > best_ll:
+                    best_ll, best_tau, best_dropout = ll, t, d
+        print ('Split ' + str(split) + ': best tau ' + str(best_tau) + ' best dropout rate ' +
+            str(best_dropout) + ' log_likelihood ' + str(best_ll))
+        best[split] = (best_dropout, best_tau)
+        finals.append((split, best_dropout, best_tau, True, n_hidden, n_epochs))
+
+    ctx = multiprocessing.get_context('fork')
+    with ProcessPoolExecutor(max_workers = jobs, mp_context = ctx, initializer = _init_worker,
+            initargs = (X, y, splits, threads, store, tol)) as pool:
+        while grid or finals or pending:
+            # Keep the pool busy, final retrains first. Cells already computed by a
+            # previous run are completed without being submitted
+            while (grid or finals) and len(pending) < jobs:
+                job = finals.pop(0) if finals else grid.pop()
+                result = lookup(*job[:4]) if lookup is not None else None
+                if result is not None:
+                    loaded.add(tuple(job[:4]))
+                    _done(job, result)
+                else:
+                    pending.add(pool.submit(_run_job, job))
+            if pending:
+                done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                for future in done:
+                    _done(*future.result())
+            # Store test results in split order
+            while next_split in test:
+                error, MC_error, ll, running_time = test.pop(next_split)
+                best_dropout, best_tau = best[next_split]
+                if (next_split, best_dropout, best_tau, True) not in loaded:
+                    write_test(next_split, error, MC_error, ll, best_tau, best_dropout, running_time, n_epochs)
+                errors += [error]
+                MC_errors += [MC_error]
+                lls += [ll]
+                next_split += 1
+    return errors, MC_errors, lls
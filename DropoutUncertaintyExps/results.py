@@ -0,0 +1,124 @@
+# This file contains a structured store of the results of experiment.py, in SQLite.
+# Every (dataset, split, dropout_rate, tau, phase) record of a run configuration (epochs
+# multiplier, number of hidden layers) is committed as soon as it is computed, with its wall
+# time, number of epochs and metrics. An interrupted run resumes from the committed records,
+# and summaries across datasets are SQL queries.
+#
+# To print a summary of the test results of every dataset in a store:
+#   python results.py <database>
+
+import sys
+import time
+import sqlite3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    dataset TEXT NOT NULL,
+    epochx INTEGER NOT NULL,
+    hidden INTEGER NOT NULL,
+    split INTEGER NOT NULL,
+    phase TEXT NOT NULL,
+    dropout REAL NOT NULL,
+    tau REAL NOT NULL,
+    epochs INTEGER,
+    wall_time REAL,
+    rmse REAL,
+    mc_rmse REAL,
+    ll REAL,
+    created REAL,
+    PRIMARY KEY (dataset, epochx, hidden, split, phase, dropout, tau)
+)
+"""
+
+_SUMMARY = """
+SELECT dataset, epochx, hidden, COUNT(*),
+    AVG(rmse), AVG(rmse * rmse) - AVG(rmse) * AVG(rmse),
+    AVG(mc_rmse), AVG(mc_rmse * mc_rmse) - AVG(mc_rmse) * AVG(mc_rmse),
+    AVG(ll), AVG(ll * ll) - AVG(ll) * AVG(ll),
+    SUM(wall_time)
+FROM records WHERE phase = 'test' GROUP BY dataset, epochx, hidden ORDER BY dataset, epochx, hidden
+"""
+
+
+class results:
+
+    def __init__(self, path, dataset, epochx, hidden):
+
+        """
+            Store of the results of one run configuration.
+
+            @param path     Path of the SQLite database.
+            @param dataset  Name of the UCI dataset directory.
+            @param epochx   Multiplier for the number of epochs.
+            @param hidden   Number of hidden layers.
+        """
+
+        self.path = path
+        self.run = (dataset, int(epochx), int(hidden))
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(_SCHEMA)
+        self.conn.commit()
+
+    def add(self, split, phase, dropout_rate, tau, error, MC_error, ll, running_time = None, epochs = None):
+        self.conn.execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            self.run + (int(split), phase, float(dropout_rate), float(tau), epochs, running_time,
+            float(error), float(MC_error), float(ll), time.time()))
+        self.conn.commit()
+
+    def get(self, split, phase, dropout_rate = None, tau = None):
+
+        """
+            @return metrics     (error, MC_error, ll, wall_time) of a committed record,
+                                or None. Without dropout_rate and tau, the record of
+                                the split and phase is returned whatever its
+                                hyperparameters are (used for the test phase).
+        """
+
+        query = 'SELECT rmse, mc_rmse, ll, wall_time FROM records WHERE dataset = ? AND epochx = ? AND hidden = ? ' + \
+            'AND split = ? AND phase = ?'
+        args = self.run + (int(split), phase)
+        if dropout_rate is not None:
+            query += ' AND dropout = ? AND tau = ?'
+            args += (float(dropout_rate), float(tau))
+        return self.conn.execute(query, args).fetchone()
+
+    def records(self, phase):
+        return self.conn.execute('SELECT split, dropout, tau, rmse, mc_rmse, ll FROM records WHERE dataset = ? ' +
+            'AND epochx = ? AND hidden = ? AND phase = ? ORDER BY split, dropout, tau', self.run + (phase,)).fetchall()
+
+    def export(self, write_validation, write_test):
+
+        """
+            Write the committed records of the run with the text writers of
+            experiment.py, in split and grid order.
+        """
+
+        for split, dropout_rate, tau, error, MC_error, ll in self.records('validation'):
+            write_validation(split, dropout_rate, tau, error, MC_error, ll)
+        for split, dropout_rate, tau, error, MC_error, ll in self.records('test'):
+            write_test(split, error, MC_error, ll, tau)
+
+
+def summary(path):
+    """
+       Method to compute the mean and standard error of the test results of every
+       dataset and run configuration in a store.
+    """
+    conn = sqlite3.connect(path)
+    conn.execute(_SCHEMA)
+    rows = []
+    for r in conn.execute(_SUMMARY).fetchall():
+        dataset, epochx, hidden, n = r[:4]
+        se = [(max(v, 0.) / n)**0.5 for v in r[5:10:2]]
+        rows.append(dict(dataset = dataset, epochx = epochx, hidden = hidden, splits = n,
+            rmse = r[4], rmse_se = se[0], mc_rmse = r[6], mc_rmse_se = se[1], ll = r[8], ll_se = se[2],
+            wall_time = r[10]))
+    conn.close()
+    return rows
+
+
+if __name__ == '__main__':
+    print ('%-28s %6s %6s %6s %18s %18s %18s' % ('Dataset', 'epochx', 'hidden', 'splits', 'RMSE', 'MC RMSE', 'LL'))
+    for r in summary(sys.argv[1]):
+        print ('%-28s %6d %6d %6d %9.3f +- %5.3f %9.3f +- %5.3f %9.3f +- %5.3f' % (r['dataset'], r['epochx'],
+            r['hidden'], r['splits'], r['rmse'], r['rmse_se'], r['mc_rmse'], r['mc_rmse_se'], r['ll'], r['ll_se']))
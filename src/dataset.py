@@ -0,0 +1,244 @@
+"""dataset.py: Module is used to store processed chorus data in a date / spacecraft partitioned parquet dataset"""
+
+__author__ = "Chakraborty, S."
+__copyright__ = "Copyright 2021, Chakraborty"
+__credits__ = []
+__license__ = "MIT"
+__version__ = "1.0."
+__maintainer__ = "Chakraborty, S."
+__email__ = "shibaji7@vt.edu"
+__status__ = "Research"
+
+import os
+import json
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from utils import profiler, fsize
+
+# Columns with per-file min / max statistics in the manifest
+STATS = ["epoch", "L", "Lstar", "MLT", "MLAT"]
+# Rollup cadences (seconds), wave amplitude columns and their statistics
+CADENCES = {"1T": 60, "5T": 300, "1H": 3600}
+WAVES = ["B(pT)", "Bl(pT)", "Bu(pT)"]
+QUANTILES = {"median": 0.5, "p90": 0.9}
+# Position columns averaged in the rollups (MLT as a circular mean)
+POSITIONS = ["L", "Lstar", "MLAT", "R", "MLT"]
+
+
+def cadence_seconds(cadence):
+    """ Seconds of a cadence, a key of CADENCES or a pandas offset (e.g. 2T) """
+    return CADENCES[cadence] if cadence in CADENCES else int(pd.Timedelta(cadence.replace("T", "min")).total_seconds())
+
+def projection(columns):
+    """ Columns to read, epoch always first (None = all) """
+    return None if columns is None else ["epoch"] + [c for c in columns if c != "epoch"]
+
+def rollup(o, cadence="1T"):
+    """
+    Statistics of the rows of one spacecraft in bins of a cadence, columns in
+    the order of o: max, mean, median, p90 and count (of finite values) of B,
+    Bl and Bu, the max of every other numeric column (<column>_max), then the
+    mean position. The rows are sorted once on integer time, every bin is a
+    contiguous segment and the statistics are segment reductions (the
+    quantiles after sorting the values within segments).
+    """
+    stats = ["max", "mean"] + list(QUANTILES) + ["count"]
+    cols = [c for c in o.columns if c == "SAT" or c in WAVES or
+            (c != "epoch" and pd.api.types.is_numeric_dtype(o[c]))]
+    if len(o) == 0:
+        names = ["epoch"] + [n for c in cols for n in ([c] if c == "SAT" else [c + "_" + k for k in stats] if c in WAVES
+                                                       else [c + "_max"])] + [c for c in POSITIONS if c in o.columns]
+        return pd.DataFrame(dict((c, pd.Series(dtype={"epoch": "datetime64[ns]", "SAT": "object"}.get(c, "float64")))
+                                 for c in names))
+    t = o.epoch.values.astype("datetime64[s]").astype(np.int64)
+    order = np.argsort(t, kind="stable")
+    b = t[order] // cadence_seconds(cadence)
+    starts = np.flatnonzero(np.r_[True, b[1:] != b[:-1]])
+    n = np.diff(np.r_[starts, len(b)])
+    seg = np.repeat(np.arange(len(starts)), n)
+    x = pd.DataFrame({"epoch": (b[starts] * cadence_seconds(cadence)).astype("datetime64[s]").astype("datetime64[ns]")})
+    for c in cols:
+        if c == "SAT":
+            x["SAT"] = o.SAT.values[order][starts]
+            continue
+        v = o[c].values.astype(np.float64)[order]
+        ok = np.isfinite(v)
+        k = np.add.reduceat(ok.astype(np.int64), starts)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            x[c + "_max"] = np.where(k > 0, np.maximum.reduceat(np.where(ok, v, -np.inf), starts), np.nan)
+            if c not in WAVES: continue
+            x[c + "_mean"] = np.add.reduceat(np.where(ok, v, 0.), starts) / k
+        # NaN sorts last, the k finite values lead every segment
+        v = v[np.lexsort((v, seg))]
+        for name, q in QUANTILES.items():
+            pos = q * np.maximum(k - 1, 0)
+            lo = np.floor(pos).astype(np.int64)
+            hi = np.minimum(lo + 1, np.maximum(k - 1, 0))
+            y = v[starts + lo] + (pos - lo) * (v[starts + hi] - v[starts + lo])
+            x[c + "_" + name] = np.where(k > 0, y, np.nan)
+        x[c + "_count"] = k
+    for c in [c for c in POSITIONS if c in o.columns]:
+        v = o[c].values.astype(np.float64)[order]
+        if c == "MLT": v = np.exp(1j * v * np.pi / 12)
+        ok = np.isfinite(v)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            m = np.add.reduceat(np.where(ok, v, 0.), starts) / np.add.reduceat(ok.astype(np.int64), starts)
+        x[c] = np.mod(np.angle(m) * 12 / np.pi, 24) if c == "MLT" else m
+    return x
+
+
+class ChorusDataset(object):
+    """
+    Processed chorus data (one row per spectrum) stored as parquet files
+    partitioned by date and spacecraft (root/date=YYYYMMDD/sc=A/part-0.parquet).
+    Rows are sorted by epoch and written in small row groups, so the parquet
+    row group statistics resolve time, L and MLT ranges within a day. The
+    per-file min / max of STATS are also kept in root/_manifest.json, so
+    queries prune files before opening them. Rollups of every file at the
+    cadences are stored with the same partitions under root/rollup/<cadence>/.
+    """
+
+    def __init__(self, root="tmp/EMFISIS/chorus/", row_group_size=2048, cadences=["1T", "5T", "1H"], v=False):
+        self.root = root
+        self.row_group_size = row_group_size
+        self.cadences = cadences
+        self.verbose = v
+        self.partitioning = ds.partitioning(pa.schema([("date", pa.string()), ("sc", pa.string())]), flavor="hive")
+        self.manifest = {}
+        if os.path.exists(self.root + "_manifest.json"):
+            with open(self.root + "_manifest.json", "r") as f: self.manifest = json.load(f)
+        return
+
+    def fname(self, d, sc):
+        return "date=%s/sc=%s/part-0.parquet"%(d.strftime("%Y%m%d"), sc.upper())
+
+    def _put_(self, table, fname, row_group_size=None):
+        if not os.path.exists(os.path.dirname(fname)): os.makedirs(os.path.dirname(fname))
+        pq.write_table(table, fname + ".tmp", row_group_size=row_group_size, compression="zstd")
+        os.replace(fname + ".tmp", fname)
+        return
+
+    def _empty_(self, root, columns=None, default=None):
+        """
+        Frame with no rows, the columns requested (default all) and epoch, typed
+        from the schema of a stored file under root, else of default.
+        """
+        files = [root + f for f in sorted(self.manifest) if os.path.exists(root + f)]
+        o = pq.read_schema(files[0]).empty_table().to_pandas() if len(files) > 0 else default
+        if o is None: o = pd.DataFrame({"epoch": pd.Series(dtype="datetime64[ns]")})
+        names = list(o.columns) if columns is None else projection(columns)
+        return pd.DataFrame(dict((c, o[c] if c in o.columns else pd.Series(dtype="object" if c in ["date", "sc", "SAT"]
+                                                                               else "float64")) for c in names))
+
+    def has(self, d, sc=None):
+        """ Whether a date (of a spacecraft) is stored """
+        if sc is not None: return self.fname(d, sc) in self.manifest
+        return any(f.startswith("date=%s/"%d.strftime("%Y%m%d")) for f in self.manifest)
+
+    def write(self, o, d, sc):
+        """ Store (replace) the rows of a date and spacecraft """
+        o = o.sort_values("epoch").reset_index(drop=True)
+        fname = self.fname(d, sc)
+        key = d.strftime("%Y%m%d") + "/" + sc.upper()
+        with profiler.stage("parquet_write", key, records=len(o)) as s:
+            self._put_(pa.Table.from_pandas(o, preserve_index=False), self.root + fname, self.row_group_size)
+            s.bytes = fsize(self.root + fname)
+        for cadence in self.cadences:
+            with profiler.stage("rollup", key + "/" + cadence) as s:
+                x = rollup(o, cadence)
+                self._put_(pa.Table.from_pandas(x, preserve_index=False), self.root + "rollup/%s/"%cadence + fname)
+                s.records, s.bytes = len(x), fsize(self.root + "rollup/%s/"%cadence + fname)
+        stats = {}
+        for c in STATS:
+            if c not in o.columns or o[c].isnull().all(): continue
+            lo, hi = o[c].min(), o[c].max()
+            stats[c] = [str(lo), str(hi)] if c == "epoch" else [float(lo), float(hi)]
+        self.manifest[fname] = stats
+        with open(self.root + "_manifest.json.tmp", "w") as f: json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(self.root + "_manifest.json.tmp", self.root + "_manifest.json")
+        if self.verbose: print(" Stored - ", self.root + fname)
+        return self
+
+    def files(self, sc=None, dates=None, ranges={}):
+        """
+        Files whose partition and min / max statistics may hold rows matching
+        the predicates (see read).
+        """
+        out = []
+        for fname, stats in sorted(self.manifest.items()):
+            date, s = [p.split("=")[1] for p in fname.split("/")[:2]]
+            if sc is not None and s != sc.upper(): continue
+            if dates is not None:
+                if date < dates[0].strftime("%Y%m%d") or date > (dates[1] - dt.timedelta(microseconds=1)).strftime("%Y%m%d"):
+                    continue
+                if "epoch" in stats and (pd.Timestamp(stats["epoch"][1]) < dates[0] or pd.Timestamp(stats["epoch"][0]) >= dates[1]):
+                    continue
+            keep = True
+            for c, (lo, hi) in ranges.items():
+                if c not in stats: continue
+                fmin, fmax = stats[c]
+                # lo > hi is a range wrapping through 0 (e.g. MLT 22 - 2)
+                keep &= (fmax >= lo or fmin < hi) if lo > hi else (fmax >= lo and fmin < hi)
+            if keep: out.append(self.root + fname)
+        return out
+
+    def read(self, sc=None, dates=None, mlt=None, mlat=None, L=None, Lstar=None, columns=None):
+        """
+        Rows matching all the given predicates, pushed down to the dataset scan:
+        sc = Spacecraft ("A" / "B")
+        dates = [start, end) of epoch
+        mlt, mlat, L, Lstar = [min, max) ranges, an MLT range with min > max wraps through 0
+        columns = Columns to read (default all), epoch is always read
+        Non-matching partitions and files are never opened and non-matching
+        row groups are skipped from their statistics.
+        """
+        ranges = dict((c, r) for c, r in zip(["MLT", "MLAT", "L", "Lstar"], [mlt, mlat, L, Lstar]) if r is not None)
+        columns = projection(columns)
+        dates = None if dates is None else [pd.Timestamp(dates[0]), pd.Timestamp(dates[1])]
+        files = self.files(sc, dates, ranges)
+        if len(files) == 0: return self._empty_(self.root, columns)
+        expr = None
+        def _and(e, x): return x if e is None else e & x
+        if sc is not None: expr = _and(expr, ds.field("sc") == sc.upper())
+        if dates is not None:
+            expr = _and(expr, (ds.field("epoch") >= pa.scalar(dates[0].to_pydatetime(), pa.timestamp("ns"))) &
+                        (ds.field("epoch") < pa.scalar(dates[1].to_pydatetime(), pa.timestamp("ns"))))
+        for c, (lo, hi) in ranges.items():
+            if lo > hi: expr = _and(expr, (ds.field(c) >= lo) | (ds.field(c) < hi))
+            else: expr = _and(expr, (ds.field(c) >= lo) & (ds.field(c) < hi))
+        with profiler.stage("parquet_read", sc.upper() if sc is not None else "", sum(fsize(f) for f in files)) as s:
+            table = ds.dataset(files, format="parquet", partitioning=self.partitioning,
+                               partition_base_dir=self.root).to_table(columns=columns, filter=expr)
+            s.records = table.num_rows
+        o = table.to_pandas()
+        o = o.drop(columns=[c for c in ["date", "sc"] if c in o.columns and (columns is None or c not in columns)])
+        if self.verbose: print(" Read %d rows from %d files"%(len(o), len(files)))
+        return o
+
+    def read_rollup(self, cadence="1T", sc=None, dates=None, columns=None):
+        """
+        Rollup rows of a cadence of a spacecraft within dates = [start, end),
+        columns are named <wave>_<max|mean|median|p90|count> and the positions,
+        epoch is always read.
+        """
+        columns = projection(columns)
+        dates = None if dates is None else [pd.Timestamp(dates[0]), pd.Timestamp(dates[1])]
+        files = [f.replace(self.root, self.root + "rollup/%s/"%cadence, 1) for f in self.files(sc, dates)]
+        files = [f for f in files if os.path.exists(f)]
+        if len(files) == 0:
+            return self._empty_(self.root + "rollup/%s/"%cadence, columns,
+                                rollup(pd.DataFrame(columns=["epoch", "SAT"] + WAVES + POSITIONS)
+                                       .astype(dict((c, "float64") for c in WAVES + POSITIONS))))
+        expr = None
+        if dates is not None:
+            expr = (ds.field("epoch") >= pa.scalar(dates[0].to_pydatetime(), pa.timestamp("ns"))) &\
+                    (ds.field("epoch") < pa.scalar(dates[1].to_pydatetime(), pa.timestamp("ns")))
+        with profiler.stage("rollup_read", cadence, sum(fsize(f) for f in files)) as s:
+            table = ds.dataset(files, format="parquet").to_table(columns=columns, filter=expr)
+            s.records = table.num_rows
+        return table.to_pandas()
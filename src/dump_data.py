@@ -18,6 +18,7 @@ import pandas as pd
 import glob
 import datetime as dt
 from random import randint
+from utils import profiler, fsize
 np.random.seed(0)
 
 
@@ -39,8 +40,10 @@ def download_omni_dataset(dates, tmpdir="tmp/EMFISIS/"):
             fpath = base_storage%(date.year,date.month)
             if fpath not in fpaths:
                 url = base_uri%(date.year,date.month)
-                response = requests.get(url)
-                with open(fpath,"w") as f: f.write(response.text)
+                with profiler.stage("omni_download", "%d%02d"%(date.year,date.month)) as s:
+                    response = requests.get(url)
+                    with open(fpath,"w") as f: f.write(response.text)
+                    s.bytes = fsize(fpath)
                 fpaths.append(fpath)
         base_storage = tmpdir + "omni/"
         if not os.path.exists(base_storage): os.system("mkdir -p " + base_storage)
@@ -48,6 +51,8 @@ def download_omni_dataset(dates, tmpdir="tmp/EMFISIS/"):
         for fname in fpaths:
             csv_fname = csv_base%(fname.split("/")[-1].replace(".asc",""))
             print(fname, "-to-", csv_fname)
+            key = fname.split("/")[-1].replace(".asc","")
+            s = profiler.start("omni_parse", key, fsize(fname))
             with open(fname, "r") as f: lines = f.readlines()
             linevalues = []
             for i, line in enumerate(lines):
@@ -64,7 +69,11 @@ def download_omni_dataset(dates, tmpdir="tmp/EMFISIS/"):
                                    float(values[40]),float(values[41]),float(values[42]),float(values[43]),
                                    float(values[44]),float(values[45])])
             _o = pd.DataFrame(linevalues, columns=header)
-            _o.to_csv(csv_fname, header=True, index=False)
+            s.records = len(_o)
+            profiler.stop(s)
+            with profiler.stage("omni_csv_write", key, records=len(_o)) as s:
+                _o.to_csv(csv_fname, header=True, index=False)
+                s.bytes = fsize(csv_fname)
             os.system("rm "+fname)
     return
 
@@ -75,7 +84,11 @@ def get_omni_dataset(dates, tmpdir="tmp/EMFISIS/"):
         fpath = base_storage%(date.year,date.month)
         if fpath not in files: files.append(fpath)
     for file in files:
-        if os.path.exists(file): o = pd.concat([o, pd.read_csv(file, parse_dates=["DATE"])])
+        if os.path.exists(file): 
+            with profiler.stage("omni_read", file.split("/")[-1].replace(".csv",""), fsize(file)) as s:
+                x = pd.read_csv(file, parse_dates=["DATE"])
+                s.records = len(x)
+            o = pd.concat([o, x])
     return o
 
 def fetch_Kp_data(dates, tmpdir="tmp/EMFISIS/"):
@@ -0,0 +1,100 @@
+"""features.py: Module is used to build and cache model-ready feature arrays"""
+
+__author__ = "Chakraborty, S."
+__copyright__ = "Copyright 2021, Chakraborty"
+__credits__ = []
+__license__ = "MIT"
+__version__ = "1.0."
+__maintainer__ = "Chakraborty, S."
+__email__ = "shibaji7@vt.edu"
+__status__ = "Research"
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+def derive_columns(frame, keys):
+    """
+    Compute derived columns for the requested keys, vectorized over the frame.
+        mod = minute of the day, sod = second of the day,
+        log.<col> = log10(<col>)
+    """
+    t = frame.epoch.values.astype("datetime64[s]").astype(np.int64)
+    sod = t % 86400
+    for k in keys:
+        if k in frame.columns: continue
+        if k == "sod": frame[k] = sod
+        elif k == "mod": frame[k] = sod // 60
+        elif k.startswith("log."):
+            with np.errstate(divide="ignore", invalid="ignore"): frame[k] = np.log10(frame[k[4:]])
+    return frame
+
+def raw_columns(keys):
+    """ Columns that have to be read from the CSV files to build keys """
+    cols = ["epoch"]
+    for k in keys:
+        if k in ["mod", "sod"]: continue
+        k = k[4:] if k.startswith("log.") else k
+        if k not in cols: cols.append(k)
+    return cols
+
+class FeatureStore(object):
+    """
+    Build (X, y) float32 arrays from the parsed CSV files and cache them on
+    disk, keyed by date range, feature set and source files. Cached arrays are
+    returned memory-mapped.
+    """
+
+    def __init__(self, dates, fnames, input_keys=["L", "Lstar", "AE", "MLAT", "MLT", "mod"],
+                 output_keys=["log.B(pT)"], cacheDir="tmp/features/", v=False):
+        self.dates = dates
+        self.fnames = fnames
+        self.input_keys = input_keys
+        self.output_keys = output_keys
+        self.cacheDir = cacheDir
+        self.verbose = v
+        self.key = self.get_key()
+        self.floc = self.cacheDir + "%s_%s_%s/"%(dates[0].strftime("%Y%m%d"), dates[-1].strftime("%Y%m%d"), self.key)
+        return
+
+    def get_key(self):
+        """ Hash of date range, features and source file stats """
+        o = {"dates": [d.strftime("%Y%m%d") for d in self.dates[:1] + self.dates[-1:]],
+             "inputs": self.input_keys, "outputs": self.output_keys, "files": []}
+        for f in self.fnames:
+            if os.path.exists(f): o["files"].append([os.path.basename(f), os.path.getsize(f), int(os.path.getmtime(f))])
+        return hashlib.sha1(json.dumps(o, sort_keys=True).encode()).hexdigest()[:12]
+
+    def exists(self):
+        return os.path.exists(self.floc + "meta.json")
+
+    def build(self):
+        """ Parse CSVs, derive features, drop invalid rows and store arrays """
+        keys = self.input_keys + self.output_keys
+        frame = pd.concat([pd.read_csv(f, parse_dates=["epoch"], usecols=raw_columns(keys))
+                           for f in self.fnames if os.path.exists(f)])
+        frame = derive_columns(frame, keys)
+        m = frame[keys].values.astype(np.float32)
+        mask = np.isfinite(m).all(axis=1)
+        if not os.path.exists(self.floc): os.makedirs(self.floc)
+        n = len(self.input_keys)
+        np.save(self.floc + "X.npy", np.ascontiguousarray(m[mask, :n]))
+        np.save(self.floc + "y.npy", np.ascontiguousarray(m[mask, n:]))
+        np.save(self.floc + "epoch.npy", frame.epoch.values[mask].astype("datetime64[ns]").astype(np.int64))
+        meta = {"inputs": self.input_keys, "outputs": self.output_keys, "fnames": self.fnames,
+                "rows": int(mask.sum()), "dropped": int((~mask).sum())}
+        with open(self.floc + "meta.json", "w") as f: json.dump(meta, f, indent=2)
+        if self.verbose: print(" Features cached to - ", self.floc, "(%d rows, %d dropped)"%(meta["rows"], meta["dropped"]))
+        return self
+
+    def load(self, with_epoch=False):
+        """ Return memory-mapped X, y (and epoch in ns) arrays, building them if required """
+        if not self.exists(): self.build()
+        elif self.verbose: print(" Loading features from - ", self.floc)
+        X = np.load(self.floc + "X.npy", mmap_mode="r")
+        y = np.load(self.floc + "y.npy", mmap_mode="r")
+        if with_epoch: return X, y, np.load(self.floc + "epoch.npy", mmap_mode="r")
+        return X, y
@@ -26,11 +26,16 @@ import pandas as pd
 from cdflib.epochs import CDFepoch
 from bs4 import BeautifulSoup
 import pickle
+import queue
+import threading
 
 from paramiko import SSHClient
 from scp import SCPClient
 
 import dump_data as dmap
+from utils import profiler, fsize
+from dataset import ChorusDataset, rollup, cadence_seconds, projection, WAVES
+import spectra
 
 
 class Connection(object):
@@ -94,15 +99,21 @@ class CDFLoader(object):
     def get_local_fname(self, d, url):
         """ Create local file name """
         fnames = []
-        response = requests.get(url, stream=True)
-        if response.status_code == 200:
-            response.raw.decode_content = True
-            soup = BeautifulSoup(response.raw, "lxml")
-            tags = [t.text for t in soup.find_all(["a"])]
-            for t in tags:
-                if self.file_kind in t: fnames.append(t)
+        with profiler.stage("listing", self._key_(d)) as s:
+            response = requests.get(url, stream=True)
+            if response.status_code == 200:
+                response.raw.decode_content = True
+                soup = BeautifulSoup(response.raw, "lxml")
+                tags = [t.text for t in soup.find_all(["a"])]
+                for t in tags:
+                    if self.file_kind in t: fnames.append(t)
+            s.records = len(fnames)
         return fnames
     
+    def _key_(self, d):
+        """ Instrumentation key of a (date, spacecraft) """
+        return d.strftime("%Y%m%d") + "/" + self.params["sc"].upper()
+    
     def get_local_floc(self, d):
         """ Create local file location """
         floc = self.localDir + d.strftime("%Y%m%d") + "/"
@@ -125,22 +136,28 @@ class CDFLoader(object):
         for loc, fname, url in zip(self.files["locations"], self.files["fnames"], self.files["urls"]):
             if not os.path.exists(loc): os.makedirs(loc)
             floc = loc + fname
+            key = loc.split("/")[-2] + "/" + self.params["sc"].upper()
             if not os.path.exists(floc):
                 if self.verbose: print(" URL -", url)
-                response = requests.get(url, stream=True)
+                with profiler.stage("download", key) as s:
+                    response = requests.get(url, stream=True)
+                    if response.status_code == 200:
+                        with open(floc, "wb") as f: shutil.copyfileobj(response.raw, f)
+                    s.bytes = fsize(floc)
                 if response.status_code == 200:
-                    with open(floc, "wb") as f:
-                        shutil.copyfileobj(response.raw, f)
+                    with profiler.stage("cdf_open", key, fsize(floc)):
                         self.files["file_objects"].append(cdflib.CDF(floc))
             else: 
                 if self.verbose: print(" Loading from - ", floc)
-                self.files["file_objects"].append(cdflib.CDF(floc))
+                with profiler.stage("cdf_open", key, fsize(floc)):
+                    self.files["file_objects"].append(cdflib.CDF(floc))
         return self
     
     def get_dataset_raw(self, keys, WFR_file_id=0):
         """ Convert the raw data to dict format """
         self.epoch = None
         o = {"Epoch": []}
+        s = profiler.start("cdf_parse", self._key_(self.dates[0]) if len(self.dates) == 1 else self.params["sc"].upper())
         for f in self.files["file_objects"]:
             dates = [dt.datetime(i[0], i[1], i[2], i[3], i[4], i[5]) for i in CDFepoch.breakdown(f.varget("Epoch"))]
             o["Epoch"].extend(dates)
@@ -150,6 +167,9 @@ class CDFLoader(object):
                 else: o[key] = np.concatenate(o[key], f.varget(key)[:])
         if WFR_file_id is not None: o["WFR"] = self.get_WFR_info(WFR_file_id)
         self.epoch = o["Epoch"]
+        s.records = len(o["Epoch"])
+        s.bytes = sum([o[k].nbytes for k in keys if hasattr(o[k], "nbytes")])
+        profiler.stop(s)
         return o
     
     def clean(self):
@@ -186,6 +206,41 @@ class WaveformInfo(CDFLoader):
     def get_dataset(self, keys=["BuSamples"]):
         return self.get_dataset_raw(keys, WFR_file_id=None)
     
+    def spectrogram(self, WFR, keys=["BuSamples", "BvSamples", "BwSamples"], fs=35000., nperseg=1024,
+                    chunk_records=16, workers=-1, encoding="f4"):
+        """
+        Stream the waveform records into Welch spectra on the WFR grid.
+        
+        Parameters:
+        -----------
+        WFR = WFR bins, frequencies and bandwidths (SpectralInfo.get_WFR_info)
+        keys = Waveform components, stored as BuBu, BvBv and BwBw
+        fs = Sampling frequency (Hz)
+        chunk_records = Records read and transformed at once, bounds memory
+        workers = scipy.fft threads
+        Returns the HDF5 file (localDir/YYYYMMDD_SC_burst.h5, see spectra.load)
+        """
+        fname = self.localDir + "%s_%s_burst.h5"%(self.dates[0].strftime("%Y%m%d"), self.params["sc"].upper())
+        out = spectra.SpectralWriter(fname, WFR, self.params, encoding)
+        W = None
+        for f in self.files["file_objects"]:
+            n = f.varinq("Epoch")["Last_Rec"] + 1
+            s = profiler.start("welch", self._key_(self.dates[0]))
+            for i in range(0, n, chunk_records):
+                j = min(i + chunk_records, n) - 1
+                epoch = [dt.datetime(*e[:6]) for e in CDFepoch.breakdown(f.varget("Epoch", startrec=i, endrec=j))]
+                psd = {}
+                for key in keys:
+                    x = np.atleast_2d(f.varget(key, startrec=i, endrec=j))
+                    freqs, P = spectra.welch(x, fs, nperseg, workers)
+                    if W is None: W = spectra.wfr_weights(freqs, WFR)
+                    psd[key[:2]*2] = P.dot(W)
+                    s.bytes += x.nbytes
+                out.append(epoch, psd)
+                s.records += len(epoch)
+            profiler.stop(s)
+        return out.close()
+    
 class LocationInfo(object):
     """ Extract MagEphem data and store """
     
@@ -210,6 +265,7 @@ class LocationInfo(object):
         self.localDir = localDir
         self.file_objects = []
         self.verbose = v
+        self.sc = params["sc"].upper()
         return
     
     def fetch(self):
@@ -217,14 +273,18 @@ class LocationInfo(object):
         for date, url, tfname in zip(self.dates, self.urls, self.files):
             _dir_ = self.localDir + date.strftime("%Y%m%d") + "/"
             if not os.path.exists(_dir_): os.makedirs(_dir_)
+            key = date.strftime("%Y%m%d") + "/" + self.sc
             if not os.path.exists(tfname):
                 if self.verbose: print(" URL -", url)
-                response = requests.get(url, stream=True)
+                with profiler.stage("ephem_download", key) as s:
+                    response = requests.get(url, stream=True)
+                    if response.status_code == 200:
+                        with open(tfname, "wb") as f:
+                            response.raw.decode_content = True
+                            shutil.copyfileobj(response.raw, f)
+                    s.bytes = fsize(tfname)
                 if response.status_code == 200:
-                    with open(tfname, "wb") as f:
-                        response.raw.decode_content = True
-                        shutil.copyfileobj(response.raw, f)
-                        self.file_objects.append(h5py.File(tfname, "r"))
+                    self.file_objects.append(h5py.File(tfname, "r"))
             else:
                 if self.verbose: print(" Loading from - ", tfname)
                 self.file_objects.append(h5py.File(tfname, "r"))
@@ -248,17 +308,33 @@ class LocationInfo(object):
     def extract_data(self, keys=["L", "Lstar", "UTC", "Bmin_gsm", 
                                  "CDMAG_MLAT", "CDMAG_MLON", "CDMAG_MLT", 
                                  "CDMAG_R"], describe=False):
+        """
+        Read the requested datasets of every file into preallocated arrays (rows of
+        all dates concatenated), UTC as datetime64[ns] computed from the hours of day.
+        """
         if describe: self.describe()
-        params = {}
-        for d, f in zip(self.dates, self.file_objects):
-            for key in f.keys():
-                name = f.get(key).name[1:]
-                if name in keys:
-                    if name == "UTC": 
-                        val = [d + dt.timedelta(hours=h) for h in f.get(key)[:]]
-                        val[-1] = d + dt.timedelta(1)
-                    else: val = (f.get(key)[:]).tolist()
-                    params[name] = params[name].extend(val) if name in params.keys() else val
+        sizes = [max([f[k].shape[0] for k in keys if k in f] + [0]) for f in self.file_objects]
+        n, params = sum(sizes), {}
+        for key in keys:
+            shapes = [f[key] for f in self.file_objects if key in f]
+            if len(shapes) == 0: continue
+            if key == "UTC": params[key] = np.full(n, np.datetime64("NaT"), dtype="datetime64[ns]")
+            elif shapes[0].dtype.kind == "f": params[key] = np.full((n,) + shapes[0].shape[1:], np.nan, dtype=shapes[0].dtype)
+            else: params[key] = np.zeros((n,) + shapes[0].shape[1:], dtype=shapes[0].dtype)
+        i = 0
+        for d, f, k in zip(self.dates, self.file_objects, sizes):
+            s = profiler.start("ephem_parse", d.strftime("%Y%m%d") + "/" + self.sc, records=k)
+            for key in params.keys():
+                if key not in f: continue
+                if key == "UTC":
+                    h = f[key][:]
+                    t = np.datetime64(d, "ns") + np.rint(h * 3.6e12).astype("timedelta64[ns]")
+                    t[-1] = np.datetime64(d + dt.timedelta(1), "ns")
+                    params[key][i:i+k] = t
+                else: f[key].read_direct(params[key], dest_sel=np.s_[i:i+k])
+                s.bytes += params[key][i:i+k].nbytes
+            profiler.stop(s)
+            i += k
         return params
     
     def clean(self):
@@ -267,14 +343,64 @@ class LocationInfo(object):
             d = "/".join(d.split("/")[:-1])
             shutil.rmtree(d)
         return
-    
+
+def align_ephemeris(t, params, epoch, max_gap=120., periods={"CDMAG_MLT": 24., "CDMAG_MLON": 360.}):
+    """
+    Linearly interpolate ephemeris parameters (1D arrays on times t) at the
+    spectral epochs, on int64 nanosecond times. Each parameter is interpolated
+    over its own finite samples, cyclic parameters (MLT, MLON) are unwrapped
+    before and wrapped back after. Epochs outside [t[0], t[-1]] or between two
+    finite samples more than max_gap seconds apart (segment boundary) are NaN.
+    """
+    t = np.asarray(t, dtype="datetime64[ns]").astype(np.int64)
+    x = np.asarray(epoch, dtype="datetime64[ns]").astype(np.int64)
+    out = {}
+    for key, v in params.items():
+        v = np.asarray(v, dtype=np.float64)
+        ok = np.isfinite(v)
+        tk, vk = t[ok], v[ok]
+        y = np.full(len(x), np.nan)
+        if len(tk) == 0:
+            out[key] = y
+            continue
+        if key in periods: vk = np.unwrap(vk * 2*np.pi / periods[key]) * periods[key] / (2*np.pi)
+        j = np.searchsorted(tk, x, side="right")
+        inside = (x >= tk[0]) & (x <= tk[-1])
+        lo, hi = np.clip(j - 1, 0, len(tk) - 1), np.clip(j, 0, len(tk) - 1)
+        inside &= ((tk[hi] - tk[lo]) <= max_gap * 1e9) | (x == tk[lo])
+        y[inside] = np.interp(x[inside], tk, vk)
+        if key in periods: y = np.mod(y, periods[key])
+        out[key] = y
+    return out
+
+def band_integrate(psd, freq, lo, hi):
+    """
+    Wave amplitude (pT) of every spectrum (rows of psd, nT^2/Hz) between per
+    spectrum frequency limits lo and hi: trapezoidal integral of the bins with
+    lo <= freq <= hi, NaN where a limit is NaN.
+    """
+    psd, freq = np.asarray(psd, dtype=np.float64), np.asarray(freq, dtype=np.float64)
+    lo, hi = np.asarray(lo, dtype=np.float64)[:, None], np.asarray(hi, dtype=np.float64)[:, None]
+    m = (freq >= lo) & (freq <= hi)
+    seg = m[:, 1:] & m[:, :-1]
+    area = 0.5 * (psd[:, 1:] + psd[:, :-1]) * np.diff(freq)
+    b = 1e3 * np.sqrt(np.where(seg, area, 0.).sum(axis=1))
+    b[np.isnan(lo[:, 0]) | np.isnan(hi[:, 0])] = np.nan
+    return b
+
 class DownloadSC(object):
     
-    def __init__(self, dates, params={"sc":"a", "lev":"L2"}, localDir="tmp/EMFISIS/", clean=True, v=False):
+    def __init__(self, dates, params={"sc":"a", "lev":"L2"}, localDir="tmp/EMFISIS/", clean=True, encoding="f4", v=False):
+        """
+        Download and hold daily ephemeris and spectral data of a spacecraft,
+        cached in localDir/YYYYMMDD_SC.h5 with the PSD matrices stored as
+        float32 or log16 (see spectra.py).
+        """
         self.dates = dates
         self.params = params
         self.localDir = localDir
-        self.files = [localDir + "%s_%s.pickle"%(d.strftime("%Y%m%d"), params["sc"].upper()) for d in dates]
+        self.encoding = encoding
+        self.files = [localDir + "%s_%s.h5"%(d.strftime("%Y%m%d"), params["sc"].upper()) for d in dates]
         self.cln = clean
         self.outs = {}
         self.units = [{"name": "pT", "value": 1e-12}]
@@ -284,26 +410,98 @@ class DownloadSC(object):
     def reset_params(self, params):
         self.outs = {}
         self.params = params
-        self.files = [self.localDir + "%s_%s.pickle"%(d.strftime("%Y%m%d"), params["sc"].upper()) for d in self.dates]
+        self.files = [self.localDir + "%s_%s.h5"%(d.strftime("%Y%m%d"), params["sc"].upper()) for d in self.dates]
         return self
         
+    def _fetch_(self, d):
+        """ Download the raw ephemeris and spectral files of a day, None if the day is cached """
+        f = self.files[self.dates.index(d)]
+        if os.path.exists(f) or os.path.exists(f.replace(".h5", ".pickle")): return None
+        li = LocationInfo([d], self.params, localDir=self.localDir).fetch()
+        si = SpectralInfo([d], self.params, localDir=self.localDir).fetch()
+        return li, si
+    
+    def _decode_(self, d, raw):
+        """ Decode the raw files of a day (or load its cache) and cache it """
+        f = self.files[self.dates.index(d)]
+        key = d.strftime("%Y%m%d") + "/" + self.params["sc"].upper()
+        legacy = f.replace(".h5", ".pickle")
+        if os.path.exists(f):
+            if self.verbose: print(" Loading from - ", f)
+            with profiler.stage("h5_load", key, fsize(f)):
+                self.outs[d] = spectra.load(f)
+            return self.outs[d]
+        if raw is None:
+            # Older float64 pickles are converted
+            if self.verbose: print(" Converting - ", legacy)
+            with profiler.stage("pickle_load", key, fsize(legacy)):
+                a = pickle.load(open(legacy, "rb"))
+        else:
+            li, si = raw
+            a = {}
+            a["LocationInfo"] = li.extract_data()
+            a["SpectralData"] = si.get_dataset()
+            a["params"] = self.params
+        with profiler.stage("h5_dump", key) as s:
+            spectra.save(f, a, self.encoding)
+            s.bytes = fsize(f)
+        self.outs[d] = a
+        return a
+    
     def download(self):
-        for d, f in zip(self.dates, self.files):
-            if os.path.exists(f):
-                if self.verbose: print(" Loading from - ", f)
-                self.outs[d] = pickle.load(open( f, "rb" ) )
-            else:
-                self.li = LocationInfo([d], self.params, localDir=self.localDir)
-                self.si = SpectralInfo([d], self.params, localDir=self.localDir)
-                a = {}
-                a["LocationInfo"] = self.li.fetch().extract_data()
-                a["SpectralData"] = self.si.fetch().get_dataset()
-                a["params"] = self.params
-                with open(f, "wb") as h: pickle.dump(a, h, protocol=pickle.HIGHEST_PROTOCOL)
-                self.outs[d] = a
+        for d in self.dates:
+            raw = self._fetch_(d)
+            self._decode_(d, raw)
+            if raw is not None:
+                self.li, self.si = raw
                 if self.cln: self.clean()
         return self
     
+    def stream(self, workers=2, queue_size=2, flims=None):
+        """
+        Ingest the days as a pipeline: this thread downloads the raw files of
+        the days into a bounded queue while worker threads decode, cache,
+        integrate and convert (spectral_to_BField) the days already downloaded
+        and then delete their raw files. At most queue_size + workers + 1 days
+        of raw files are on disk, and processed days are not kept in outs.
+        """
+        q = queue.Queue(maxsize=queue_size)
+        local, cons, errors = threading.local(), [], []
+        def consume():
+            while True:
+                item = q.get()
+                if item is None: return
+                d, raw = item
+                try:
+                    if not hasattr(local, "con"):
+                        local.con = Connection()
+                        cons.append(local.con)
+                    self._decode_(d, raw)
+                    self._bfield_(d, local.con, flims)
+                    # Raw files are only removed once the day is committed
+                    if raw is not None: self._remove_(*raw)
+                    self.outs.pop(d, None)
+                except Exception as e: errors.append(e)
+        threads = [threading.Thread(target=consume, daemon=True) for _ in range(workers)]
+        for t in threads: t.start()
+        try:
+            for d in self.dates:
+                if errors: break
+                q.put((d, self._fetch_(d)))
+        finally:
+            for _ in threads: q.put(None)
+            for t in threads: t.join()
+            for con in cons: con._close_()
+        if errors: raise errors[0]
+        return self
+    
+    def _remove_(self, li, si):
+        """ Delete the raw files of a day """
+        for f in li.file_objects: f.close()
+        for f in li.files + [l + f for l, f in zip(si.files["locations"], si.files["fnames"])]:
+            if os.path.exists(f): os.remove(f)
+        return
+    
     def clean(self):
         self.li.clean()
         return
@@ -336,106 +534,98 @@ class DownloadSC(object):
         _dic_["frames"] = np.array(_dic_["frames"])
         return _dic_
     
-    def spectral_to_BField(self, flims=None):
-        def integrate_b(t, l, u):
-            ox = t[(t.freq>=l) & (t.freq<=u)]
-            m = 1e3*np.sqrt(np.trapz(ox.psd, x=ox.freq))
-            return m
-        
-        con = Connection()
-        for d in self.dates:
-            fname = self.localDir + "%s_%s.csv"%(d.strftime("%Y%m%d"), self.params["sc"].upper())
-            if os.path.exists(fname):
-                if self.verbose: print(" Loading from - ", fname)
+    def _bfield_(self, d, con, flims=None):
+        """ Band integrated wave amplitude and position of a day, converted remotely and stored as CSV """
+        fname = self.localDir + "%s_%s.csv"%(d.strftime("%Y%m%d"), self.params["sc"].upper())
+        key = d.strftime("%Y%m%d") + "/" + self.params["sc"].upper()
+        if os.path.exists(fname):
+            if self.verbose: print(" Loading from - ", fname)
+            with profiler.stage("csv_read", key, fsize(fname)) as s:
                 o = pd.read_csv(fname, parse_dates=["epoch"])
+                s.records = len(o)
+        else:
+            s = profiler.start("band_integration", key)
+            loc = self.outs[d]["LocationInfo"]
+            fce = 1e-9*np.array(loc["Bmin_gsm"])[:, 3] * C.e / (2*C.pi * C.m_e)
+            loc["L"], loc["Lstar"] = np.array(loc["L"]), np.array(loc["Lstar"])
+            loc["L"][loc["L"] < 0], loc["Lstar"][loc["Lstar"] < 0] = np.nan, np.nan
+            spec = self.outs[d]["SpectralData"]
+            b2_psd = spec["BuBu"] + spec["BvBv"] + spec["BwBw"]
+            epoch = spec["Epoch"]
+            freq = spec["WFR"]["frequencies"]
+            p = align_ephemeris(loc["UTC"], {"L": np.nanmedian(loc["L"], axis=1),
+                                             "Lstar": np.nanmedian(loc["Lstar"], axis=1), "fce": fce,
+                                             "CDMAG_MLAT": loc["CDMAG_MLAT"], "CDMAG_MLON": loc["CDMAG_MLON"],
+                                             "CDMAG_MLT": loc["CDMAG_MLT"], "CDMAG_R": loc["CDMAG_R"]}, epoch)
+            L, Lstar, Fce = p["L"], p["Lstar"], p["fce"]
+            CDMAG_MLAT, CDMAG_MLON, CDMAG_MLT, CDMAG_R = p["CDMAG_MLAT"], p["CDMAG_MLON"], p["CDMAG_MLT"], p["CDMAG_R"]
+            if flims is None:
+                B = band_integrate(b2_psd, freq, 0.1*Fce, 0.9*Fce)
+                Bl = band_integrate(b2_psd, freq, 0.1*Fce, 0.5*Fce)
+                Bu = band_integrate(b2_psd, freq, 0.5*Fce, 0.9*Fce)
             else:
-                loc = self.outs[d]["LocationInfo"]
-                fce = 1e-9*np.array(loc["Bmin_gsm"])[:, 3] * C.e / (2*C.pi * C.m_e)
-                loc["L"], loc["Lstar"] = np.array(loc["L"]), np.array(loc["Lstar"])
-                loc["L"][loc["L"] < 0], loc["Lstar"][loc["Lstar"] < 0] = np.nan, np.nan
-                _l = pd.DataFrame()
-                _l["L"], _l["Lstar"], _l["epoch"], _l["fce"] = np.nanmedian(loc["L"], axis=1),\
-                                np.nanmedian(loc["Lstar"], axis=1), loc["UTC"], fce
-                _l["CDMAG_MLAT"], _l["CDMAG_MLON"], _l["CDMAG_MLT"], _l["CDMAG_R"] = loc["CDMAG_MLAT"],\
-                                loc["CDMAG_MLON"], loc["CDMAG_MLT"], loc["CDMAG_R"]
-                _l = _l.set_index("epoch").resample("1s").interpolate().reset_index()
-                spec = self.outs[d]["SpectralData"]
-                b2_psd = spec["BuBu"] + spec["BvBv"] + spec["BwBw"]
-                epoch = spec["Epoch"]
-                freq = spec["WFR"]["frequencies"]
-                o = pd.DataFrame()
-                L, Lstar, CDMAG_MLAT, CDMAG_MLON, CDMAG_MLT, CDMAG_R, Fce = [], [], [], [], [], [], []
-                Bl, Bu, B = [], [], []
-                for i in range(b2_psd.shape[0]):
-                    o["freq"] = np.copy(freq)
-                    o["psd"] = np.copy(b2_psd[i,:])
-                    b, bl, bu = 0., 0., 0.
-                    if flims is None:
-                        f = _l[_l.epoch==epoch[i]]
-                        if len(f) > 0:
-                            fce = f.fce.tolist()[0]
-                            Fce.append(fce)
-                            b += integrate_b(o, 0.1*fce, 0.9*fce)
-                            bl += integrate_b(o, 0.1*fce, 0.5*fce)
-                            bu += integrate_b(o, 0.5*fce, 0.9*fce)
-                            L.append(f.L.tolist()[0])
-                            Lstar.append(f.Lstar.tolist()[0])
-                            CDMAG_MLAT.append(f.CDMAG_MLAT.tolist()[0])
-                            CDMAG_MLON.append(f.CDMAG_MLON.tolist()[0])
-                            CDMAG_MLT.append(f.CDMAG_MLT.tolist()[0])
-                            CDMAG_R.append(f.CDMAG_R.tolist()[0])
-                        else:
-                            b, bl, bu = np.nan, np.nan, np.nan
-                            Fce.append(np.nan)
-                            L.append(np.nan)
-                            Lstar.append(np.nan)
-                            CDMAG_MLAT.append(np.nan)
-                            CDMAG_MLON.append(np.nan)
-                            CDMAG_MLT.append(np.nan)
-                            CDMAG_R.append(np.nan)
-                    else:
-                        for flim in flims:
-                            ox = o[(o.freq>=flim["min"]) & (o.freq<=flim["max"])]
-                            b += 1e3*np.sqrt(np.trapz(ox.psd, x=ox.freq))
-                            bl, bu = np.nan, np.nan
-                    B.append(b)
-                    Bl.append(bl)
-                    Bu.append(bu)
-                    o = o[0:0]
-                o = pd.DataFrame()
-                o["B(pT)"], o["Bl(pT)"], o["Bu(pT)"], o["epoch"], o["L"], o["Lstar"] = B, Bl, Bu, epoch, L, Lstar
-                o["CDMAG_MLAT"], o["CDMAG_MLON"], o["CDMAG_MLT"], o["CDMAG_R"] = CDMAG_MLAT, CDMAG_MLON, CDMAG_MLT, CDMAG_R
-                o["SAT"], o["Fce"] = self.params["sc"].upper(), Fce
+                n = b2_psd.shape[0]
+                B = sum(band_integrate(b2_psd, freq, np.full(n, flim["min"]), np.full(n, flim["max"]))
+                        for flim in flims)
+                Bl, Bu = np.full(n, np.nan), np.full(n, np.nan)
+            o = pd.DataFrame()
+            o["B(pT)"], o["Bl(pT)"], o["Bu(pT)"], o["epoch"], o["L"], o["Lstar"] = B, Bl, Bu, epoch, L, Lstar
+            o["CDMAG_MLAT"], o["CDMAG_MLON"], o["CDMAG_MLT"], o["CDMAG_R"] = CDMAG_MLAT, CDMAG_MLON, CDMAG_MLT, CDMAG_R
+            o["SAT"], o["Fce"] = self.params["sc"].upper(), Fce
+            s.records = len(o)
+            profiler.stop(s)
+            with profiler.stage("csv_write", key, records=len(o)) as s:
                 o.to_csv(fname, index=False, header=True)
-                if self.verbose: print(" Local extraction done - ", d)
-                # Run remote conversion in Python 2.7
+                s.bytes = fsize(fname)
+            if self.verbose: print(" Local extraction done - ", d)
+            # Run remote conversion in Python 2.7
+            with profiler.stage("lgmpy2", key, fsize(fname), len(o)):
                 stdin, stdout, stderr = con.ssh.exec_command("cd CodeBase/Bayesian_Framework_CRRES/ "\
                                 "\n python src/lgmpy2.py {f}".format(f=fname), get_pty=True)
                 for line in iter(stdout.readline, ""):
                     if self.verbose: print(line, end="")
+            with profiler.stage("csv_read", key, fsize(fname)) as s:
                 o = pd.read_csv(fname, parse_dates=["epoch"])
-            if self.verbose: print(o.head())        
+                s.records = len(o)
+        if self.verbose: print(o.head())        
+        return o
+    
+    def spectral_to_BField(self, flims=None):
+        con = Connection()
+        for d in self.dates: self._bfield_(d, con, flims)
         # End remote connections
         con._close_()
         return self
     
     def merge_satellites(self):
+        """ Store the days of both spacecraft in the chorus dataset, and as merged daily CSV files """
         sats = ["a", "b"]
+        store = ChorusDataset(self.localDir + "chorus/", v=self.verbose)
         for d in self.dates:
             fname = self.localDir + "%s.csv"%(d.strftime("%Y%m%d"))
             u = pd.DataFrame()
             for sat in sats:
                 f = self.localDir + "%s_%s.csv"%(d.strftime("%Y%m%d"), sat.upper())
-                if os.path.exists(f): u = pd.concat([u, pd.read_csv(f)])
+                if os.path.exists(f):
+                    x = pd.read_csv(f, parse_dates=["epoch"])
+                    store.write(x, d, sat)
+                    u = pd.concat([u, x])
             u.to_csv(fname, index=False, header=True)
         return
 
-def download_dataset(dates, localDir="tmp/EMFISIS/"):
+def download_dataset(dates, localDir="tmp/EMFISIS/", stream=False):
     params = {"sc":"a", "lev":"L2"}
     d = DownloadSC(dates, params, localDir)
-    d.download().spectral_to_BField().reset_params({"sc":"b", "lev":"L2"})
-    d.download().spectral_to_BField()
+    if stream:
+        # Downloads overlap with decoding and integration, raw files are deleted per day
+        d.stream().reset_params({"sc":"b", "lev":"L2"})
+        d.stream()
+    else:
+        d.download().spectral_to_BField().reset_params({"sc":"b", "lev":"L2"})
+        d.download().spectral_to_BField()
     d.merge_satellites()
+    profiler.summary()
+    profiler.summary(by_key=True)
     return
 
 
@@ -444,44 +634,102 @@ class DataLoader(object):
     def __init__(self, dates, localDir="tmp/EMFISIS/", first_date_reset = True, v=False):
         self.dates = dates
         self.localDir = localDir
+        self.first_date_reset = first_date_reset
         self.verbose = v
-        o = pd.DataFrame()
-        for d in self.dates:
-            f = self.localDir + d.strftime("%Y%m%d.csv")
-            if os.path.exists(f): 
-                if self.verbose: print(" Data file %s exists."%f)
-                o = pd.concat([o, pd.read_csv(f, parse_dates=["epoch"])])
-            else: 
-                if self.verbose: print(" Data file %s does not exists."%f)
-        if first_date_reset and o.epoch.tolist()[0] != dates[0]: 
+        self.frame = None
+        # Days stored in the chorus dataset are read on demand by _filter_
+        self.store = ChorusDataset(self.localDir + "chorus/", v=v)
+        if not all(self.store.has(d) for d in self.dates):
+            o = pd.DataFrame()
+            for d in self.dates:
+                f = self.localDir + d.strftime("%Y%m%d.csv")
+                if os.path.exists(f): 
+                    if self.verbose: print(" Data file %s exists."%f)
+                    with profiler.stage("csv_read", d.strftime("%Y%m%d"), fsize(f)) as s:
+                        x = pd.read_csv(f, parse_dates=["epoch"])
+                        s.records = len(x)
+                    o = pd.concat([o, x])
+                else: 
+                    if self.verbose: print(" Data file %s does not exists."%f)
+            o = o.reset_index()
+            o.drop(columns=["index"], inplace=True)
+            self.frame = o
+        dmap.download_omni_dataset(self.dates)
+        return
+    
+    def _reset_first_date_(self, o):
+        """ Copy the first row at the first date, so that resampled series start at it """
+        if len(o) > 0 and o.epoch.tolist()[0] != self.dates[0]: 
             if self.verbose: print(" Reseting first date, row.")
-            f = o.iloc[0]
-            f["epoch"] = dates[0]
+            f = o.iloc[0].copy()
+            f["epoch"] = self.dates[0]
             f = pd.DataFrame([f.to_dict()])
             o = pd.concat([f, o]).reset_index(drop = True)
-        o = o.reset_index()
-        o.drop(columns=["index"], inplace=True)
-        self.frame = o.copy()
-        dmap.download_omni_dataset(self.dates)
-        return
+        return o
     
-    def _filter_(self, sc=None, dates=None, mlt=None, mlat=None):
-        o = self.frame.copy()
-        if sc is not None: o = o[o.SAT == sc]
-        if (dates is not None) and (len(dates) == 2): o = o[(o.epoch >= dates[0]) & (o.epoch < dates[1])]
+    def _filter_(self, sc=None, dates=None, mlt=None, mlat=None, L=None, Lstar=None, columns=None):
+        """
+        Rows of a spacecraft, within dates = [start, end) and [min, max) ranges
+        of MLT (min > max wraps through 0), MLAT, L and L*. With the chorus
+        dataset the predicates are pushed down to the scan.
+        """
+        if self.frame is None:
+            o = self.store.read(sc, dates or [self.dates[0], self.dates[-1] + dt.timedelta(1)],
+                                mlt, mlat, L, Lstar, columns)
+        else:
+            o = self.frame
+            if sc is not None: o = o[o.SAT == sc]
+            if (dates is not None) and (len(dates) == 2): o = o[(o.epoch >= dates[0]) & (o.epoch < dates[1])]
+            for c, r in zip(["MLT", "MLAT", "L", "Lstar"], [mlt, mlat, L, Lstar]):
+                if r is None: continue
+                if r[0] > r[1]: o = o[(o[c] >= r[0]) | (o[c] < r[1])]
+                else: o = o[(o[c] >= r[0]) & (o[c] < r[1])]
+            if columns is not None: o = o[projection(columns)]
+            o = o.copy()
+        if self.first_date_reset and dates is None: o = self._reset_first_date_(o)
+        return o
+    
+    def _rollup_(self, sc, cadence="1T", stat="max"):
+        """
+        Rollup (dataset.rollup) of a spacecraft on the full grid of the dates,
+        with the wave columns of a statistic (max, mean, median, p90) and the
+        max of the other columns under their own names. The stored rollup is
+        used when there is one, else it is computed from the rows, so both give
+        the same frame.
+        """
+        end = self.dates[-1] + dt.timedelta(1)
+        o = None
+        if self.frame is None and cadence in self.store.cadences:
+            o = self.store.read_rollup(cadence, sc, [self.dates[0], end])
+            if len(o) == 0: o = None
+        if o is None:
+            o = rollup(self._filter_(sc=sc, dates=[self.dates[0], end]), cadence)
+        names = {}
+        for c in o.columns:
+            if c == "SAT": names[c] = c
+            elif c.endswith("_" + stat) and c[:-len(stat) - 1] in WAVES: names[c] = c[:-len(stat) - 1]
+            elif c.endswith("_max") and c[:-4] not in WAVES: names[c] = c[:-4]
+        o = o[["epoch"] + list(names)].rename(columns=names)
+        grid = np.arange(np.datetime64(self.dates[0], "s"), np.datetime64(end, "s"),
+                         np.timedelta64(cadence_seconds(cadence), "s")).astype("datetime64[ns]")
+        o = o.set_index("epoch").reindex(grid).rename_axis("epoch").reset_index()
+        o["SAT"] = sc
         return o
     
     def parsed_min_segmented_data(self, scs = ["A", "B"], interpolate_params={"dt":"1T"}, 
-                                  omni_params=["AE"], to_csv={"save":True, "localDir":"tmp/"}):
+                                  omni_params=["AE"], to_csv={"save":True, "localDir":"tmp/"}, stat="max"):
+        cadence = cadence_seconds(interpolate_params["dt"])
         omni = dmap.get_omni_dataset(self.dates)[["DATE"]+omni_params]
         omni = omni.rename(columns={"DATE":"epoch"})
         omni = omni[(omni.epoch>=self.dates[0]) & (omni.epoch<self.dates[-1]+dt.timedelta(1))]
+        # OMNI (1 min) averaged in the bins of the cadence, joined on epoch
+        b = omni.epoch.values.astype("datetime64[s]").astype(np.int64) // cadence * cadence
+        omni = omni[omni_params].groupby(b.astype("datetime64[s]").astype("datetime64[ns]")).mean()
         o = pd.DataFrame()
         for sc in scs:
-            _o = self._filter_(sc=sc)
-            _o = _o.set_index("epoch").resample(interpolate_params["dt"]).max().reset_index()
-            for p in omni_params:
-                _o[p] = omni[p].tolist()
+            # Stored rollups avoid re-reading the 6 s data
+            _o = self._rollup_(sc, interpolate_params["dt"], stat)
+            _o = _o.join(omni, on="epoch")
             o = pd.concat([o, _o])
         o = o.reset_index().drop(columns=["index"])
         if to_csv and to_csv["save"]: 
@@ -528,7 +776,9 @@ def get_fetch_hiss_data(dates, fname):
         nLstar = nds.createVariable("Lstar","f4",("epoch",))
         nL[:], nLstar[:] = L, Lstar
         
-        B = nds.createVariable("B_hiss", "f8", ("epoch","freqs"))
+        # float32 (relative error <= 2^-24) with compressed daily chunks
+        B = nds.createVariable("B_hiss", "f4", ("epoch","freqs"), zlib=True, shuffle=True, complevel=4,
+                               chunksizes=(min(14400, len(epoch)), len(freqs)))
         B[:] = np.vstack(tuple(frames))
         
         nds.close()
@@ -11,8 +11,10 @@ __status__ = "Research"
 
 import os
 import sys
+import time
+import numpy as np
 sys.path.append("src/")
-import get_data as gd
+from features import FeatureStore
 import datetime as dt
 import argparse
 from dateutil import parser as prs
@@ -24,33 +26,248 @@ class Model(object):
     """
     
     def __init__(self, args):
-        for k in vars(args).keys():
+        for p in vars(args).keys():
             setattr(self, p, vars(args)[p])
-        self.load_data()
         self.input_keys = ["L", "Lstar", "AE", "MLAT", "MLT", "mod"]
+        self.output_keys = ["log.B(pT)"]
+        self.load_data()
         return
 
     def load_data(self):
-        self.frame = pd.read_csv(self.fname, parse_dates=["epoch"])
-        self.frame["mod"] = self.frame.epoch.apply(lambda x: x.minute + 60*x.hour)
+        self.store = FeatureStore([self.start, self.end], [self.fname], self.input_keys, self.output_keys)
+        self.X, self.y = self.store.load()
+        logger.info(f"Loaded features - {self.X.shape} from {self.store.floc}")
         return
-    
+
+    def normalization(self, chunk=1000000):
+        """ Mean and standard deviation of inputs / outputs, computed chunk-wise """
+        s, ss, n = 0., 0., 0
+        for i in range(0, len(self.X), chunk):
+            x = np.hstack((self.X[i:i+chunk], self.y[i:i+chunk])).astype(np.float64)
+            s, ss, n = s + x.sum(0), ss + (x**2).sum(0), n + len(x)
+        mean = s / n
+        std = np.sqrt(np.maximum(ss / n - mean**2, 0.))
+        std[std == 0] = 1.
+        k = self.X.shape[1]
+        self.mean_X, self.std_X, self.mean_y, self.std_y = mean[:k], std[:k], mean[k:], std[k:]
+        return self
+
+    def grid(self, axes, fixed={}):
+        """
+        Create an input matrix over a dense grid, e.g. axes={"Lstar": [...], "MLT": [...]}.
+        Inputs not in axes or fixed are held at their training median.
+        """
+        sample = self.X[np.linspace(0, len(self.X)-1, min(len(self.X), 10000)).astype(int)]
+        mesh = np.meshgrid(*[np.asarray(v) for v in axes.values()], indexing="ij")
+        X = np.zeros((mesh[0].size, len(self.input_keys)), dtype=np.float32)
+        for i, k in enumerate(self.input_keys):
+            if k in axes: X[:, i] = mesh[list(axes.keys()).index(k)].ravel()
+            elif k in fixed: X[:, i] = fixed[k]
+            else: X[:, i] = np.median(sample[:, i])
+        return X, mesh[0].shape
+
+class GPR(Model):
+    """
+    Scalable Gaussian process regression (RBF kernel) approximated with random
+    Fourier features. The model is a Bayesian linear regression on the features,
+    fitted from sufficient statistics accumulated over chunks of the cached data,
+    so memory is bounded by the chunk size and time by the number of features.
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.n_features = 2 * (getattr(self, "n_features", 1024) // 2)
+        self.memory = getattr(self, "memory", 512)
+        self.budget = getattr(self, "budget", None)
+        self.lengthscale = getattr(self, "lengthscale", None)
+        self.seed = getattr(self, "seed", 0)
+        self.chunk = max(1000, int(self.memory * 2**20 / (8 * 3 * self.n_features)))
+        self.rng = np.random.RandomState(self.seed)
+        return
+
+    def _features(self, X):
+        """ Random Fourier features of normalized inputs """
+        Z = ((X - self.mean_X) / self.std_X) @ self.W
+        return np.hstack((np.cos(Z), np.sin(Z))) * np.sqrt(2. / self.n_features)
+
+    def fit(self, em_steps=10):
+        """ Accumulate Phi'Phi and Phi'y chunk-wise and solve for the posterior """
+        start = time.time()
+        self.normalization()
+        d, D = self.X.shape[1], self.n_features
+        if self.lengthscale is None:
+            s = (self.X[self.rng.choice(len(self.X), min(len(self.X), 2000), replace=False)] - self.mean_X) / self.std_X
+            self.lengthscale = np.median(np.sqrt(((s[:, None] - s[None])**2).sum(-1)))
+        self.W = self.rng.normal(scale=1./self.lengthscale, size=(d, D // 2))
+        G, b, yy, n = np.zeros((D, D)), np.zeros(D), 0., 0
+        # Visit chunks in random order so that a time budget still sees representative data
+        for i in self.rng.permutation(np.arange(0, len(self.X), self.chunk)):
+            P = self._features(self.X[i:i+self.chunk].astype(np.float64))
+            y = (self.y[i:i+self.chunk, 0] - self.mean_y[0]) / self.std_y[0]
+            G, b, yy, n = G + P.T @ P, b + P.T @ y, yy + y @ y, n + len(y)
+            if self.budget is not None and time.time() - start > self.budget:
+                logger.warning(f"Time budget reached, fitted on {n}/{len(self.X)} rows")
+                break
+        # Estimate the noise variance by EM on the sufficient statistics
+        self.noise = 0.1
+        for _ in range(em_steps):
+            self.S = np.linalg.inv(G / self.noise + np.eye(D))
+            self.w = self.S @ b / self.noise
+            rss = yy - 2 * self.w @ b + self.w @ G @ self.w
+            self.noise = max((rss + np.trace(G @ self.S)) / n, 1e-6)
+        self.S = np.linalg.inv(G / self.noise + np.eye(D))
+        self.w = self.S @ b / self.noise
+        self.n_train = n
+        logger.info(f"GPR fitted on {n} rows, D={D}, lengthscale={self.lengthscale:.3f}, "
+                    f"noise={self.noise:.3f} in {time.time()-start:.1f}s")
+        return self
+
+    def predict(self, X, batch=None):
+        """ Batched predictive mean and variance (including noise) in output units """
+        batch = batch or self.chunk
+        mean, var = np.zeros(len(X)), np.zeros(len(X))
+        for i in range(0, len(X), batch):
+            P = self._features(np.asarray(X[i:i+batch], dtype=np.float64))
+            mean[i:i+batch] = P @ self.w
+            var[i:i+batch] = ((P @ self.S) * P).sum(1) + self.noise
+        return mean * self.std_y[0] + self.mean_y[0], var * self.std_y[0]**2
+
+    def save(self, localDir="tmp/models/"):
+        if not os.path.exists(localDir): os.makedirs(localDir)
+        fname = localDir + "gpr_%s.npz"%self.store.key
+        np.savez(fname, W=self.W, w=self.w, S=self.S, noise=self.noise, lengthscale=self.lengthscale,
+                 mean_X=self.mean_X, std_X=self.std_X, mean_y=self.mean_y, std_y=self.std_y)
+        logger.info(f"GPR saved to - {fname}")
+        return self
+
+class BNN(Model):
+    """
+    Bayesian neural network approximated with MC-dropout. The network predicts
+    a mean and a log noise variance (aleatoric), and the spread of the mean
+    over stochastic forward passes gives the epistemic variance.
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.n_hidden = getattr(self, "n_hidden", [50, 50])
+        self.dropout = getattr(self, "dropout", 0.05)
+        self.epochs = getattr(self, "epochs", 40)
+        self.samples = getattr(self, "samples", 1000)
+        self.memory = getattr(self, "memory", 512)
+        self.batch_size = getattr(self, "batch_size", 1024)
+        self.lengthscale = 1e-2
+        return
+
+    def build(self):
+        import keras
+        reg = self.lengthscale**2 * (1 - self.dropout) / (2. * len(self.X))
+        inputs = keras.Input(shape=(self.X.shape[1],))
+        inter = inputs
+        for n in self.n_hidden:
+            inter = keras.layers.Dropout(self.dropout)(inter, training=True)
+            inter = keras.layers.Dense(n, activation="relu", kernel_regularizer=keras.regularizers.l2(reg))(inter)
+        inter = keras.layers.Dropout(self.dropout)(inter, training=True)
+        outputs = keras.layers.Dense(2, kernel_regularizer=keras.regularizers.l2(reg))(inter)
+        self.model = keras.Model(inputs, outputs)
+        self.model.compile(loss=self._nll, optimizer="adam")
+        return self
+
+    @staticmethod
+    def _nll(y_true, y_pred):
+        """ Gaussian negative log-likelihood with predicted log variance """
+        from keras import backend as K
+        mu, s = y_pred[:, :1], y_pred[:, 1:]
+        return K.mean(0.5 * K.exp(-s) * K.square(y_true - mu) + 0.5 * s)
+
+    def _batches(self, rng):
+        """
+        Endless generator of normalized float32 batches from the cached arrays:
+        chunks within the memory budget are read in random order and their rows
+        shuffled, so batches do not hold contiguous (time sorted) rows.
+        """
+        chunk = max(1, int(self.memory * 2**20 / (8 * (self.X.shape[1] + 1))) // self.batch_size) * self.batch_size
+        while True:
+            for i in rng.permutation(np.arange(0, len(self.X), chunk)):
+                X, y = np.asarray(self.X[i:i+chunk]), np.asarray(self.y[i:i+chunk, :1])
+                order = rng.permutation(len(X))
+                for j in range(0, len(X), self.batch_size):
+                    index = order[j:j+self.batch_size]
+                    yield ((X[index] - self.mean_X) / self.std_X).astype(np.float32),\
+                        ((y[index] - self.mean_y[0]) / self.std_y[0]).astype(np.float32)
+
+    def fit(self):
+        start = time.time()
+        self.normalization().build()
+        steps = int(np.ceil(len(self.X) / self.batch_size))
+        self.model.fit(self._batches(np.random.RandomState(0)), steps_per_epoch=steps, epochs=self.epochs, verbose=0)
+        logger.info(f"BNN fitted on {len(self.X)} rows in {time.time()-start:.1f}s")
+        return self
+
+    def _rows(self, n_features):
+        """
+        Rows per forward call within the memory budget, counting float32 bytes
+        per row of the replicated and batched input, the dense and dropout
+        activations of every hidden layer, and the outputs with their reductions.
+        """
+        return max(1, int(self.memory * 2**20 / (4 * (2 * n_features + 2 * sum(self.n_hidden) + 4 * 2))))
+
+    def predict(self, X, T=None):
+        """
+        MC-dropout prediction. Inputs are replicated so that many stochastic passes
+        run in each forward call; the number of rows per call is bounded by the
+        memory budget. Returns predictive mean, epistemic and aleatoric variance.
+        """
+        T = T or self.samples
+        if len(X) == 0: return np.zeros(0), np.zeros(0), np.zeros(0)
+        rows = self._rows(np.shape(X)[1])
+        chunk = min(len(X), rows)
+        mean, epistemic, aleatoric = np.zeros(len(X)), np.zeros(len(X)), np.zeros(len(X))
+        for i in range(0, len(X), chunk):
+            x = ((np.asarray(X[i:i+chunk]) - self.mean_X) / self.std_X).astype(np.float32)
+            n, m, M2, a = 0, 0., 0., 0.
+            while n < T:
+                tb = min(T - n, max(1, rows // len(x)))
+                o = self.model.predict(np.tile(x, (tb, 1)), batch_size=rows, verbose=0).reshape(tb, len(x), 2)
+                # Merge block statistics into the running mean / M2 (Chan et al.)
+                bm, bM2 = o[..., 0].mean(0), o[..., 0].var(0) * tb
+                d = bm - m
+                m, M2 = m + d * tb / (n + tb), M2 + bM2 + d**2 * n * tb / (n + tb)
+                a, n = a + np.exp(o[..., 1]).sum(0), n + tb
+            mean[i:i+chunk], epistemic[i:i+chunk], aleatoric[i:i+chunk] = m, M2 / n, a / n
+        return mean * self.std_y[0] + self.mean_y[0], epistemic * self.std_y[0]**2, aleatoric * self.std_y[0]**2
+
+    def save(self, localDir="tmp/models/"):
+        if not os.path.exists(localDir): os.makedirs(localDir)
+        fname = localDir + "bnn_%s"%self.store.key
+        self.model.save_weights(fname + ".weights.h5")
+        np.savez(fname + ".npz", mean_X=self.mean_X, std_X=self.std_X, mean_y=self.mean_y, std_y=self.std_y,
+                 n_hidden=self.n_hidden, dropout=self.dropout)
+        logger.info(f"BNN saved to - {fname}")
+        return self
+
 def modeling(args):
     logger.info(f"Start model for - {args.start}-{args.end}")
     logger.info(f"Data file - {args.fname}")
     if os.path.exists(args.fname): 
-        if args.operation == "gpr": GPR(args)
-        elif args.operation == "bnn": BNN(args)
+        if args.operation == "gpr": GPR(args).fit().save()
+        elif args.operation == "bnn": BNN(args).fit().save()
         else: logger.error(f"Model does not exists - {args.operation}!")
     else: logger.error(f"Data file does not exists - {args.fname}!")
     return
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
     parser.add_argument("-o", "--operation", default="gpr", help="Model type")
     parser.add_argument("-s", "--start", default=dt.datetime(2012,10,1), help="Start date (default 2012-10-01)", 
             type=prs.parse)
     parser.add_argument("-e", "--end", default=dt.datetime(2012,10,31), help="End date (default 2012-10-31)", 
             type=prs.parse)
+    parser.add_argument("-nf", "--n_features", default=1024, type=int, help="Number of random Fourier features (GPR)")
+    parser.add_argument("-m", "--memory", default=512, type=int, help="Memory budget per chunk in MB")
+    parser.add_argument("-b", "--budget", default=None, type=float, help="Training time budget in seconds")
+    parser.add_argument("-ep", "--epochs", default=40, type=int, help="Number of training epochs (BNN)")
+    parser.add_argument("-dr", "--dropout", default=0.05, type=float, help="Dropout rate (BNN)")
+    parser.add_argument("-T", "--samples", default=1000, type=int, help="Number of MC-dropout samples (BNN)")
     parser.add_argument("-v", "--verbose", action="store_false", help="Increase output verbosity (default True)")
     args = parser.parse_args()
     logger.info(f"Simulation run using model.__main__")
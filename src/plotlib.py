@@ -30,14 +30,29 @@ class FrequencyTimePlot(object):
         self.WFR = WFR
         self.num_subplots = num_subplots
         self._num_subplots_created = 0
+        self.axes, self.caxes, self._num_colorbars_created = [], [], 0
+        self.fig_title = fig_title
         fig_title = fig_title.format(date=self.dates[0].strftime("%Y-%m-%d"))
         self.fig = plt.figure(figsize=(8, 3*self.num_subplots), dpi=100) # Size for website
-        plt.suptitle(fig_title, x=0.9, y=0.95, ha="right", fontweight="bold", fontsize=12)
+        self.title = plt.suptitle(fig_title, x=0.9, y=0.95, ha="right", fontweight="bold", fontsize=12)
         mpl.rcParams.update({"font.size": 10})
         return
+    
+    def reset(self, dates, WFR):
+        """ Reuse the figure and its axes for other dates (batch rendering) """
+        self.dates, self.WFR = dates, WFR
+        self._reset_()
+        self.title.set_text(self.fig_title.format(date=self.dates[0].strftime("%Y-%m-%d")))
+        return self
         
     def addParamPlot(self, Z, title, vmax=1e-5, vmin=1e-9, steps=3, cmap = plt.cm.Spectral, xlabel="Time UT",
-                     ylabel="Frequency, Hz", label=r"[$nT^2Hz^{-1}$]", ax=None, fig=None, add_colbar=True):
+                     ylabel="Frequency, Hz", label=r"[$nT^2Hz^{-1}$]", ax=None, fig=None, add_colbar=True,
+                     render="mesh", agg="max"):
+        """
+        render="mesh" draws every (time, frequency) cell, render="raster" first
+        aggregates the PSD to one column per pixel of the axis (agg="max" or
+        "logmean") and draws the reduced grid rasterized.
+        """
         if fig is None: fig = self.fig
         if ax is None: ax = self._add_axis()
         if vmax is None: vmax = Z.max()
@@ -52,8 +67,15 @@ class FrequencyTimePlot(object):
         ax.set_ylabel(ylabel, fontdict={"size":12})
         ax.set_xlim([self.dates[0], self.dates[-1]])
         ax.set_ylim([self.WFR["frequencies"][0], self.WFR["frequencies"][-1]])
-        X, Y = np.meshgrid(self.dates, self.WFR["frequencies"])
-        ax.pcolormesh(X, Y, Z.T, lw=0.01, edgecolors="None", cmap=cmap, norm=norm)
+        if render == "raster":
+            # The frequency axis is logarithmic, so the reduced grid is drawn with
+            # pcolormesh (rows at their frequencies) rather than imshow
+            x, Zr = decimate(date2num(self.dates), Z, int(ax.get_window_extent().width), agg)
+            ax.pcolormesh(x, self.WFR["frequencies"], np.ma.masked_invalid(Zr).T, shading="nearest", 
+                          edgecolors="None", cmap=cmap, norm=norm, rasterized=True)
+        else:
+            X, Y = np.meshgrid(self.dates, self.WFR["frequencies"])
+            ax.pcolormesh(X, Y, Z.T, lw=0.01, edgecolors="None", cmap=cmap, norm=norm)
         ax.set_yscale("log")
         if add_colbar: self._add_colorbar(fig, ax, norm, cmap, label=title+" "+label)
         ax.set_title(title, loc="left")
@@ -70,9 +92,19 @@ class FrequencyTimePlot(object):
 
     def _add_axis(self):
         self._num_subplots_created += 1
-        ax = self.fig.add_subplot(self.num_subplots, 1, self._num_subplots_created)
+        if len(self.axes) >= self._num_subplots_created:
+            ax = self.axes[self._num_subplots_created - 1]
+            ax.cla()
+        else:
+            ax = self.fig.add_subplot(self.num_subplots, 1, self._num_subplots_created)
+            self.axes.append(ax)
         ax.tick_params(axis="both", labelsize=12)
         return ax
+    
+    def _reset_(self):
+        """ Axes and colorbar axes are cleared when they are reused """
+        self._num_subplots_created, self._num_colorbars_created = 0, 0
+        return
 
     def _add_colorbar(self, fig, ax, norm, colormap, label=""):
         """
@@ -88,7 +120,13 @@ class FrequencyTimePlot(object):
         pos = ax.get_position()
         cpos = [pos.x1 + 0.025, pos.y0 + 0.0125,
                 0.015, pos.height * 0.8]                # this list defines (left, bottom, width, height
-        cax = fig.add_axes(cpos)
+        if len(self.caxes) > self._num_colorbars_created:
+            cax = self.caxes[self._num_colorbars_created]
+            cax.cla()
+        else:
+            cax = fig.add_axes(cpos)
+            self.caxes.append(cax)
+        self._num_colorbars_created += 1
         cb2 = mpl.colorbar.ColorbarBase(cax, cmap=colormap,
                                         norm=norm,
                                         spacing="uniform",
@@ -96,6 +134,28 @@ class FrequencyTimePlot(object):
         cb2.set_label(label)
         return
 
+def decimate(x, Z, n, agg="max"):
+    """
+    Aggregate the rows of Z (time x frequency) sampled at sorted times x into n
+    equal time bins (pixel columns), with the max or the mean of log10 per bin.
+    Returns the bin centers and the reduced grid (NaN for empty bins).
+    """
+    x, Z = np.asarray(x, dtype=np.float64), np.asarray(Z, dtype=np.float64)
+    if n <= 0 or len(x) <= n: return x, Z
+    edges = np.linspace(x[0], x[-1], n + 1)
+    idx = np.clip(np.searchsorted(edges, x, side="right") - 1, 0, n - 1)
+    starts = np.flatnonzero(np.r_[True, idx[1:] != idx[:-1]])
+    Zr = np.full((n, Z.shape[1]), np.nan)
+    if agg == "max": Zr[idx[starts]] = np.fmax.reduceat(Z, starts, axis=0)
+    else:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lz = np.log10(Z)
+            ok = np.isfinite(lz)
+            s = np.add.reduceat(np.where(ok, lz, 0.), starts, axis=0)
+            c = np.add.reduceat(ok.astype(np.float64), starts, axis=0)
+            Zr[idx[starts]] = 10**(s / c)
+    return (edges[:-1] + edges[1:]) / 2, Zr
+
 def get_gridded_parameters(q, xparam="x", yparam="y", zparam="z"):
     """
     Method converts scans to "beam" and "slist" or gate
@@ -123,12 +183,22 @@ class RangeTimePlot(object):
         self.dates = dates
         self.num_subplots = num_subplots
         self._num_subplots_created = 0
+        self.axes, self.caxes, self._num_colorbars_created = [], [], 0
+        self.fig_title = fig_title
         fig_title = fig_title.format(date=self.dates[0].strftime("%Y.%m.%d") + "-" + self.dates[-1].strftime("%m.%d"))
         self.fig = plt.figure(figsize=(8, 3*self.num_subplots), dpi=150) # Size for website
-        plt.suptitle(fig_title, x=0.9, y=0.95, ha="right", fontweight="bold", fontsize=12)
+        self.title = plt.suptitle(fig_title, x=0.9, y=0.95, ha="right", fontweight="bold", fontsize=12)
         mpl.rcParams.update({"font.size": 10})
         return
     
+    def reset(self, dates):
+        """ Reuse the figure and its axes for other dates (batch rendering) """
+        self.dates = dates
+        self._reset_()
+        self.title.set_text(self.fig_title.format(date=self.dates[0].strftime("%Y.%m.%d") + "-" + 
+                                                  self.dates[-1].strftime("%m.%d")))
+        return self
+    
     def addParamPlot(self, x, y, z, title="", vmax=1e2, vmin=1e0, steps=3, cmap = plt.cm.Spectral_r, xlabel="Time UT",
                      ylabel="L", label=r"$B_{chorus}$[pT]", ax=None, fig=None, add_colbar=True, 
                      interpolate_params={"dt":"1T"}):
@@ -143,7 +213,33 @@ class RangeTimePlot(object):
         df = df.set_index("x").resample(interpolate_params["dt"]).max().reset_index()
         df["x"] = df.x.apply(lambda k: date2num(k))
         X, Y, Z = get_gridded_parameters(df)
-        # Configure axes
+        self._format_axis(ax, xlabel, ylabel)
+        ax.pcolormesh(X, Y, Z.T, lw=4., edgecolors="None", cmap=cmap, norm=norm)
+        if add_colbar: self._add_colorbar(fig, ax, norm, cmap, label=title+" "+label)
+        ax.set_title(title, loc="left")
+        return
+    
+    def addTilePlot(self, pyramid, title="", how="max", vmax=1e2, vmin=1e0, cmap = plt.cm.Spectral_r, 
+                    xlabel="Time UT", ylabel="L", label=r"$B_{chorus}$[pT]", ax=None, fig=None, add_colbar=True):
+        """
+        Plot the (time x L) max / mean grid from a tiles.TilePyramid, at the coarsest
+        level that still has one time bin per pixel of the axis.
+        """
+        if fig is None: fig = self.fig
+        if ax is None: ax = self._add_axis()
+        norm = mpl.colors.LogNorm(vmin=vmin, vmax=vmax)
+        cmap.set_bad("w", alpha=0.0)
+        start, end = self.dates[0], self.dates[-1]+dt.timedelta(1)
+        level = pyramid.level_for(start, end, ax.get_window_extent().width)
+        t, L, Z = pyramid.query(start, end, level, how)
+        self._format_axis(ax, xlabel, ylabel)
+        ax.pcolormesh(date2num(t.astype("datetime64[us]").astype(dt.datetime)), L, np.ma.masked_invalid(Z).T, 
+                      edgecolors="None", cmap=cmap, norm=norm)
+        if add_colbar: self._add_colorbar(fig, ax, norm, cmap, label=title+" "+label)
+        ax.set_title(title, loc="left")
+        return
+    
+    def _format_axis(self, ax, xlabel, ylabel):
         ax.xaxis.set_major_formatter(DateFormatter(r"$%d$"))
         ax.xaxis.set_minor_formatter(DateFormatter(r"$%H^{%M}$"))
         hours = mdates.HourLocator(byhour=[12])
@@ -152,16 +248,23 @@ class RangeTimePlot(object):
         ax.set_ylabel(ylabel, fontdict={"size":12})
         ax.set_xlim([self.dates[0], self.dates[-1]+dt.timedelta(1)])
         ax.set_ylim(1.5, 6.5)
-        ax.pcolormesh(X, Y, Z.T, lw=4., edgecolors="None", cmap=cmap, norm=norm)
-        if add_colbar: self._add_colorbar(fig, ax, norm, cmap, label=title+" "+label)
-        ax.set_title(title, loc="left")
         return
     
     def _add_axis(self):
         self._num_subplots_created += 1
-        ax = self.fig.add_subplot(self.num_subplots, 1, self._num_subplots_created)
+        if len(self.axes) >= self._num_subplots_created:
+            ax = self.axes[self._num_subplots_created - 1]
+            ax.cla()
+        else:
+            ax = self.fig.add_subplot(self.num_subplots, 1, self._num_subplots_created)
+            self.axes.append(ax)
         ax.tick_params(axis="both", labelsize=12)
         return ax
+    
+    def _reset_(self):
+        """ Axes and colorbar axes are cleared when they are reused """
+        self._num_subplots_created, self._num_colorbars_created = 0, 0
+        return
 
     def _add_colorbar(self, fig, ax, norm, colormap, label=""):
         """
@@ -177,7 +280,13 @@ class RangeTimePlot(object):
         pos = ax.get_position()
         cpos = [pos.x1 + 0.025, pos.y0 + 0.0125,
                 0.015, pos.height * 0.8]                # this list defines (left, bottom, width, height
-        cax = fig.add_axes(cpos)
+        if len(self.caxes) > self._num_colorbars_created:
+            cax = self.caxes[self._num_colorbars_created]
+            cax.cla()
+        else:
+            cax = fig.add_axes(cpos)
+            self.caxes.append(cax)
+        self._num_colorbars_created += 1
         cb2 = mpl.colorbar.ColorbarBase(cax, cmap=colormap,
                                         norm=norm,
                                         spacing="uniform",
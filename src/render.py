@@ -0,0 +1,144 @@
+"""render.py: Module is used to render batches of daily / monthly summary figures in parallel"""
+
+__author__ = "Chakraborty, S."
+__copyright__ = "Copyright 2021, Chakraborty"
+__credits__ = []
+__license__ = "MIT"
+__version__ = "1.0."
+__maintainer__ = "Chakraborty, S."
+__email__ = "shibaji7@vt.edu"
+__status__ = "Research"
+
+import os
+import sys
+import json
+import hashlib
+import datetime as dt
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dateutil import parser as prs
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+sys.path.append("src/")
+import plotlib
+import spectra
+from tiles import TilePyramid
+
+_FIGURES = {}
+
+def periods(dates, monthly=False):
+    """ Group dates into days or calendar months """
+    if not monthly: return [[d] for d in dates]
+    o = {}
+    for d in dates: o.setdefault((d.year, d.month), []).append(d)
+    return [o[k] for k in sorted(o.keys())]
+
+def inputs(kind, days, sc="A", localDir="tmp/EMFISIS/"):
+    """ Input files of a figure: daily spectral HDF5 files or merged daily CSVs """
+    if kind == "FrequencyTimePlot": return [localDir + "%s_%s.h5"%(d.strftime("%Y%m%d"), sc) for d in days]
+    return [localDir + "%s.csv"%d.strftime("%Y%m%d") for d in days]
+
+def get_key(kind, days, fnames, params):
+    """ Hash of the figure kind, period, rendering parameters and input file stats """
+    o = {"kind": kind, "days": [d.strftime("%Y%m%d") for d in days], "params": params, "files": []}
+    for f in fnames:
+        if os.path.exists(f): o["files"].append([os.path.basename(f), os.path.getsize(f), os.path.getmtime(f)])
+    return hashlib.sha1(json.dumps(o, sort_keys=True).encode()).hexdigest()
+
+def _figure_(kind, *args):
+    """ Figure of a kind, created once per worker process and reset for every job """
+    if kind not in _FIGURES:
+        _FIGURES[kind] = getattr(plotlib, kind)(*args, num_subplots=1)
+        return _FIGURES[kind]
+    return _FIGURES[kind].reset(*args)
+
+def render(job):
+    """ Render one figure and record the hash of its inputs next to it, None if it has no input """
+    kind, days, fnames, fig_name, key, params = job
+    fnames = [f for f in fnames if os.path.exists(f)]
+    if len(fnames) == 0: return None
+    if kind == "FrequencyTimePlot":
+        o = spectra.load(fnames[0])["SpectralData"]
+        Z = o["BuBu"] + o["BvBv"] + o["BwBw"]
+        f = _figure_(kind, o["Epoch"], o["WFR"])
+        f.addParamPlot(Z, "RBSP-%s"%params["sc"], render="raster", agg=params["agg"])
+    else:
+        f = _figure_(kind, days)
+        f.addTilePlot(TilePyramid(params["tileDir"]), how=params["how"])
+    f.save(fig_name)
+    with open(fig_name + ".hash", "w") as h: h.write(key)
+    return fig_name
+
+def sync_tiles(dates, localDir="tmp/EMFISIS/", tileDir="tmp/tiles/B/"):
+    """
+    Rebuild the tiles of the days whose merged daily CSV changed since they were
+    tiled. Every CSV holds all the rows of its day, so its tiles are replaced.
+    """
+    pyramid = TilePyramid(tileDir)
+    for d in dates:
+        fn = localDir + "%s.csv"%d.strftime("%Y%m%d")
+        if not os.path.exists(fn): continue
+        src = pyramid.cacheDir + "1T/%s.src"%d.strftime("%Y%m%d")
+        key = get_key("tiles", [d], [fn], {})
+        if os.path.exists(src) and open(src).read() == key: continue
+        o = pd.read_csv(fn, parse_dates=["epoch"])
+        o = o[(o.epoch >= d) & (o.epoch < d + dt.timedelta(1))]
+        pyramid.update(o.epoch.values, np.array(o.L), np.array(o["B(pT)"]), replace=True)
+        with open(src, "w") as h: h.write(key)
+        logger.info(f"Tiled - {fn}")
+    return pyramid
+
+def batch(dates, kinds=["FrequencyTimePlot", "RangeTimePlot"], monthly=False, sc="A", agg="max", how="max",
+          localDir="tmp/EMFISIS/", tileDir="tmp/tiles/B/", outDir="tmp/figures/", procs=None, force=False):
+    """
+    Render the figures of every (kind, period) with a pool of headless (Agg)
+    worker processes. Figures whose inputs hash is unchanged are skipped,
+    range-time figures are drawn from the tile pyramid, synced first.
+    """
+    if not os.path.exists(outDir): os.makedirs(outDir)
+    params = {"sc": sc, "agg": agg, "how": how, "tileDir": tileDir}
+    if "RangeTimePlot" in kinds: sync_tiles(dates, localDir, tileDir)
+    jobs, skipped = [], 0
+    for kind in kinds:
+        # Spectrograms are daily figures
+        for days in periods(dates, monthly and kind == "RangeTimePlot"):
+            fnames = inputs(kind, days, sc, localDir)
+            if not any(os.path.exists(f) for f in fnames):
+                logger.warning(f"No input for {kind} {days[0].strftime('%Y%m%d')}-{days[-1].strftime('%Y%m%d')}, skipped")
+                continue
+            fig_name = outDir + "%s_%s_%s.png"%(kind, days[0].strftime("%Y%m%d"), days[-1].strftime("%Y%m%d"))
+            key = get_key(kind, days, fnames, params)
+            if not force and os.path.exists(fig_name) and os.path.exists(fig_name + ".hash") and\
+                    open(fig_name + ".hash").read() == key:
+                skipped += 1
+                continue
+            jobs.append((kind, days, fnames, fig_name, key, params))
+    logger.info(f"Rendering {len(jobs)} figures, {skipped} unchanged")
+    with ProcessPoolExecutor(max_workers=procs or multiprocessing.cpu_count()) as pool:
+        futures = dict((pool.submit(render, job), job) for job in jobs)
+        for future in as_completed(futures):
+            kind, days = futures[future][:2]
+            try: logger.info(f"Saved - {future.result()}")
+            except Exception as e: logger.error(f"Failed {kind} {days[0].strftime('%Y%m%d')} - {e}")
+    return [j[3] for j in jobs]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--start", default=dt.datetime(2012,10,1), help="Start date (default 2012-10-01)",
+            type=prs.parse)
+    parser.add_argument("-e", "--end", default=dt.datetime(2012,10,31), help="End date (default 2012-10-31)",
+            type=prs.parse)
+    parser.add_argument("-k", "--kinds", nargs="+", default=["FrequencyTimePlot", "RangeTimePlot"], help="Figure kinds")
+    parser.add_argument("-mo", "--monthly", action="store_true", help="Monthly RangeTimePlot figures instead of daily")
+    parser.add_argument("-sc", "--sc", default="A", help="Spacecraft of the spectrograms (default A)")
+    parser.add_argument("-p", "--procs", default=None, type=int, help="Number of worker processes (default all cores)")
+    parser.add_argument("-f", "--force", action="store_true", help="Render unchanged figures again")
+    args = parser.parse_args()
+    dates = [args.start + dt.timedelta(i) for i in range((args.end - args.start).days + 1)]
+    batch(dates, args.kinds, args.monthly, args.sc, procs=args.procs, force=args.force)
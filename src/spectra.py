@@ -0,0 +1,159 @@
+"""spectra.py: Module is used to store daily WFR spectral matrices and ephemeris in compact, compressed HDF5 files"""
+
+__author__ = "Chakraborty, S."
+__copyright__ = "Copyright 2021, Chakraborty"
+__credits__ = []
+__license__ = "MIT"
+__version__ = "1.0."
+__maintainer__ = "Chakraborty, S."
+__email__ = "shibaji7@vt.edu"
+__status__ = "Research"
+
+import os
+import json
+import numpy as np
+import h5py
+from scipy import fft
+
+# PSD (nT^2/Hz) matrices of the spectral data
+PSD = ["BuBu", "BvBv", "BwBw"]
+# log16 encoding: log10(PSD) in [LOG_MIN, LOG_MAX] quantized on codes 2 ... 65535,
+# code 0 is NaN and code 1 is a value <= 10**LOG_MIN (decoded as 0)
+LOG_MIN, LOG_MAX = -14., 0.
+NCODES = 65534
+
+
+def error_bound(encoding):
+    """ Maximum relative error of a decoded PSD value within [10**LOG_MIN, 10**LOG_MAX] """
+    if encoding == "f4": return 2.**-24
+    if encoding == "log16": return 10**(0.5 * (LOG_MAX - LOG_MIN) / (NCODES - 1)) * (1 + 2.**-24) - 1
+    return 0.
+
+def encode(psd, encoding="f4"):
+    """ Encode a linear PSD array as float32 or log16 (uint16 codes) """
+    psd = np.asarray(psd)
+    if encoding == "f4": return psd.astype(np.float32)
+    if encoding == "log16":
+        with np.errstate(divide="ignore", invalid="ignore"):
+            x = (np.log10(psd) - LOG_MIN) / (LOG_MAX - LOG_MIN) * (NCODES - 1)
+        code = np.clip(np.rint(x), 0, NCODES - 1) + 2
+        code[~(psd > 10**LOG_MIN)] = 1
+        code[np.isnan(psd)] = 0
+        return code.astype(np.uint16)
+    return psd
+
+def decode(x, encoding="f4"):
+    """ Decode an array of encode into linear PSD (float32) """
+    x = np.asarray(x)
+    if encoding == "log16":
+        psd = (10**(LOG_MIN + (x.astype(np.float64) - 2) * (LOG_MAX - LOG_MIN) / (NCODES - 1))).astype(np.float32)
+        psd[x == 1] = 0.
+        psd[x == 0] = np.nan
+        return psd
+    return x
+
+def save(fname, a, encoding="f4", chunk_rows=1024):
+    """ Store a DownloadSC day dictionary in HDF5, PSD matrices encoded and compressed """
+    tmp = fname + ".tmp"
+    with h5py.File(tmp, "w") as f:
+        f.attrs["params"] = json.dumps(a["params"])
+        g = f.create_group("LocationInfo")
+        for k, v in a["LocationInfo"].items():
+            v = np.asarray(v)
+            # Older files hold UTC as a list of datetime
+            if v.dtype == object: v = v.astype("datetime64[ns]")
+            if np.issubdtype(v.dtype, np.datetime64): v = v.astype("datetime64[ns]").astype(np.int64)
+            g.create_dataset(k, data=v, compression="gzip", shuffle=True)
+        if "UTC" in g: g["UTC"].attrs["units"] = "ns since 1970-01-01"
+        g = f.create_group("SpectralData")
+        g.attrs["encoding"], g.attrs["relative_error_bound"] = encoding, error_bound(encoding)
+        g.attrs["log_min"], g.attrs["log_max"] = LOG_MIN, LOG_MAX
+        spec = a["SpectralData"]
+        g.create_dataset("Epoch", data=np.array(spec["Epoch"], dtype="datetime64[ns]").astype(np.int64),
+                         compression="gzip", shuffle=True)
+        for k in PSD:
+            x = encode(spec[k], encoding)
+            g.create_dataset(k, data=x, chunks=(min(chunk_rows, x.shape[0]),) + x.shape[1:],
+                             compression="gzip", shuffle=True)
+        w = g.create_group("WFR")
+        for k, v in spec["WFR"].items(): w.create_dataset(k, data=v)
+    os.replace(tmp, fname)
+    return
+
+def load(fname, keys=None):
+    """ Read a file of save back into the day dictionary (keys = PSD matrices to read) """
+    a = {}
+    with h5py.File(fname, "r") as f:
+        a["params"] = json.loads(f.attrs["params"])
+        if "LocationInfo" in f:
+            g = f["LocationInfo"]
+            a["LocationInfo"] = dict((k, g[k][()]) for k in g.keys())
+            a["LocationInfo"]["UTC"] = a["LocationInfo"]["UTC"].astype("datetime64[ns]")
+        g = f["SpectralData"]
+        encoding = g.attrs["encoding"]
+        spec = {"Epoch": g["Epoch"][()].astype("datetime64[ns]").astype("datetime64[us]").tolist()}
+        for k in (keys or [k for k in PSD if k in g]): spec[k] = decode(g[k][()], encoding)
+        spec["WFR"] = dict((k, g["WFR"][k][()]) for k in g["WFR"].keys())
+        a["SpectralData"] = spec
+    return a
+
+def welch(x, fs, nperseg=1024, workers=-1):
+    """ Frequencies and one sided Welch PSD (Hann, half overlap) of every row of x """
+    x = np.ascontiguousarray(x, dtype=np.float64)
+    step = nperseg // 2
+    nseg = (x.shape[1] - nperseg) // step + 1
+    seg = np.lib.stride_tricks.as_strided(x, (x.shape[0], nseg, nperseg),
+                                          (x.strides[0], step * x.strides[1], x.strides[1]))
+    w = np.hanning(nperseg + 1)[:-1]
+    X = fft.rfft((seg - seg.mean(axis=-1, keepdims=True)) * w, axis=-1, workers=workers)
+    P = (X.real**2 + X.imag**2).mean(axis=1) / (fs * (w**2).sum())
+    P[:, 1:-1 if nperseg % 2 == 0 else None] *= 2
+    return fft.rfftfreq(nperseg, 1. / fs), P
+
+def wfr_weights(f, WFR):
+    """ Matrix (FFT bins x WFR bands) averaging the FFT bins of every WFR band """
+    W = np.zeros((len(f), len(WFR["frequencies"])))
+    for j, (fc, bw) in enumerate(zip(WFR["frequencies"], WFR["bandwidth"])):
+        m = (f >= fc - bw / 2) & (f < fc + bw / 2)
+        if m.any(): W[m, j] = 1. / m.sum()
+        elif f[0] <= fc <= f[-1]:
+            i = min(np.searchsorted(f, fc, side="right") - 1, len(f) - 2)
+            a = (fc - f[i]) / (f[i + 1] - f[i])
+            W[i, j], W[i + 1, j] = 1 - a, a
+    return W
+
+class SpectralWriter(object):
+    """ Append spectra on the WFR grid to an HDF5 file readable with load """
+
+    def __init__(self, fname, WFR, params, encoding="f4", chunk_rows=1024):
+        self.fname = fname
+        self.encoding = encoding
+        self.f = h5py.File(fname + ".tmp", "w")
+        self.f.attrs["params"] = json.dumps(params)
+        self.g = self.f.create_group("SpectralData")
+        self.g.attrs["encoding"], self.g.attrs["relative_error_bound"] = encoding, error_bound(encoding)
+        self.g.attrs["log_min"], self.g.attrs["log_max"] = LOG_MIN, LOG_MAX
+        nb = len(WFR["frequencies"])
+        self.g.create_dataset("Epoch", (0,), maxshape=(None,), dtype=np.int64, chunks=(chunk_rows,))
+        for k in PSD:
+            self.g.create_dataset(k, (0, nb), maxshape=(None, nb), chunks=(chunk_rows, nb),
+                                  dtype=encode(np.zeros(1), encoding).dtype, compression="gzip", shuffle=True)
+        w = self.g.create_group("WFR")
+        for k, v in WFR.items(): w.create_dataset(k, data=v)
+        return
+
+    def append(self, epoch, psd):
+        """ Append rows: epoch (datetime) and PSD matrices of the keys of PSD """
+        n = self.g["Epoch"].shape[0]
+        k = len(epoch)
+        self.g["Epoch"].resize((n + k,))
+        self.g["Epoch"][n:] = np.array(epoch, dtype="datetime64[ns]").astype(np.int64)
+        for key, v in psd.items():
+            self.g[key].resize((n + k, self.g[key].shape[1]))
+            self.g[key][n:] = encode(v, self.encoding)
+        return self
+
+    def close(self):
+        self.f.close()
+        os.replace(self.fname + ".tmp", self.fname)
+        return self.fname
@@ -0,0 +1,157 @@
+"""tiles.py: Module is used to build a multi-resolution (time x L) tile pyramid for range-time plots"""
+
+__author__ = "Chakraborty, S."
+__copyright__ = "Copyright 2021, Chakraborty"
+__credits__ = []
+__license__ = "MIT"
+__version__ = "1.0."
+__maintainer__ = "Chakraborty, S."
+__email__ = "shibaji7@vt.edu"
+__status__ = "Research"
+
+import os
+import numpy as np
+
+# (level, cadence in seconds, tile span) from the finest to the coarsest level
+LEVELS = [("1T", 60, "D"), ("10T", 600, "D"), ("1H", 3600, "M"), ("1D", 86400, "Y")]
+SPANS = {"D": "%Y%m%d", "M": "%Y%m", "Y": "%Y"}
+
+
+def tile_range(start, span):
+    """ Start and end (datetime64[s]) of the tile of a span containing start """
+    t0 = np.datetime64(start, "s").astype("datetime64[%s]"%span)
+    return t0.astype("datetime64[s]"), (t0 + 1).astype("datetime64[s]")
+
+def tiles_between(start, end, span):
+    """ Start times of the tiles of a span overlapping [start, end) """
+    t0 = np.datetime64(start, "s").astype("datetime64[%s]"%span)
+    t1 = (np.datetime64(end, "s") - np.timedelta64(1, "s")).astype("datetime64[%s]"%span)
+    return [t.astype("datetime64[s]") for t in np.arange(t0, t1 + 1)]
+
+class TilePyramid(object):
+    """
+    Precomputed (time x L) grids of sum, count and max of a parameter (e.g. B(pT))
+    at 1 min, 10 min, 1 h and 1 day cadences. The 1 min level is stored in daily
+    tiles built from the raw series, every coarser level is aggregated exactly from
+    the next finer one (daily tiles at 10 min, monthly at 1 h, yearly at 1 day), so
+    an update only rewrites the bins of the days it touches. Tiles are float32 .npy
+    arrays (3 x time x L) read memory-mapped.
+    """
+
+    def __init__(self, cacheDir="tmp/tiles/B/", Lmin=1.5, Lmax=6.5, dL=0.1, v=False):
+        self.cacheDir = cacheDir
+        self.Lmin, self.Lmax, self.dL = Lmin, Lmax, dL
+        self.nL = int(np.rint((Lmax - Lmin) / dL)) + 1
+        self.L = Lmin + dL * np.arange(self.nL)
+        self.verbose = v
+        return
+
+    def fname(self, level, start):
+        span = dict((l, s) for l, _, s in LEVELS)[level]
+        return self.cacheDir + "%s/%s.npy"%(level, start.astype("O").strftime(SPANS[span]))
+
+    def _save_(self, level, start, tile):
+        fname = self.fname(level, start)
+        if not os.path.exists(os.path.dirname(fname)): os.makedirs(os.path.dirname(fname))
+        np.save(fname + ".tmp.npy", tile)
+        os.replace(fname + ".tmp.npy", fname)
+        return
+
+    def _load_(self, level, start):
+        fname = self.fname(level, start)
+        return np.load(fname, mmap_mode="r") if os.path.exists(fname) else None
+
+    def _empty_(self, n):
+        tile = np.zeros((3, n, self.nL), dtype=np.float32)
+        tile[2] = -np.inf
+        return tile
+
+    def update(self, epoch, L, z, replace=False):
+        """
+        Add a raw (time, L, z) series. By default the series is merged into the
+        1 min tiles of its days, so every spacecraft (or any part of a day) can
+        be added in its own call; adding the same rows twice counts them twice.
+        With replace=True the 1 min tiles of the days present are replaced, and
+        all the rows of these days must then be in this call. The coarser tiles
+        containing these days are updated.
+        """
+        t = np.asarray(epoch, dtype="datetime64[s]").astype(np.int64)
+        L, z = np.asarray(L, dtype=np.float64), np.asarray(z, dtype=np.float64)
+        il = np.rint((L - self.Lmin) / self.dL)
+        ok = np.isfinite(z) & np.isfinite(L) & (il >= 0) & (il < self.nL)
+        t, il, z = t[ok], il[ok].astype(np.int64), z[ok]
+        day = t // 86400
+        days = np.unique(day)
+        n = 1440 * self.nL
+        for d in days:
+            m = day == d
+            idx = ((t[m] % 86400) // 60) * self.nL + il[m]
+            tile = self._empty_(1440).reshape(3, n)
+            tile[0] = np.bincount(idx, weights=z[m], minlength=n)
+            tile[1] = np.bincount(idx, minlength=n)
+            np.maximum.at(tile[2], idx, z[m])
+            tile = tile.reshape(3, 1440, self.nL)
+            start = np.datetime64(int(d) * 86400, "s")
+            old = None if replace else self._load_("1T", start)
+            if old is not None: tile = np.stack([old[0] + tile[0], old[1] + tile[1], np.maximum(old[2], tile[2])])
+            self._save_("1T", start, tile)
+        # Update the bins of these days level by level
+        for i in range(1, len(LEVELS)):
+            for d in days: self._build_(i, np.datetime64(int(d) * 86400, "s"))
+        if self.verbose: print(" Tiles updated - %d days, %d samples"%(len(days), len(z)))
+        return self
+
+    def _build_(self, i, day):
+        """ Aggregate the bins of a day of the level i tile from the level i - 1 tile """
+        level, cadence, span = LEVELS[i]
+        flevel, fcadence, fspan = LEVELS[i - 1]
+        t0, t1 = tile_range(day, span)
+        old = self._load_(level, t0)
+        tile = np.array(old) if old is not None else self._empty_(int((t1 - t0).astype(np.int64)) // cadence)
+        del old
+        n, k = 86400 // cadence, cadence // fcadence
+        j = int((day - t0).astype(np.int64)) // cadence
+        f0 = tile_range(day, fspan)[0]
+        src = self._load_(flevel, f0)
+        if src is None: tile[:, j:j + n] = self._empty_(n)
+        else:
+            fj = int((day - f0).astype(np.int64)) // fcadence
+            b = np.asarray(src[:, fj:fj + n * k]).reshape(3, n, k, self.nL)
+            tile[0, j:j + n], tile[1, j:j + n], tile[2, j:j + n] = b[0].sum(1), b[1].sum(1), b[2].max(1)
+        self._save_(level, t0, tile)
+        return
+
+    def level_for(self, start, end, pixels):
+        """
+        Coarsest level with at least one time bin per pixel over [start, end),
+        the finest level if none resolves the width.
+        """
+        seconds = int((np.datetime64(end, "s") - np.datetime64(start, "s")).astype(np.int64))
+        level = LEVELS[0][0]
+        for l, cadence, _ in LEVELS:
+            if seconds // cadence >= pixels: level = l
+        return level
+
+    def query(self, start, end, level="1T", how="max"):
+        """
+        Grid of a level over [start, end).
+        Returns time bin edges (datetime64[s]), L bin edges and the
+        (time x L) grid of max or mean values, NaN where there is no data.
+        """
+        cadence, span = dict((l, (c, s)) for l, c, s in LEVELS)[level]
+        start = np.datetime64(start, "s")
+        start = start - np.timedelta64(int(start.astype(np.int64)) % cadence, "s")
+        end = np.datetime64(end, "s")
+        n = -(-int((end - start).astype(np.int64)) // cadence)
+        Z = np.full((n, self.nL), np.nan, dtype=np.float32)
+        for t0 in tiles_between(start, end, span):
+            tile = self._load_(level, t0)
+            if tile is None: continue
+            i0 = int((t0 - start).astype(np.int64)) // cadence
+            a, b = max(i0, 0), min(i0 + tile.shape[1], n)
+            count = tile[1, a - i0:b - i0]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                v = tile[2, a - i0:b - i0] if how == "max" else tile[0, a - i0:b - i0] / count
+            Z[a:b] = np.where(count > 0, v, np.nan)
+        edges = start + np.arange(n + 1) * np.timedelta64(cadence, "s")
+        return edges, np.append(self.L, self.Lmax + self.dL) - self.dL / 2, Z
@@ -9,5 +9,105 @@ __maintainer__ = "Chakraborty, S."
 __email__ = "shibaji7@vt.edu"
 __status__ = "Research"
 
+import os
+import sys
+import time
+import resource
 import numpy as np
+from contextlib import contextmanager
+from loguru import logger
 
+
+def peak_rss():
+    """ Peak resident set size of the process (lifetime high-water mark) in MB """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.**2 if sys.platform == "darwin" else 1024.)
+
+def fsize(fname):
+    """ Size of a file in bytes, 0 if it does not exist """
+    return os.path.getsize(fname) if os.path.exists(fname) else 0
+
+class Stage(object):
+    """ Measurements of one execution of a pipeline stage """
+    
+    def __init__(self, name, key=None, nbytes=0, records=0):
+        self.name = name
+        self.key = key
+        self.bytes = nbytes
+        self.records = records
+        self.wall = 0.
+        # Growth of the process peak RSS during the stage (0 without a new peak)
+        self.rss = 0.
+        return
+
+class Profiler(object):
+    """
+    Lightweight instrumentation of the data pipeline: wall time, bytes, record
+    counts and growth of the peak RSS per stage and per key (e.g. date/spacecraft),
+    emitted as structured loguru records, with an end-of-run summary per stage.
+    """
+    
+    def __init__(self, v=True):
+        self.stages = []
+        self.verbose = v
+        return
+    
+    def start(self, name, key=None, nbytes=0, records=0):
+        """ Start timing a stage, for blocks that do not fit a with statement """
+        s = Stage(name, key, nbytes, records)
+        s.start, s.rss0 = time.time(), peak_rss()
+        return s
+    
+    def stop(self, s):
+        """ Stop timing a stage, record and log it """
+        s.wall, s.rss = time.time() - s.start, peak_rss() - s.rss0
+        self.stages.append(s)
+        if self.verbose:
+            logger.bind(stage=s.name, key=s.key, wall=s.wall, bytes=s.bytes, records=s.records, rss=s.rss)\
+                .info(f"{s.name} [{s.key}] {s.wall:.2f}s, {s.bytes/2**20:.1f} MB, {s.records} records, peak RSS +{s.rss:.0f} MB")
+        return s
+    
+    @contextmanager
+    def stage(self, name, key=None, nbytes=0, records=0):
+        """
+        Time a block, the yielded Stage can be updated with the bytes and
+        records processed inside it.
+        """
+        s = self.start(name, key, nbytes, records)
+        try: yield s
+        finally: self.stop(s)
+        return
+    
+    def summary(self, by_key=False):
+        """
+        Aggregate the stages (and keys), log a table sorted by total wall time
+        and return its rows. +peakRSS is the largest growth of the process peak
+        RSS (MB) in one call of the stage.
+        """
+        rows = {}
+        for s in self.stages:
+            k = (s.name, s.key) if by_key else (s.name, None)
+            r = rows.setdefault(k, dict(stage=s.name, key=s.key if by_key else None, calls=0, wall=0., 
+                                        bytes=0, records=0, rss=0.))
+            r["calls"] += 1
+            r["wall"] += s.wall
+            r["bytes"] += s.bytes
+            r["records"] += s.records
+            r["rss"] = max(r["rss"], s.rss)
+        rows = sorted(rows.values(), key=lambda r: -r["wall"])
+        total = sum(r["wall"] for r in rows) or 1.
+        lines = ["%-24s %-14s %6s %10s %6s %10s %12s %10s"%("stage", "key", "calls", "wall(s)", "%", 
+                                                             "MB", "records", "+peakRSS")]
+        for i, r in enumerate(rows):
+            lines.append("%-24s %-14s %6d %10.2f %6.1f %10.1f %12d %10.0f%s"%(r["stage"], r["key"] or "-", r["calls"], 
+                                                                            r["wall"], 100*r["wall"]/total, 
+                                                                            r["bytes"]/2**20, r["records"], r["rss"],
+                                                                            "  <- hot" if i == 0 else ""))
+        logger.info("Pipeline summary\n" + "\n".join(lines))
+        return rows
+    
+    def reset(self):
+        self.stages = []
+        return self
+
+profiler = Profiler()
@@ -0,0 +1,41 @@
+"""test_dataset.py: Reads of the chorus dataset that match no file"""
+
+import os
+import sys
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+for m in ["h5py", "pyarrow"]: pytest.importorskip(m)
+from dataset import ChorusDataset
+
+
+def test_empty_reads_keep_the_schema(tmp_path):
+    store = ChorusDataset(str(tmp_path) + "/")
+    assert list(store.read(sc="A").columns) == ["epoch"]
+    assert list(store.read(sc="A", columns=["B(pT)"]).columns) == ["epoch", "B(pT)"]
+    t = pd.date_range(dt.datetime(2017, 1, 1), periods=100, freq="6s")
+    o = pd.DataFrame({"epoch": t, "SAT": "A", "L": np.ones(100), "MLT": np.ones(100), "B(pT)": np.ones(100)})
+    store.write(o, dt.datetime(2017, 1, 1), "A")
+    x = store.read(sc="B")
+    assert len(x) == 0 and list(x.columns) == list(o.columns)
+    assert np.issubdtype(x.epoch.dtype, np.datetime64)
+    assert x.set_index("epoch").empty
+    assert list(store.read(sc="B", columns=["L"]).columns) == ["epoch", "L"]
+    x = store.read_rollup("1H", sc="B")
+    assert len(x) == 0 and list(x.columns) == list(store.read_rollup("1H", sc="A").columns)
+
+def test_projected_reads_keep_epoch(tmp_path):
+    store = ChorusDataset(str(tmp_path) + "/")
+    t = pd.date_range(dt.datetime(2017, 1, 1), periods=100, freq="6s")
+    o = pd.DataFrame({"epoch": t, "SAT": "A", "L": np.ones(100), "MLT": np.ones(100), "B(pT)": np.arange(100.)})
+    store.write(o, dt.datetime(2017, 1, 1), "A")
+    x = store.read(sc="A", columns=["B(pT)"])
+    assert list(x.columns) == ["epoch", "B(pT)"] == list(store.read(sc="B", columns=["B(pT)"]).columns)
+    assert (x.epoch.values == t.values).all() and (x["B(pT)"].values == o["B(pT)"].values).all()
+    x = store.read(sc="A", dates=[t[10], t[20]], columns=["epoch", "L"])
+    assert list(x.columns) == ["epoch", "L"] and len(x) == 10
+    x = store.read_rollup("1T", sc="A", columns=["B(pT)_max"])
+    assert list(x.columns) == ["epoch", "B(pT)_max"] and x["B(pT)_max"].tolist() == [9., 19., 29., 39., 49., 59., 69., 79., 89., 99.]
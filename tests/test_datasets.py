@@ -0,0 +1,30 @@
+"""test_datasets.py: Round trip of the binary (UCIBIN01) UCI dataset container"""
+
+import os
+import sys
+import shutil
+import numpy as np
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DropoutUncertaintyExps")
+sys.path.append(ROOT)
+import datasets
+
+
+def test_binary_round_trip(tmp_path):
+    path = str(tmp_path / "data")
+    shutil.copytree(os.path.join(ROOT, "UCI_Datasets", "yacht", "data"), path)
+    text = datasets.load_text(path)
+    fname = datasets.convert(path)
+    with open(fname, "rb") as f: assert f.read(8) == b"UCIBIN01"
+    binary = datasets.load(path)
+    assert isinstance(binary["data"], np.memmap) and binary["data"].offset % 64 == 0
+    assert np.array_equal(binary["data"], np.asarray(text["data"], dtype=np.float32))
+    for k in ["index_train", "index_test"]: assert np.array_equal(binary[k], np.array(text[k]))
+    assert np.array_equal(binary["index_features"], text["index_features"])
+    for k in ["index_target", "n_hidden", "n_epochs", "n_splits", "dropout_rates", "tau_values"]:
+        assert binary[k] == text[k]
+
+def test_binary_rejects_other_files(tmp_path):
+    with open(str(tmp_path / "data.bin"), "wb") as f: f.write(b"NOTUCI01" + bytes(8))
+    with pytest.raises(ValueError): datasets.load_binary(str(tmp_path))
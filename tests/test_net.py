@@ -0,0 +1,31 @@
+"""test_net.py: Streaming statistics of the MC dropout networks"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DropoutUncertaintyExps", "net"))
+pytest.importorskip("keras")
+import net
+
+
+def test_mc_accumulator_matches_direct_computation():
+    rng = np.random.default_rng(0)
+    y, tau = rng.normal(size=50), 2.5
+    Yt_hat = y[None] + rng.normal(scale=3., size=(1000, 50))
+    acc = net.mc_accumulator(y, tau)
+    for start in range(0, 1000, 64): acc.update(Yt_hat[start:start + 64])
+    l = -0.5 * tau * (y[None] - Yt_hat)**2.
+    ll = np.log(np.mean(np.exp(l), 0)) - 0.5 * np.log(2 * np.pi) + 0.5 * np.log(tau)
+    np.testing.assert_allclose(acc.mean(), Yt_hat.mean(0))
+    np.testing.assert_allclose(acc.m2, ((Yt_hat - Yt_hat.mean(0))**2.).sum(0))
+    assert np.isclose(acc.rmse(), np.mean((y - Yt_hat.mean(0))**2.)**0.5)
+    assert np.isclose(acc.ll(), np.mean(ll))
+
+@pytest.mark.parametrize("chunk_rows", [1, 7, 64, 1000])
+def test_chunked_moments_match_numpy(chunk_rows):
+    X = np.random.default_rng(1).normal(loc=1e3, scale=2., size=(250, 4))
+    mean, std = net._moments(X, chunk_rows)
+    np.testing.assert_allclose(mean, X.mean(0))
+    np.testing.assert_allclose(std, X.std(0))
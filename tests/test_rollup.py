@@ -0,0 +1,93 @@
+"""test_rollup.py: Segmented data of DataLoader with and without stored rollups"""
+
+import os
+import sys
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+for m in ["cdflib", "requests", "netCDF4", "bs4", "paramiko", "scp", "h5py", "pyarrow"]: pytest.importorskip(m)
+import get_data
+from dataset import ChorusDataset
+
+DATES = [dt.datetime(2017, 1, 1), dt.datetime(2017, 1, 2)]
+
+
+def _day(d, sc, rng):
+    """ One day of processed (lgmpy2) rows of a spacecraft, with gaps and NaN """
+    t = pd.date_range(d, periods=14400, freq="6s")
+    t = t[rng.random(len(t)) > 0.2]
+    n = len(t)
+    o = pd.DataFrame({"epoch": t, "SAT": sc, "L": 3 + 2*rng.random(n), "Lstar": 3 + 2*rng.random(n),
+                      "R": 4 + rng.random(n), "MLAT": 10*rng.standard_normal(n), "MLON": 360*rng.random(n),
+                      "MLT": (23.5 + rng.random(n)) % 24, "Fce": 5e3*rng.random(n),
+                      "Bl(pT)": rng.lognormal(size=n), "Bu(pT)": rng.lognormal(size=n), "B(pT)": rng.lognormal(size=n)})
+    o.loc[rng.random(n) < 0.1, "B(pT)"] = np.nan
+    return o
+
+def _loader(localDir, frame):
+    """ DataLoader of the dates without the OMNI download """
+    o = object.__new__(get_data.DataLoader)
+    o.dates, o.localDir, o.first_date_reset, o.verbose = DATES, localDir, True, False
+    o.store = ChorusDataset(localDir + "chorus/")
+    o.frame = frame
+    return o
+
+@pytest.mark.parametrize("cadence", ["1T", "5T", "1H"])
+@pytest.mark.parametrize("stat", ["max", "mean", "median", "p90"])
+def test_stored_and_computed_rollups_are_equal(tmp_path, cadence, stat):
+    rng = np.random.default_rng(0)
+    localDir = str(tmp_path) + "/"
+    store = ChorusDataset(localDir + "chorus/")
+    rows = []
+    for d in DATES:
+        for sc in ["A", "B"]:
+            x = _day(d, sc, rng)
+            store.write(x, d, sc)
+            rows.append(x)
+    stored = _loader(localDir, None)
+    computed = _loader(localDir, pd.concat(rows).reset_index(drop=True))
+    for sc in ["A", "B"]:
+        a, b = stored._rollup_(sc, cadence, stat), computed._rollup_(sc, cadence, stat)
+        assert len(a) == 2 * 86400 // get_data.cadence_seconds(cadence)
+        pd.testing.assert_frame_equal(a, b, check_dtype=False)
+
+def test_filter_with_columns_resets_first_date(tmp_path):
+    localDir = str(tmp_path) + "/"
+    store = ChorusDataset(localDir + "chorus/")
+    x = _day(DATES[0], "A", np.random.default_rng(1)).iloc[5:]
+    store.write(x, DATES[0], "A")
+    for o in [_loader(localDir, None), _loader(localDir, x.reset_index(drop=True))]:
+        y = o._filter_(sc="A", columns=["B(pT)"])
+        assert list(y.columns) == ["epoch", "B(pT)"] and y.epoch.iloc[0] == DATES[0] and len(y) == len(x) + 1
+
+@pytest.mark.parametrize("cadence", ["1T", "5T", "1H"])
+def test_segmented_data_matches_resampled_max(tmp_path, monkeypatch, cadence):
+    rng = np.random.default_rng(2)
+    localDir = str(tmp_path) + "/"
+    store = ChorusDataset(localDir + "chorus/")
+    rows = []
+    for d in DATES:
+        for sc in ["A", "B"]:
+            x = _day(d, sc, rng)
+            store.write(x, d, sc)
+            rows.append(x)
+    t = pd.date_range(DATES[0], periods=2 * 1440, freq="60s")
+    omni = pd.DataFrame({"DATE": t, "AE": rng.random(len(t))})
+    monkeypatch.setattr(get_data.dmap, "get_omni_dataset", lambda dates: omni, raising=False)
+    frame = pd.concat(rows).reset_index(drop=True)
+    freq = "%ds"%get_data.cadence_seconds(cadence)
+    grid = pd.date_range(DATES[0], periods=2 * 86400 // get_data.cadence_seconds(cadence), freq=freq)
+    ae = omni.set_index("DATE").AE.resample(freq).mean().reindex(grid).values
+    outs = []
+    for loader in [_loader(localDir, None), _loader(localDir, frame)]:
+        o = loader.parsed_min_segmented_data(interpolate_params={"dt": cadence}, to_csv=None)
+        assert list(o.columns) == list(frame.columns) + ["AE"]
+        outs.append(o)
+    pd.testing.assert_frame_equal(outs[0], outs[1], check_dtype=False)
+    for sc, o in outs[0].groupby("SAT", sort=False):
+        x = frame[frame.SAT == sc].drop(columns="SAT").set_index("epoch").resample(freq).max().reindex(grid)
+        assert np.allclose(o[x.columns].values, x.values, equal_nan=True)
+        assert np.allclose(o.AE.values, ae)
@@ -0,0 +1,26 @@
+"""test_spectra.py: Encoding error of the spectral caches"""
+
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+pytest.importorskip("h5py")
+import spectra
+
+
+@pytest.mark.parametrize("encoding", ["f4", "log16"])
+def test_round_trip_error_is_within_the_bound(encoding):
+    rng = np.random.default_rng(0)
+    psd = 10**rng.uniform(spectra.LOG_MIN, spectra.LOG_MAX, size=(500, 65))
+    x = spectra.decode(spectra.encode(psd, encoding), encoding).astype(np.float64)
+    assert np.max(np.abs(x / psd - 1)) <= spectra.error_bound(encoding)
+
+def test_log16_special_values():
+    psd = np.array([np.nan, 0., 10**(spectra.LOG_MIN - 1), 10**spectra.LOG_MIN, 10**(spectra.LOG_MAX + 1)])
+    code = spectra.encode(psd, "log16")
+    assert code.dtype == np.uint16 and code[:4].tolist() == [0, 1, 1, 1]
+    x = spectra.decode(code, "log16")
+    assert np.isnan(x[0]) and x[1:4].tolist() == [0., 0., 0.]
+    assert np.isclose(x[4], 10**spectra.LOG_MAX, rtol=spectra.error_bound("log16"))
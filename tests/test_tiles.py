@@ -0,0 +1,60 @@
+"""test_tiles.py: Merge and replace updates of the tile pyramid"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from tiles import TilePyramid
+
+
+START, END = np.datetime64("2021-03-01T12:00:00"), np.datetime64("2021-03-03T12:00:00")
+
+def _series(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    epoch = START + rng.integers(0, int((END - START).astype(np.int64)), n).astype("timedelta64[s]")
+    return epoch, rng.uniform(1.5, 6.5, n), rng.uniform(0., 100., n)
+
+def _grids(pyramid, level="1T"):
+    return [pyramid.query(START, END, level, how)[2] for how in ("mean", "max")]
+
+def _assert_same(a, b):
+    for x, y in zip(a, b): np.testing.assert_allclose(x, y, rtol=1e-5, equal_nan=True)
+
+def test_merge_of_parts_equals_one_update(tmp_path):
+    epoch, L, z = _series()
+    whole = TilePyramid(str(tmp_path / "whole") + "/").update(epoch, L, z)
+    parts = TilePyramid(str(tmp_path / "parts") + "/")
+    parts.update(epoch[::2], L[::2], z[::2]).update(epoch[1::2], L[1::2], z[1::2])
+    for level in ("1T", "10T", "1H", "1D"): _assert_same(_grids(whole, level), _grids(parts, level))
+
+def test_merge_counts_added_rows_twice(tmp_path):
+    epoch, L, z = _series()
+    pyramid = TilePyramid(str(tmp_path) + "/").update(epoch, L, z)
+    day = pyramid._load_("1T", np.datetime64("2021-03-02T00:00:00"))
+    sums, counts = np.array(day[0]), np.array(day[1])
+    pyramid.update(epoch, L, z)
+    day = pyramid._load_("1T", np.datetime64("2021-03-02T00:00:00"))
+    np.testing.assert_allclose(day[0], 2 * sums, rtol=1e-6)
+    np.testing.assert_array_equal(day[1], 2 * counts)
+
+def test_replace_is_idempotent(tmp_path):
+    epoch, L, z = _series()
+    fresh = TilePyramid(str(tmp_path / "fresh") + "/").update(epoch, L, z, replace=True)
+    again = TilePyramid(str(tmp_path / "again") + "/").update(*_series(seed=1))
+    again.update(epoch, L, z, replace=True).update(epoch, L, z, replace=True)
+    for level in ("1T", "1H"): _assert_same(_grids(fresh, level), _grids(again, level))
+
+def test_coarse_levels_aggregate_the_raw_series(tmp_path):
+    epoch, L, z = _series()
+    pyramid = TilePyramid(str(tmp_path) + "/").update(epoch, L, z)
+    mean, mx = _grids(pyramid, "1H")
+    i = ((epoch - START).astype(np.int64) // 3600).astype(int)
+    j = np.rint((L - 1.5) / 0.1).astype(int)
+    n = np.zeros(mean.shape)
+    np.add.at(n, (i, j), 1)
+    s, m = np.zeros(mean.shape), np.full(mean.shape, -np.inf)
+    np.add.at(s, (i, j), z)
+    np.maximum.at(m, (i, j), z)
+    with np.errstate(invalid="ignore"):
+        _assert_same([mean, mx], [np.where(n > 0, s / n, np.nan), np.where(n > 0, m, np.nan)])
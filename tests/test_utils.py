@@ -0,0 +1,20 @@
+"""test_utils.py: Per-stage measurements of the profiler"""
+
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from utils import Profiler
+
+
+def test_stage_rss_is_the_growth_of_the_peak():
+    p = Profiler(v=False)
+    with p.stage("alloc") as s:
+        x = np.ones(2**25)
+        x.sum()
+    del x
+    with p.stage("idle"): pass
+    assert p.stages[0].rss > 0 and p.stages[1].rss == 0
+    rows = p.summary()
+    assert dict((r["stage"], r["rss"]) for r in rows)["idle"] == 0